@@ -0,0 +1,366 @@
+# src/bench/fakes.py
+"""
+    Deterministic stand-ins for the external services, so the pipeline can be benchmarked offline:
+        FakeGroq / FakeAsyncGroq   chat.completions.create honoring the JSON schemas of src/llm/schemas.py
+        FakeMilvusClient           in-memory MilvusClient (collections, filters, dense + sparse search)
+        FakeEmbedder               SentenceTransformer-style encode() with hashed unit vectors
+    Latencies and token counts are drawn from seeded distributions (LLMProfile).
+"""
+import asyncio
+import hashlib
+import json
+import math
+import random
+import re
+import threading
+import time
+from types import SimpleNamespace
+
+import numpy as np
+
+from src.functions.quantization import POPCOUNT
+
+
+class LLMProfile:
+    """
+        Latency / token model of the fake LLM:
+            latency_ms, latency_sigma   time to first token ~ lognormal(median latency_ms, sigma)
+            completion_tokens           mean completion length (normal, 30% spread, capped by max_completion_tokens)
+            token_rate                  generated tokens per second after the first one
+            true_rate                   probability of `true` for boolean fields (is_ambiguous)
+            max_items                   arrays get 0..max_items items
+    """
+    def __init__(self, latency_ms: float = 300.0, latency_sigma: float = 0.3, completion_tokens: int = 200,
+                 token_rate: float = 500.0, true_rate: float = 0.2, max_items: int = 3, seed: int = 0):
+        self.latency_ms = latency_ms
+        self.latency_sigma = latency_sigma
+        self.completion_tokens = completion_tokens
+        self.token_rate = token_rate
+        self.true_rate = true_rate
+        self.max_items = max_items
+        self.seed = seed
+
+
+class FakeLLM:
+    """
+        Shared by the sync and async fronts: draws latency / tokens, builds schema-valid content
+        and counts calls per kind (schema name, "answer", "answer_stream", "json_object").
+    """
+    def __init__(self, profile: LLMProfile | None = None):
+        self.profile = profile or LLMProfile()
+        self.rng = random.Random(self.profile.seed)
+        self.calls: dict[str, int] = {}
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self._lock = threading.Lock()
+
+    def reset_stats(self):
+        with self._lock:
+            self.calls = {}
+            self.prompt_tokens = 0
+            self.completion_tokens = 0
+
+    @property
+    def total_calls(self) -> int:
+        return sum(self.calls.values())
+
+    def _words(self, messages: list) -> list[str]:
+        text = messages[-1].get("content", "") if messages else ""
+        return re.findall(r"\w+", str(text))[-50:] or ["ok"]
+
+    def _value(self, schema: dict, words: list[str]):
+        if "enum" in schema:
+            return self.rng.choice(schema["enum"])
+        kind = schema.get("type")
+        if kind == "object":
+            return {k: self._value(v, words) for k, v in schema.get("properties", {}).items()}
+        if kind == "array":
+            return [self._value(schema.get("items", {"type": "string"}), words) for _ in range(self.rng.randint(0, self.profile.max_items))]
+        if kind == "boolean":
+            return self.rng.random() < self.profile.true_rate
+        if kind == "integer":
+            return self.rng.randint(0, 100)
+        if kind == "number":
+            return round(self.rng.random() * 100, 3)
+        return " ".join(self.rng.choice(words) for _ in range(self.rng.randint(3, 12)))
+
+    def respond(self, kwargs: dict) -> tuple[str, str, SimpleNamespace, float, int]:
+        """
+            Returns (kind, content, usage, first-token delay in s, completion tokens)
+        """
+        messages = kwargs.get("messages", [])
+        response_format = kwargs.get("response_format") or {}
+        with self._lock:
+            if response_format.get("type") == "json_schema":
+                json_schema = response_format["json_schema"]
+                kind = json_schema.get("name", "json_schema")
+                content = json.dumps(self._value(json_schema["schema"], self._words(messages)), ensure_ascii=False)
+            elif response_format.get("type") == "json_object":
+                kind, content = "json_object", "{}"
+            else:
+                kind = "answer_stream" if kwargs.get("stream") else "answer"
+                content = None
+            mean = self.profile.completion_tokens
+            completion = max(1, int(self.rng.gauss(mean, 0.3 * mean)))
+            completion = min(completion, kwargs.get("max_completion_tokens") or completion)
+            delay = self.profile.latency_ms * math.exp(self.rng.gauss(0.0, self.profile.latency_sigma)) / 1000
+            if content is None:
+                words = self._words(messages)
+                content = " ".join(self.rng.choice(words) for _ in range(completion))
+            prompt = sum(len(str(m.get("content", ""))) for m in messages) // 4 + 4 * len(messages)
+            self.calls[kind] = self.calls.get(kind, 0) + 1
+            self.prompt_tokens += prompt
+            self.completion_tokens += completion
+        usage = SimpleNamespace(prompt_tokens=prompt, completion_tokens=completion, total_tokens=prompt + completion)
+        return kind, content, usage, delay, completion
+
+    def _message(self, content: str, usage) -> SimpleNamespace:
+        return SimpleNamespace(
+            choices=[SimpleNamespace(message=SimpleNamespace(role="assistant", content=content))],
+            usage=usage,
+        )
+
+
+class _SyncCompletions:
+    def __init__(self, llm: FakeLLM):
+        self.llm = llm
+
+    def create(self, **kwargs):
+        kind, content, usage, delay, completion = self.llm.respond(kwargs)
+        time.sleep(delay + completion / self.llm.profile.token_rate)
+        return self.llm._message(content, usage)
+
+
+class _AsyncCompletions:
+    def __init__(self, llm: FakeLLM, chunk_tokens: int = 8):
+        self.llm = llm
+        self.chunk_tokens = chunk_tokens
+
+    async def create(self, **kwargs):
+        kind, content, usage, delay, completion = self.llm.respond(kwargs)
+        await asyncio.sleep(delay)
+        if not kwargs.get("stream"):
+            await asyncio.sleep(completion / self.llm.profile.token_rate)
+            return self.llm._message(content, usage)
+        return self._stream(content, usage)
+
+    async def _stream(self, content: str, usage):
+        words = content.split(" ")
+        step = self.chunk_tokens
+        for i in range(0, len(words), step):
+            if i:
+                await asyncio.sleep(step / self.llm.profile.token_rate)
+            delta = SimpleNamespace(role="assistant" if i == 0 else None, content=" ".join(words[i:i + step]) + " ")
+            yield SimpleNamespace(choices=[SimpleNamespace(delta=delta)], x_groq=None, usage=None)
+        # groq puts usage on a last, choice-less chunk
+        yield SimpleNamespace(choices=[], x_groq=SimpleNamespace(usage=usage), usage=None)
+
+
+class FakeGroq:
+    """
+        Stand-in for groq.Groq: GroqClient(config, client=FakeGroq(llm))
+    """
+    def __init__(self, llm: FakeLLM):
+        self.chat = SimpleNamespace(completions=_SyncCompletions(llm))
+
+
+class FakeAsyncGroq:
+    """
+        Stand-in for groq.AsyncGroq: AsyncGroqClient(config, client=FakeAsyncGroq(llm))
+    """
+    def __init__(self, llm: FakeLLM):
+        self.chat = SimpleNamespace(completions=_AsyncCompletions(llm))
+
+
+class _Row(dict):
+    # fields a row doesn't have make the filter false instead of raising
+    def __missing__(self, key):
+        raise _MissingField(key)
+
+
+class _MissingField(Exception):
+    pass
+
+
+class FakeMilvusClient:
+    """
+        In-memory MilvusClient with the subset of the API src/functions/database.py uses.
+        Filters are the boolean expressions that code builds (==, >=, <=, and, in [...]), evaluated in Python.
+        Each call can sleep `latency_ms` to stand in for the network round trip.
+        bytes_written / writes count the payload of insert / upsert per collection.
+    """
+    def __init__(self, uri: str | None = None, latency_ms: float = 0.0, **kwargs):
+        self.latency_ms = latency_ms
+        self.databases = {"default"}
+        self.collections: dict[str, dict[str, dict]] = {}
+        self.fields: dict[str, list[dict]] = {}
+        self.bytes_written: dict[str, int] = {}
+        self.writes: dict[str, int] = {}
+        self.calls: dict[str, int] = {}
+        self._filters: dict[str, object] = {}
+        self._lock = threading.Lock()
+
+    def _op(self, name: str):
+        with self._lock:
+            self.calls[name] = self.calls.get(name, 0) + 1
+        if self.latency_ms:
+            time.sleep(self.latency_ms / 1000)
+
+    # ---------- databases / collections ----------
+    def list_databases(self):
+        self._op("list_databases")
+        return sorted(self.databases)
+
+    def create_database(self, db_name):
+        self._op("create_database")
+        self.databases.add(db_name)
+
+    def has_collection(self, collection_name):
+        self._op("has_collection")
+        return collection_name in self.collections
+
+    def create_collection(self, collection_name, schema=None, index_params=None, **kwargs):
+        self._op("create_collection")
+        with self._lock:
+            self.collections.setdefault(collection_name, {})
+            self.fields[collection_name] = [{"name": f.name, "type": f.dtype} for f in getattr(schema, "fields", [])]
+
+    def describe_collection(self, collection_name):
+        self._op("describe_collection")
+        return {"collection_name": collection_name, "fields": [dict(f) for f in self.fields.get(collection_name, [])]}
+
+    def load_collection(self, collection_name, **kwargs):
+        self._op("load_collection")
+
+    # ---------- writes ----------
+    @staticmethod
+    def _row_bytes(row: dict) -> int:
+        size = 0
+        for value in row.values():
+            if isinstance(value, (list, tuple, np.ndarray)):
+                size += 4 * len(value)                 # float32 vector
+            elif isinstance(value, bytes):
+                size += len(value)                     # binary vector
+            elif isinstance(value, dict):
+                size += 8 * len(value)                 # sparse: uint32 index + float32 weight
+            elif isinstance(value, str):
+                size += len(value.encode("utf-8"))
+            else:
+                size += 8
+        return size
+
+    def insert(self, collection_name, data, **kwargs):
+        self._op("insert")
+        rows = data if isinstance(data, list) else [data]
+        with self._lock:
+            col = self.collections.setdefault(collection_name, {})
+            for row in rows:
+                col[row["pk"]] = dict(row)
+            self.bytes_written[collection_name] = self.bytes_written.get(collection_name, 0) + sum(self._row_bytes(r) for r in rows)
+            self.writes[collection_name] = self.writes.get(collection_name, 0) + 1
+        return {"insert_count": len(rows)}
+
+    def upsert(self, collection_name, data, **kwargs):
+        result = self.insert(collection_name, data)
+        return {"upsert_count": result["insert_count"]}
+
+    def delete(self, collection_name, ids=None, filter=None, **kwargs):
+        self._op("delete")
+        with self._lock:
+            col = self.collections.get(collection_name, {})
+            pks = list(ids or []) if ids is not None else [pk for pk, r in col.items() if self._match(r, filter)]
+            for pk in pks:
+                col.pop(pk, None)
+        return {"delete_count": len(pks)}
+
+    # ---------- reads ----------
+    def _match(self, row: dict, expr: str | None) -> bool:
+        if not expr:
+            return True
+        code = self._filters.get(expr)
+        if code is None:
+            code = self._filters[expr] = compile(expr, "<filter>", "eval")
+        try:
+            return bool(eval(code, {"__builtins__": {}}, _Row(row)))
+        except _MissingField:
+            return False
+
+    @staticmethod
+    def _project(row: dict, output_fields) -> dict:
+        if not output_fields or "*" in output_fields:
+            return dict(row)
+        return {k: row[k] for k in output_fields if k in row}
+
+    def query(self, collection_name, filter="", output_fields=None, limit=None, **kwargs):
+        self._op("query")
+        with self._lock:
+            rows = [self._project(r, output_fields) for r in self.collections.get(collection_name, {}).values() if self._match(r, filter)]
+        return rows[:limit] if limit else rows
+
+    def search(self, collection_name, data, filter="", limit=10, search_params=None, output_fields=None,
+               anns_field="embedding", **kwargs):
+        self._op("search")
+        metric = (search_params or {}).get("metric_type", "COSINE")
+        with self._lock:
+            rows = [r for r in self.collections.get(collection_name, {}).values() if anns_field in r and self._match(r, filter)]
+        results = []
+        for q in data:
+            if isinstance(q, dict):
+                # sparse: inner product over shared term ids
+                scored = [(sum(w * r[anns_field].get(t, 0.0) for t, w in q.items()), r) for r in rows]
+                scored = [(s, r) for s, r in scored if s > 0]
+                scored.sort(key=lambda x: -x[0])
+            elif isinstance(q, bytes) and rows:
+                # binary: HAMMING distance, lower is better
+                qb = np.frombuffer(q, dtype=np.uint8)
+                codes = np.asarray([np.frombuffer(r[anns_field], dtype=np.uint8) for r in rows])
+                scores = POPCOUNT[np.bitwise_xor(codes, qb)].sum(axis=1)
+                scored = [(int(scores[i]), rows[i]) for i in np.argsort(scores, kind="stable")]
+            elif rows:
+                qv = np.asarray(q, dtype=np.float32).reshape(-1)
+                matrix = np.asarray([r[anns_field] for r in rows], dtype=np.float32)
+                if metric == "L2":
+                    scores = ((matrix - qv) ** 2).sum(axis=1)
+                    order = np.argsort(scores)
+                else:
+                    if metric == "COSINE":
+                        matrix = matrix / np.maximum(np.linalg.norm(matrix, axis=1, keepdims=True), 1e-12)
+                        qv = qv / max(float(np.linalg.norm(qv)), 1e-12)
+                    scores = matrix @ qv
+                    order = np.argsort(-scores)
+                scored = [(float(scores[i]), rows[i]) for i in order]
+            else:
+                scored = []
+            results.append([
+                {"id": r["pk"], "distance": s, "entity": self._project(r, output_fields)}
+                for s, r in scored[:limit]
+            ])
+        return results
+
+    def close(self):
+        pass
+
+
+class FakeEmbedder:
+    """
+        encode(texts) -> (n, dim) float32 unit vectors, a pure function of the text (blake2b-seeded),
+        costing ms_per_batch + ms_per_text * n of (GIL-free) sleep
+    """
+    def __init__(self, dim: int = 384, ms_per_batch: float = 2.0, ms_per_text: float = 0.5):
+        self.dim = dim
+        self.ms_per_batch = ms_per_batch
+        self.ms_per_text = ms_per_text
+        self.calls = 0
+        self.texts = 0
+
+    def encode(self, texts, **kwargs):
+        texts = [texts] if isinstance(texts, str) else list(texts)
+        self.calls += 1
+        self.texts += len(texts)
+        time.sleep((self.ms_per_batch + self.ms_per_text * len(texts)) / 1000)
+        out = np.empty((len(texts), self.dim), dtype=np.float32)
+        for i, text in enumerate(texts):
+            seed = int.from_bytes(hashlib.blake2b(str(text).encode("utf-8"), digest_size=8).digest(), "little")
+            v = np.random.default_rng(seed).standard_normal(self.dim).astype(np.float32)
+            out[i] = v / np.linalg.norm(v)
+        return out
@@ -0,0 +1,249 @@
+# src/bench/load.py
+"""
+    Multi-session load generator: N concurrent synthetic (user_id, chat_id) sessions drive a
+    SessionManager wired to the stand-ins of src/bench/fakes.py, for each N of a concurrency sweep.
+
+        python -m src.bench.load --sweep 1,2,4,8,16,32,64 --duration 20
+        python -m src.bench.load --sweep 8,32 --think-ms 2000 --message-words 40 --summary-every 4 --json load.json
+
+    Every session is a closed loop: think (exponential, mean --think-ms), send one message
+    (lognormal length, median --message-words words), stream the answer. Per concurrency level it
+    reports throughput, turn / first-token latency percentiles, event-loop lag, memory-job backlog,
+    peak threads and RSS; the saturation point is the first level where adding sessions no longer
+    buys throughput (or tail latency blows up).
+"""
+import argparse
+import asyncio
+import json
+import random
+import resource
+import shutil
+import tempfile
+import threading
+import time
+
+import yaml
+
+from src.bench.replay import Bench, add_fake_args, bench_config, percentiles, quiet
+from src.pipeline.session_manager import SessionManager
+
+WORDS = (
+    "memory vector search milvus index query summary window token prompt model answer latency python "
+    "asyncio thread batch cache embedding schema session user chat history context groq stream json "
+    "deploy config docker error retry queue worker idle evict budget recall cosine sparse ticket bug"
+).split()
+
+
+def rss_mb() -> float:
+    # current resident set size; ru_maxrss (peak, KiB on Linux) where /proc is missing
+    try:
+        with open("/proc/self/status", "r") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class Sampler:
+    """
+        Samples event-loop lag, live threads and RSS every `interval` seconds while a level runs
+    """
+    def __init__(self, interval: float = 0.1):
+        self.interval = interval
+        self.lag_ms: list[float] = []
+        self.threads = 0
+        self.rss_mb = 0.0
+        self._task = None
+
+    async def _run(self):
+        while True:
+            t = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            self.lag_ms.append((time.perf_counter() - t - self.interval) * 1000)
+            self.threads = max(self.threads, threading.active_count())
+            self.rss_mb = max(self.rss_mb, rss_mb())
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+
+
+def synthetic_message(rng: random.Random, median_words: int) -> str:
+    n = max(1, int(median_words * rng.lognormvariate(0.0, 0.5)))
+    return " ".join(rng.choice(WORDS) for _ in range(n)) + "?"
+
+
+def summary_context_length(args) -> int:
+    """
+        max_context_length that closes a window roughly every `summary_every` turns:
+        fixed prompt part + that many (message + answer) turns
+    """
+    per_turn = int(args.message_words * 1.3) + args.completion_tokens + 8
+    return 400 + args.summary_every * per_turn
+
+
+async def run_session(manager: SessionManager, index: int, deadline: float, args, stats: dict):
+    rng = random.Random(args.seed * 100003 + index)
+    user_id = f"load_user_{index % args.users}"
+    chat_id = f"load_chat_{index}"
+    # spread the first requests over one think time
+    await asyncio.sleep(rng.random() * args.think_ms / 1000)
+    while time.perf_counter() < deadline:
+        text = synthetic_message(rng, args.message_words)
+        t0 = time.perf_counter()
+        ttft = None
+        try:
+            async for _ in manager.chat_stream(user_id, chat_id, text):
+                if ttft is None:
+                    ttft = (time.perf_counter() - t0) * 1000
+        except Exception as e:
+            stats["errors"].append(f"{type(e).__name__}: {e}")
+            continue
+        stats["turn_ms"].append((time.perf_counter() - t0) * 1000)
+        if ttft is not None:
+            stats["ttft_ms"].append(ttft)
+        if args.think_ms:
+            await asyncio.sleep(rng.expovariate(1000 / args.think_ms))
+
+
+async def run_level(config: dict, concurrency: int, args) -> dict:
+    bench = Bench(config, args)
+    manager = SessionManager(
+        config,
+        llm=bench.sync_llm,
+        allm=bench.allm,
+        session_database=bench.store,
+        query_understanding=bench.query_understanding,
+    )
+    await manager.start()
+    await asyncio.to_thread(bench.store.prepare)
+
+    stats = {"turn_ms": [], "ttft_ms": [], "errors": []}
+    sampler = Sampler()
+    sampler.start()
+    t0 = time.perf_counter()
+    deadline = t0 + args.duration
+    await asyncio.gather(*(run_session(manager, i, deadline, args, stats) for i in range(concurrency)))
+    elapsed = time.perf_counter() - t0
+    backlog = manager.memory_worker.queue.qsize()
+
+    t1 = time.perf_counter()
+    await manager.memory_worker.drain()
+    drain_s = time.perf_counter() - t1
+    await sampler.stop()
+    await manager.close()
+
+    turns = len(stats["turn_ms"])
+    written = bench.bytes_written()
+    summaries = bench.llm.calls.get("session_summary_content", 0)
+    return {
+        "concurrency": concurrency,
+        "turns": turns,
+        "turns_per_sec": round(turns / elapsed, 3),
+        "turn_ms": percentiles(stats["turn_ms"]),
+        "ttft_ms": percentiles(stats["ttft_ms"]),
+        "errors": len(stats["errors"]),
+        "error_samples": stats["errors"][:3],
+        "summaries_per_turn": round(summaries / turns, 3) if turns else 0,
+        "memory_backlog_at_end": backlog,
+        "memory_drain_s": round(drain_s, 3),
+        "llm_calls_per_turn": round(bench.llm.total_calls / turns, 3) if turns else 0,
+        "embedder_batches": bench.embedder.calls,
+        "embedder_texts_per_batch": round(bench.embedder.texts / bench.embedder.calls, 2) if bench.embedder.calls else 0,
+        "bytes_written_per_turn": round(sum(written.values()) / turns, 1) if turns else 0,
+        "loop_lag_ms": percentiles(sampler.lag_ms),
+        "peak_threads": sampler.threads,
+        "peak_rss_mb": round(sampler.rss_mb, 1),
+        "speculation": manager.speculation_stats.stats(),
+    }
+
+
+def find_saturation(levels: list[dict], min_gain: float, max_p95_factor: float) -> dict | None:
+    """
+        First level whose throughput grew by less than `min_gain` (relative) over the previous level,
+        or whose p95 turn latency exceeds `max_p95_factor` x the lowest level's p95
+    """
+    if not levels:
+        return None
+    base_p95 = levels[0]["turn_ms"].get("p95")
+    for prev, level in zip(levels, levels[1:]):
+        gain = (level["turns_per_sec"] - prev["turns_per_sec"]) / prev["turns_per_sec"] if prev["turns_per_sec"] else 0
+        p95 = level["turn_ms"].get("p95")
+        if gain < min_gain:
+            return {"concurrency": prev["concurrency"], "reason": f"throughput +{gain:.0%} going to {level['concurrency']} sessions"}
+        if base_p95 and p95 and p95 > max_p95_factor * base_p95:
+            return {"concurrency": prev["concurrency"], "reason": f"p95 {p95:.0f} ms > {max_p95_factor}x {base_p95:.0f} ms at {level['concurrency']} sessions"}
+    return None
+
+
+def print_levels(levels: list[dict], saturation: dict | None):
+    print(f"\n{'sessions':>8s} {'turns':>6s} {'turns/s':>8s} {'p50 ms':>8s} {'p95 ms':>8s} {'p99 ms':>8s} "
+          f"{'ttft95':>8s} {'lag95':>7s} {'backlog':>7s} {'threads':>7s} {'rss MB':>7s} {'err':>4s} {'spec hit':>8s}")
+    for lv in levels:
+        t, f, lag = lv["turn_ms"], lv["ttft_ms"], lv["loop_lag_ms"]
+        hit_rate = lv["speculation"]["hit_rate"]
+        print(f"{lv['concurrency']:8d} {lv['turns']:6d} {lv['turns_per_sec']:8.2f} {t.get('p50', 0):8.0f} {t.get('p95', 0):8.0f} "
+              f"{t.get('p99', 0):8.0f} {f.get('p95', 0):8.0f} {lag.get('p95', 0):7.1f} {lv['memory_backlog_at_end']:7d} "
+              f"{lv['peak_threads']:7d} {lv['peak_rss_mb']:7.0f} {lv['errors']:4d} "
+              f"{'-' if hit_rate is None else f'{hit_rate:.0%}':>8s}")
+    if saturation:
+        print(f"\nSaturation at ~{saturation['concurrency']} concurrent sessions ({saturation['reason']}).")
+    else:
+        print("\nNo saturation within the sweep.")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Concurrent synthetic sessions against SessionManager + local fakes")
+    parser.add_argument("--sweep", type=str, default="1,2,4,8,16,32", help="comma-separated session counts")
+    parser.add_argument("--duration", type=float, default=20.0, help="seconds per concurrency level")
+    parser.add_argument("--users", type=int, default=10, help="sessions are spread over this many user_ids")
+    parser.add_argument("--think-ms", type=float, default=1000.0, help="mean pause between a session's turns")
+    parser.add_argument("--message-words", type=int, default=20, help="median words per user message")
+    parser.add_argument("--summary-every", type=int, default=None,
+                        help="aim for one summary every this many turns per session (sets max_context_length)")
+    parser.add_argument("--min-gain", type=float, default=0.1, help="saturation: throughput gain below this")
+    parser.add_argument("--max-p95-factor", type=float, default=3.0, help="saturation: p95 above this x the first level's")
+    parser.add_argument("--json", type=str, default=None)
+    add_fake_args(parser)
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    with open(args.config, "r") as f:
+        base_config = yaml.safe_load(f)
+    if args.summary_every and not args.max_context_length:
+        args.max_context_length = summary_context_length(args)
+
+    levels = []
+    for concurrency in [int(x) for x in args.sweep.split(",") if x.strip()]:
+        workdir = tempfile.mkdtemp(prefix="chatbot-load-")
+        config = bench_config(base_config, workdir, args)
+        # per-turn trace export would dominate the disk writes being measured
+        config["trace_path"] = None
+        try:
+            with quiet(not args.verbose):
+                level = asyncio.run(run_level(config, concurrency, args))
+        finally:
+            if not args.keep:
+                shutil.rmtree(workdir, ignore_errors=True)
+        levels.append(level)
+        print(f"{concurrency} session(s): {level['turns_per_sec']} turns/s, p95 {level['turn_ms'].get('p95')} ms", flush=True)
+
+    saturation = find_saturation(levels, args.min_gain, args.max_p95_factor)
+    print_levels(levels, saturation)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"args": vars(args), "levels": levels, "saturation": saturation}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
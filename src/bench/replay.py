@@ -0,0 +1,281 @@
+# src/bench/replay.py
+"""
+    Offline replay benchmark: runs the user turns of a saved transcript (e.g. chatbot_logs/001.json)
+    through ChatPipeline with the stand-ins of src/bench/fakes.py - no Groq key, no Milvus stack.
+
+        python -m src.bench.replay --config configs/app.yaml --transcript chatbot_logs/001.json --repeat 20
+        python -m src.bench.replay ... --json out.json                 # save the report
+        python -m src.bench.replay ... --baseline out.json             # exit 1 on a regression
+
+    Reports turns/sec, p50/p95/p99 per traced stage, LLM calls per turn, bytes written per turn and the
+    speculative-answer hit rate (--no-speculation for the sequential baseline).
+"""
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import yaml
+
+from src.bench.fakes import FakeAsyncGroq, FakeEmbedder, FakeGroq, FakeLLM, FakeMilvusClient, LLMProfile
+from src.functions.database import Milvus
+from src.functions.query_understanding import QueryUnderstanding
+from src.llm.client import AsyncGroqClient, GroqClient
+from src.pipeline.chat_pipeline import ChatPipeline
+from src.tracing import tracer
+
+
+def load_transcript(path: str) -> list[str]:
+    """
+        User messages of a saved chat (chat_history_path/<chat_id>.json), or of a JSON list of strings
+    """
+    with open(path, "r", encoding="utf-8") as f:
+        data = json.load(f)
+    if isinstance(data, dict):
+        return [m["user"]["content"] for m in data.get("all_messages", [])]
+    return [m if isinstance(m, str) else m["user"]["content"] for m in data]
+
+
+def percentiles(values: list[float]) -> dict:
+    if not values:
+        return {}
+    xs = sorted(values)
+    def pick(q):
+        return round(xs[min(len(xs) - 1, int(q * len(xs)))], 3)
+    return {"n": len(xs), "p50": pick(0.50), "p95": pick(0.95), "p99": pick(0.99), "max": round(xs[-1], 3)}
+
+
+def stage_percentiles(trace_path: str) -> dict:
+    """
+        Exact per-stage percentiles from the JSON-lines trace export; "turn" / "memory_job" are whole traces
+    """
+    samples: dict[str, list[float]] = {}
+    if not os.path.exists(trace_path):
+        return {}
+    with open(trace_path, "r", encoding="utf-8") as f:
+        for line in f:
+            trace = json.loads(line)
+            samples.setdefault(trace["kind"], []).append(trace["wall_ms"])
+            for s in trace.get("spans", []):
+                samples.setdefault(s["stage"], []).append(s["wall_ms"])
+    return {stage: percentiles(v) for stage, v in sorted(samples.items())}
+
+
+@contextlib.contextmanager
+def quiet(enabled: bool = True):
+    # the pipeline prints every analyzed query / summary; keep the report readable
+    if not enabled:
+        yield
+        return
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        yield
+
+
+def bench_config(config: dict, workdir: str, args) -> dict:
+    config = dict(config)
+    config.update(
+        storage_backend="milvus",
+        chat_history_path=os.path.join(workdir, "chatbot_logs") + "/",
+        trace_path=os.path.join(workdir, "traces.jsonl"),
+        embedding_cache_path=None,
+        memory_journal_path=None,
+        sparse_stats_path=os.path.join(workdir, "sparse_stats.json"),
+        reload=False,
+        startup_warmup=False,
+        # the fakes are the only backends; don't pace them
+        groq_requests_per_minute=None,
+        groq_tokens_per_minute=None,
+    )
+    if args.max_context_length:
+        config["max_context_length"] = args.max_context_length
+    if args.no_speculation:
+        config["speculative_answer"] = False
+    return config
+
+
+class Bench:
+    """
+        Fakes + one ChatPipeline wired to them
+    """
+    def __init__(self, config: dict, args):
+        self.config = config
+        self.llm = FakeLLM(LLMProfile(
+            latency_ms=args.llm_latency_ms,
+            latency_sigma=args.llm_latency_sigma,
+            completion_tokens=args.completion_tokens,
+            token_rate=args.token_rate,
+            true_rate=args.ambiguous_rate,
+            seed=args.seed,
+        ))
+        self.milvus_client = FakeMilvusClient(latency_ms=args.milvus_latency_ms)
+        self.embedder = FakeEmbedder(dim=config.get("embedding_dimension", 384), ms_per_text=args.embed_ms_per_text)
+
+        self.store = Milvus(config, client=self.milvus_client)
+        self.allm = AsyncGroqClient(config, client=FakeAsyncGroq(self.llm))
+        self.sync_llm = GroqClient(config, client=FakeGroq(self.llm))
+        self.query_understanding = QueryUnderstanding(self.allm, config, self.store, embedding_model=self.embedder)
+
+    def pipeline(self, user_id: str, chat_id: str, memory_worker=None) -> ChatPipeline:
+        config = dict(self.config, user_id=user_id, chat_id=chat_id)
+        return ChatPipeline(
+            config,
+            llm=self.sync_llm,
+            session_database=self.store,
+            query_understanding=self.query_understanding,
+            allm=self.allm,
+            memory_worker=memory_worker,
+        )
+
+    def bytes_written(self) -> dict:
+        return dict(self.milvus_client.bytes_written)
+
+    async def close(self):
+        await self.query_understanding.embedding_service.close()
+        self.query_understanding.embedding_cache.close()
+        self.store.close()
+        await self.allm.close()
+
+
+async def replay(config: dict, messages: list[str], args) -> dict:
+    bench = Bench(config, args)
+    pipe = bench.pipeline(config.get("user_id", "bench_user"), "replay")
+    turn_ms = []
+
+    t0 = time.perf_counter()
+    for _ in range(args.repeat):
+        for text in messages:
+            t = time.perf_counter()
+            await pipe.chat_turn(text)
+            turn_ms.append((time.perf_counter() - t) * 1000)
+    turns_s = time.perf_counter() - t0
+    llm_calls_turns = dict(bench.llm.calls)
+
+    # background summaries / memory writes belong to the same turns
+    t1 = time.perf_counter()
+    await pipe.memory_worker.drain()
+    await pipe.memory_worker.close()
+    bench.store.flush()
+    drain_s = time.perf_counter() - t1
+    await bench.close()
+
+    turns = len(turn_ms)
+    written = bench.bytes_written()
+    return {
+        "turns": turns,
+        "turns_per_sec": round(turns / turns_s, 3) if turns_s else None,
+        "turn_ms": percentiles(turn_ms),
+        "memory_drain_s": round(drain_s, 3),
+        "summaries": pipe.context_length["lastest_summary_idx"],
+        "llm_calls_per_turn": round(bench.llm.total_calls / turns, 3) if turns else 0,
+        "llm_calls_by_kind": dict(bench.llm.calls),
+        "llm_calls_during_turns": llm_calls_turns,
+        "llm_tokens_per_turn": {
+            "prompt": round(bench.llm.prompt_tokens / turns, 1) if turns else 0,
+            "completion": round(bench.llm.completion_tokens / turns, 1) if turns else 0,
+        },
+        "embedder": {"batches": bench.embedder.calls, "texts": bench.embedder.texts},
+        "bytes_written_per_turn": round(sum(written.values()) / turns, 1) if turns else 0,
+        "bytes_written_by_collection": written,
+        "store_calls": dict(bench.milvus_client.calls),
+        "speculation": pipe.speculation_stats.stats(),
+        "stages_ms": stage_percentiles(config["trace_path"]),
+    }
+
+
+def compare(report: dict, baseline: dict, tolerance: float) -> list[str]:
+    """
+        Regressions beyond `tolerance` (relative) on throughput, turn tail latency, LLM calls and bytes per turn
+    """
+    problems = []
+    def worse(name, new, old, higher_is_better=False):
+        if new is None or not old:
+            return
+        change = (old - new) / old if higher_is_better else (new - old) / old
+        if change > tolerance:
+            problems.append(f"{name}: {old} -> {new} ({change:+.0%})")
+    worse("turns_per_sec", report["turns_per_sec"], baseline.get("turns_per_sec"), higher_is_better=True)
+    for q in ("p95", "p99"):
+        worse(f"turn_ms.{q}", report["turn_ms"].get(q), baseline.get("turn_ms", {}).get(q))
+    worse("llm_calls_per_turn", report["llm_calls_per_turn"], baseline.get("llm_calls_per_turn"))
+    worse("bytes_written_per_turn", report["bytes_written_per_turn"], baseline.get("bytes_written_per_turn"))
+    return problems
+
+
+def print_report(report: dict):
+    print(f"\n{report['turns']} turns  {report['turns_per_sec']} turns/s  "
+          f"turn p50/p95/p99 = {report['turn_ms'].get('p50')}/{report['turn_ms'].get('p95')}/{report['turn_ms'].get('p99')} ms  "
+          f"(memory drain {report['memory_drain_s']} s, {report['summaries']} summaries)")
+    print(f"LLM calls/turn {report['llm_calls_per_turn']}  {report['llm_calls_by_kind']}")
+    print(f"bytes written/turn {report['bytes_written_per_turn']}  {report['bytes_written_by_collection']}")
+    print(f"speculation {report['speculation']}")
+    print(f"\n{'stage':40s} {'n':>6s} {'p50':>10s} {'p95':>10s} {'p99':>10s}")
+    for stage, p in report["stages_ms"].items():
+        print(f"{stage:40s} {p['n']:6d} {p['p50']:10.2f} {p['p95']:10.2f} {p['p99']:10.2f}")
+
+
+def add_fake_args(parser: argparse.ArgumentParser):
+    parser.add_argument("--config", type=str, default="configs/app.yaml")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--llm-latency-ms", type=float, default=300.0, help="median time to first token")
+    parser.add_argument("--llm-latency-sigma", type=float, default=0.3)
+    parser.add_argument("--completion-tokens", type=int, default=200)
+    parser.add_argument("--token-rate", type=float, default=500.0, help="generated tokens per second")
+    parser.add_argument("--ambiguous-rate", type=float, default=0.2)
+    parser.add_argument("--milvus-latency-ms", type=float, default=1.0)
+    parser.add_argument("--embed-ms-per-text", type=float, default=0.5)
+    parser.add_argument("--max-context-length", type=int, default=None, help="override to make summaries more/less frequent")
+    parser.add_argument("--no-speculation", action="store_true", help="wait for query understanding before answering")
+    parser.add_argument("--keep", action="store_true", help="keep the work directory (traces, summaries)")
+    parser.add_argument("--verbose", action="store_true", help="show the pipeline's own output")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Replay a transcript through ChatPipeline against local fakes")
+    parser.add_argument("--transcript", type=str, default="chatbot_logs/001.json")
+    parser.add_argument("--repeat", type=int, default=10, help="replay the transcript this many times")
+    parser.add_argument("--json", type=str, default=None, help="write the report here")
+    parser.add_argument("--baseline", type=str, default=None, help="report of an earlier run to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.15)
+    add_fake_args(parser)
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    with open(args.config, "r") as f:
+        config = yaml.safe_load(f)
+    messages = load_transcript(args.transcript)
+    if not messages:
+        raise SystemExit(f"No user messages in {args.transcript}")
+
+    workdir = tempfile.mkdtemp(prefix="chatbot-bench-")
+    config = bench_config(config, workdir, args)
+    tracer.configure(config)
+    try:
+        with quiet(not args.verbose):
+            report = asyncio.run(replay(config, messages, args))
+    finally:
+        if not args.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+    report["transcript"] = args.transcript
+    print_report(report)
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+    if args.baseline:
+        with open(args.baseline, "r") as f:
+            problems = compare(report, json.load(f), args.tolerance)
+        if problems:
+            print("\nREGRESSIONS:\n  " + "\n  ".join(problems))
+            sys.exit(1)
+        print("\nNo regressions against", args.baseline)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,143 @@
+# src/bench/vectors.py
+"""
+    Recall versus memory of the session-memory vector storage options (vector_storage: float / sq8 / pq / binary),
+    with and without the exact rerank, on the in-process VectorIndex of the local store.
+
+        python -m src.bench.vectors                                    # synthetic clustered vectors
+        python -m src.bench.vectors --vectors chatbot_logs/local_store/session_memory.f32 --queries 200
+        python -m src.bench.vectors --storages sq8,pq --rerank-factors 1,2,4,10 --json vectors.json
+
+    Ground truth is the exact top-k over the float32 vectors; queries are held out from the same set
+    (or drawn from the same clusters). Per option it reports recall@k, resident bytes per vector, index
+    memory and p50 / p95 search latency.
+"""
+import argparse
+import json
+import time
+
+import numpy as np
+
+from src.bench.replay import percentiles
+from src.functions.local_store import VectorIndex
+from src.functions.quantization import make_codec
+
+
+def synthetic_vectors(n: int, dim: int, clusters: int, noise: float, seed: int) -> np.ndarray:
+    # topic clusters, roughly what summaries of a few recurring subjects look like in embedding space
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(size=(clusters, dim))
+    return (centers[rng.integers(0, clusters, n)] + noise * rng.normal(size=(n, dim))).astype(np.float32)
+
+
+def load_vectors(path: str, dim: int) -> np.ndarray:
+    raw = np.fromfile(path, dtype=np.float32)
+    return raw[: len(raw) // dim * dim].reshape(-1, dim)
+
+
+def exact_top_k(base: np.ndarray, queries: np.ndarray, k: int, metric: str) -> np.ndarray:
+    index = VectorIndex(base.shape[1], metric=metric, ivf_min_rows=len(base) + 1)
+    for v in base:
+        index.add(v)
+    return np.stack([index.search(q, k)[0] for q in queries])
+
+
+def run_option(base: np.ndarray, queries: np.ndarray, truth: np.ndarray, storage: str, rerank_factor: int, args) -> dict:
+    codec = make_codec(storage, base.shape[1], pq_m=args.pq_m)
+    t0 = time.perf_counter()
+    index = VectorIndex(
+        base.shape[1],
+        metric=args.metric,
+        nlist=args.nlist,
+        nprobe=args.nprobe,
+        ivf_min_rows=args.ivf_min_rows,
+        codec=codec,
+        quant_min_rows=len(base),
+        rerank_factor=rerank_factor,
+        # the local store reads these from session_memory.f32
+        full_vectors=(lambda rows: base[rows]) if rerank_factor > 1 else None,
+    )
+    for v in base:
+        index.add(v)
+    index._maybe_train()
+    build_s = time.perf_counter() - t0
+
+    hits, latencies = 0, []
+    for q, expected in zip(queries, truth):
+        t = time.perf_counter()
+        rows, _ = index.search(q, args.k)
+        latencies.append((time.perf_counter() - t) * 1000)
+        hits += len(set(rows.tolist()) & set(expected.tolist()))
+    search_ms = percentiles(latencies)
+    return {
+        "storage": storage,
+        "rerank_factor": rerank_factor,
+        f"recall@{args.k}": round(hits / (len(queries) * args.k), 4),
+        "bytes_per_vector": index.bytes_per_vector(),
+        "index_mb": round(index.memory_bytes() / 2**20, 2),
+        "build_s": round(build_s, 3),
+        "search_ms_p50": search_ms.get("p50"),
+        "search_ms_p95": search_ms.get("p95"),
+    }
+
+
+def print_table(rows: list[dict], k: int):
+    print(f"\n{'storage':8s} {'rerank':>6s} {'recall@' + str(k):>9s} {'B/vector':>9s} {'index MB':>9s} "
+          f"{'build s':>8s} {'p50 ms':>7s} {'p95 ms':>7s}")
+    for r in rows:
+        rerank = f"x{r['rerank_factor']}" if r["rerank_factor"] > 1 else "-"
+        print(f"{r['storage']:8s} {rerank:>6s} {r[f'recall@{k}']:9.3f} {r['bytes_per_vector']:9d} {r['index_mb']:9.2f} "
+              f"{r['build_s']:8.2f} {r['search_ms_p50']:7.2f} {r['search_ms_p95']:7.2f}")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Recall vs memory of float / sq8 / pq / binary vector storage")
+    parser.add_argument("--vectors", type=str, default=None, help="raw float32 file (e.g. the local store's session_memory.f32)")
+    parser.add_argument("--dim", type=int, default=384)
+    parser.add_argument("--n", type=int, default=20000, help="synthetic vectors")
+    parser.add_argument("--clusters", type=int, default=200)
+    parser.add_argument("--noise", type=float, default=0.6)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=5)
+    parser.add_argument("--metric", type=str, default="COSINE")
+    parser.add_argument("--storages", type=str, default="float,sq8,pq,binary")
+    parser.add_argument("--rerank-factors", type=str, default="1,4", help="1 = no rerank")
+    parser.add_argument("--pq-m", type=int, default=48)
+    parser.add_argument("--nlist", type=int, default=128)
+    parser.add_argument("--nprobe", type=int, default=10)
+    parser.add_argument("--ivf-min-rows", type=int, default=20000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", type=str, default=None)
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    if args.vectors:
+        vectors = load_vectors(args.vectors, args.dim)
+    else:
+        vectors = synthetic_vectors(args.n + args.queries, args.dim, args.clusters, args.noise, args.seed)
+    if len(vectors) <= args.queries:
+        raise SystemExit(f"Need more than {args.queries} vectors, got {len(vectors)}")
+    rng = np.random.default_rng(args.seed)
+    order = rng.permutation(len(vectors))
+    queries, base = vectors[order[: args.queries]], vectors[order[args.queries:]]
+    print(f"{len(base)} vectors x {base.shape[1]} dims, {len(queries)} queries, {args.metric}", flush=True)
+
+    truth = exact_top_k(base, queries, args.k, args.metric)
+    rows = []
+    for storage in [s.strip() for s in args.storages.split(",") if s.strip()]:
+        # float storage is exact already: a rerank would rescore the same numbers
+        factors = [1] if storage == "float" else [int(f) for f in args.rerank_factors.split(",") if f.strip()]
+        for factor in factors:
+            row = run_option(base, queries, truth, storage, factor, args)
+            rows.append(row)
+            print(f"{storage} rerank x{factor}: recall@{args.k} {row[f'recall@{args.k}']}", flush=True)
+
+    print_table(rows, args.k)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"args": vars(args), "n_vectors": len(base), "results": rows}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
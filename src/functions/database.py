@@ -1,5 +1,11 @@
+import atexit
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
-from pymilvus import MilvusClient, DataType, Collection , connections
+from src.tracing import span
+from src.functions.memory_store import MemoryStore, SearchHit
+from src.functions.quantization import exact_scores, from_f16_b64, make_codec, pack_sign_bits, to_f16_b64
+from src.functions.sparse_encoder import SparseEncoder
 
 MAX_USER_ID_LENGTH = 512
 MAX_CHAT_ID_LENGTH = 512
@@ -11,17 +17,252 @@ MAX_CONTENT_LENGTH = 4096
 MAX_WINDOW_JSON_LENGTH = 16384
 MAX_PK_LENGTH = 1024
 
-class Milvus:
-    def __init__(self, config):
+SESSION_OUTPUT_FIELDS = ["user_id", "chat_id", "session_content", "full_session_json"]
+
+# VARCHAR limits (bytes) of the buffered collections, checked before a row is buffered
+CHAT_LOGS_LIMITS = {
+    "pk": MAX_PK_LENGTH, "user_id": MAX_USER_ID_LENGTH, "chat_id": MAX_CHAT_ID_LENGTH,
+    "role": MAX_ROLE_LENGTH, "content": MAX_CONTENT_LENGTH,
+}
+CONTEXT_WINDOW_LIMITS = {
+    "pk": MAX_PK_LENGTH, "user_id": MAX_USER_ID_LENGTH, "chat_id": MAX_CHAT_ID_LENGTH,
+    "window_json": MAX_WINDOW_JSON_LENGTH, "latest_summary_json": MAX_SESSION_JSON_LENGTH,
+}
+SESSION_MEMORY_LIMITS = {
+    "pk": MAX_USER_ID_LENGTH + MAX_CHAT_ID_LENGTH + 20, "user_id": MAX_USER_ID_LENGTH, "chat_id": MAX_CHAT_ID_LENGTH,
+    "session_content": MAX_MESSAGE_LENGTH, "full_session_json": MAX_SESSION_JSON_LENGTH,
+}
+# JSON columns can't be cut: an oversized value is replaced by this. Summaries are bounded before they get
+# here (session_summary.bound_summary), so for them this is only a last resort
+JSON_FALLBACKS = {"window_json": "[]", "latest_summary_json": "{}", "full_session_json": "{}"}
+
+
+def fit_row(row: dict, limits: dict) -> dict:
+    """
+        Copy of `row` whose VARCHAR fields fit their max_length: text is cut at a UTF-8 boundary,
+        JSON is replaced by an empty value
+    """
+    out = row
+    for field, limit in limits.items():
+        value = row.get(field)
+        if not isinstance(value, str) or len(value) <= limit // 4:
+            continue
+        raw = value.encode("utf-8")
+        if len(raw) <= limit:
+            continue
+        if out is row:
+            out = dict(row)
+        if field in JSON_FALLBACKS:
+            print(f"[WARN] '{row.get('pk')}': {field} is {len(raw)} bytes (max {limit}); not stored", flush=True)
+            out[field] = JSON_FALLBACKS[field]
+        else:
+            out[field] = raw[:limit].decode("utf-8", errors="ignore")
+    return out
+
+
+class WriteBehindBuffer:
+    """
+        Collects small per-turn rows (chat logs, context-window state) across turns and sessions and
+        writes them with one bulk insert/upsert per collection, when `max_rows` are pending or every
+        `flush_interval` seconds, on a background thread.
+        Rows waiting here (or being flushed) stay visible through get_pending / pending_rows.
+        A failed bulk write is retried row by row; a row still failing after `max_attempts` flushes
+        is dropped (and logged) so it cannot block everything buffered behind it. Retries are upserts:
+        a failed bulk insert may have applied part of its rows, and insert does not dedupe primary keys.
+    """
+    def __init__(self, database, max_rows: int = 256, flush_interval: float = 1.0, max_attempts: int = 3):
+        self.database = database
+        self.max_rows = max_rows
+        self.flush_interval = flush_interval
+        self.max_attempts = max_attempts
+        # (collection_name, pk) -> failed flushes so far
+        self.attempts: dict[tuple[str, str], int] = {}
+
+        # (collection_name, "insert" | "upsert") -> {pk: row}; later rows with the same pk replace earlier ones
+        self.pending: dict[tuple[str, str], dict[str, dict]] = {}
+        self.inflight: dict[tuple[str, str], dict[str, dict]] = {}
+        self.num_pending = 0
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stopped = False
+        self._thread = threading.Thread(target=self._loop, name="milvus-write-behind", daemon=True)
+        self._thread.start()
+
+    def add(self, collection_name: str, row: dict, op: str = "insert"):
+        with self._lock:
+            rows = self.pending.setdefault((collection_name, op), {})
+            if row["pk"] not in rows:
+                self.num_pending += 1
+            rows[row["pk"]] = row
+            full = self.num_pending >= self.max_rows
+        if full:
+            self._wake.set()
+
+    def _loop(self):
+        while not self._stopped:
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"[WARN] write-behind flush failed: {e}", flush=True)
+
+    def flush(self):
+        with self._flush_lock:
+            with self._lock:
+                if not self.pending:
+                    return
+                batch, self.pending, self.num_pending = self.pending, {}, 0
+                self.inflight = batch
+
+            failed = {}
+            for (collection_name, op), rows in batch.items():
+                data = list(rows.values())
+                try:
+                    self._write(collection_name, op, data)
+                except Exception as e:
+                    print(f"[WARN] write-behind {op} of {len(data)} row(s) into '{collection_name}' failed: {e}; "
+                          f"retrying row by row", flush=True)
+                    bad = self._write_rows(collection_name, rows)
+                    if bad:
+                        failed[collection_name] = bad
+
+            with self._lock:
+                # put failed rows back (as upserts) unless a newer version of the same pk arrived meanwhile
+                for collection_name, rows in failed.items():
+                    newer = [self.pending.get((collection_name, op), {}) for op in ("insert", "upsert")]
+                    retry = self.pending.setdefault((collection_name, "upsert"), {})
+                    for pk, row in rows.items():
+                        if not any(pk in n for n in newer):
+                            retry[pk] = row
+                            self.num_pending += 1
+                self.inflight = {}
+
+    def _write(self, collection_name: str, op: str, data: list):
+        if op == "upsert":
+            self.database.upsert(collection_name=collection_name, data=data)
+        else:
+            self.database.insert(collection_name=collection_name, data=data)
+
+    def _write_rows(self, collection_name: str, rows: dict[str, dict]) -> dict[str, dict]:
+        """
+            One upsert per row; returns the rows to retry on the next flush (the ones below max_attempts)
+        """
+        retry = {}
+        for pk, row in rows.items():
+            key = (collection_name, pk)
+            try:
+                self._write(collection_name, "upsert", [row])
+                self.attempts.pop(key, None)
+                continue
+            except Exception as e:
+                error = e
+            n = self.attempts.get(key, 0) + 1
+            if n >= self.max_attempts:
+                self.attempts.pop(key, None)
+                print(f"[ERROR] write-behind dropped '{pk}' of '{collection_name}' after {n} attempt(s): {error}", flush=True)
+            else:
+                self.attempts[key] = n
+                retry[pk] = row
+        return retry
+
+    def get_pending(self, collection_name: str, pk: str) -> dict | None:
+        with self._lock:
+            for source in (self.pending, self.inflight):
+                for op in ("upsert", "insert"):
+                    row = source.get((collection_name, op), {}).get(pk)
+                    if row is not None:
+                        return row
+        return None
+
+    def pending_rows(self, collection_name: str) -> list[dict]:
+        with self._lock:
+            merged = {}
+            for source in (self.inflight, self.pending):
+                for op in ("insert", "upsert"):
+                    merged.update(source.get((collection_name, op), {}))
+            return list(merged.values())
+
+    def close(self):
+        self._stopped = True
+        self._wake.set()
+        self._thread.join(timeout=5)
+        self.flush()
+
+
+class Milvus(MemoryStore):
+    """
+        Connecting, the database / collection checks and loading collections happen once, in
+        prepare() - called by the startup warmup or else by the first read/write.
+        pymilvus itself is only imported then.
+    """
+    def __init__(self, config, client=None):
         self.config = config
-        self.client = MilvusClient(uri=config['uri'])
-        self.database = self.create_database(config["db_name"])
+        self._client = client
+        self._client_lock = threading.Lock()
+        self._prepare_lock = threading.Lock()
+        self._prepared = False
+        self._loaded: set[str] = set()
 
-        self.create_session_memory_collection()
-        self.create_chat_logs_collection()
-        self.create_context_window_collection()
+        # BM25 sparse vectors for hybrid retrieval; collections created before it have no "sparse" field
+        self.sparse_encoder = None
+        self._session_has_sparse = False
+        if config.get("hybrid_search", True):
+            self.sparse_encoder = SparseEncoder.from_config(config, config.get("chat_history_path", "chatbot_logs/"))
+        # float / sq8 / pq / binary "embedding" (src/functions/quantization.py); an existing collection keeps its own type
+        self.vector_storage = (config.get("vector_storage") or "float").lower()
+        # only to reject an unknown vector_storage / a pq_m that does not divide the dimension early
+        make_codec(self.vector_storage, config.get("embedding_dimension", 384), pq_m=config.get("pq_m", 48))
+        self.rerank_factor = config.get("rerank_factor", 4) if config.get("vector_rerank", True) else 1
+        # dense + sparse searches of one query run side by side
+        self._search_pool = ThreadPoolExecutor(max_workers=config.get("search_threads", 8), thread_name_prefix="milvus-search")
 
-    
+        self.write_buffer = None
+        if config.get("write_behind", True):
+            self.write_buffer = WriteBehindBuffer(
+                self,
+                max_rows=config.get("write_behind_max_rows", 256),
+                flush_interval=config.get("write_behind_flush_interval", 1.0),
+                max_attempts=config.get("write_behind_max_attempts", 3),
+            )
+        # flush whatever is still buffered (and the sparse stats) on interpreter shutdown
+        atexit.register(self.close)
+
+    @property
+    def client(self):
+        if self._client is None:
+            with self._client_lock:
+                if self._client is None:
+                    from pymilvus import MilvusClient
+                    self._client = MilvusClient(uri=self.config['uri'])
+        return self._client
+
+    def prepare(self):
+        """
+            Create/check the database and the three collections (concurrently) and load them
+        """
+        if self._prepared:
+            return
+        with self._prepare_lock:
+            if self._prepared:
+                return
+            with span("milvus.prepare"):
+                self.create_database(self.config["db_name"])
+                names = [
+                    self.config["session_collection_name"],
+                    self.config["chat_logs_collection_name"],
+                    self.config["context_window_collection_name"],
+                ]
+                creates = [
+                    self.create_session_memory_collection,
+                    self.create_chat_logs_collection,
+                    self.create_context_window_collection,
+                ]
+                with ThreadPoolExecutor(max_workers=len(names), thread_name_prefix="milvus-prepare") as pool:
+                    list(pool.map(lambda f: f(), creates))
+                    list(pool.map(self.ensure_loaded, names))
+            self._prepared = True
 
     def create_database(self, database_name):
         if database_name not in self.client.list_databases():
@@ -32,67 +273,283 @@ class Milvus:
     
     def ensure_loaded(self, collection_name: str):
         # Milvus cần load collection trước khi query/get/search
+        if collection_name in self._loaded:
+            return
         try:
             self.client.load_collection(collection_name=collection_name)
         except Exception:
             # nếu version milvus_client không có load_collection, fallback ORM
+            from pymilvus import Collection, connections
             connections.connect(alias="default", host="localhost", port="19530")
             Collection(collection_name).load()
+        self._loaded.add(collection_name)
 
 
-    def retrieve_relevant_session_memory(self, query_embedding: list, top_k: int =5):
-        search_params = {
-            "metric_type": self.config['metric_type'],
-            "params": {"nprobe": self.config['nprobe']}
-        }
-        results = self.client.search(
-            collection_name=self.config['session_collection_name'],
-            data=query_embedding,
-            limit=top_k,
-            search_params=search_params,
-            output_fields=["user_id", "chat_id", "session_content", "full_session_json"]
-        )
+    @staticmethod
+    def quote(value: str) -> str:
+        """
+            Quote a string literal for a Milvus boolean expression
+        """
+        return '"' + str(value).replace("\\", "\\\\").replace('"', '\\"') + '"'
+
+    def session_memory_filter(self, user_id: str | None = None, chat_id: str | None = None, scope: str | None = None) -> str:
+        """
+            scope: "chat" (this chat only), "user" (all chats of this user) or "global" (no filter)
+        """
+        scope = self.search_scope(scope)
+        if scope == "global" or user_id is None:
+            return ""
+        expr = f"user_id == {self.quote(user_id)}"
+        if scope == "chat" and chat_id is not None:
+            expr += f" and chat_id == {self.quote(chat_id)}"
+        return expr
+
+    def retrieve_relevant_session_memory(self, query_embedding: list, top_k: int =5,
+                                         user_id: str | None = None, chat_id: str | None = None, scope: str | None = None,
+                                         query_text: str | None = None):
+        self.prepare()
+        # user_id is the partition key -> a user_id filter only touches that user's partition
+        expr = self.session_memory_filter(user_id, chat_id, scope)
+        if not (self.use_hybrid(query_embedding, query_text) and self._session_has_sparse):
+            return self._search_dense(query_embedding, top_k, expr, scope)
+
+        sparse_query = self.sparse_encoder.encode_query(query_text)
+        limit = self.hybrid_candidates(top_k)
+        with span("milvus.hybrid_search", collection=self.config['session_collection_name'], scope=self.search_scope(scope)) as attrs:
+            dense = self._search_pool.submit(self._search_dense, query_embedding, limit, expr, scope)
+            sparse = self._search_pool.submit(self._search_sparse, sparse_query, limit, expr) if sparse_query else None
+            dense_hits = dense.result()[0]
+            sparse_hits = sparse.result()[0] if sparse is not None else []
+            hits = self.fuse_rrf(dense_hits, sparse_hits, top_k)
+            attrs.update(dense_hits=len(dense_hits), sparse_hits=len(sparse_hits), hits=len(hits))
+        return [hits]
+
+    def _search_dense(self, query_embedding, limit: int, expr: str, scope: str | None = None):
+        metric = self.config['metric_type']
+        data = query_embedding
+        if self.vector_storage == "binary":
+            metric = "HAMMING"
+            data = [pack_sign_bits(q) for q in np.asarray(query_embedding, dtype=np.float32).reshape(-1, self.config['embedding_dimension'])]
+        # compressed storage: fetch rerank_factor x more candidates together with their stored full vectors
+        rerank = self.vector_storage != "float" and self.rerank_factor > 1
+        full_field = "embedding_f16" if self.vector_storage == "binary" else "embedding"
+        with span("milvus.search", collection=self.config['session_collection_name'], scope=self.search_scope(scope),
+                  storage=self.vector_storage, rerank=rerank) as attrs:
+            results = self.client.search(
+                collection_name=self.config['session_collection_name'],
+                data=data,
+                anns_field="embedding",
+                filter=expr,
+                limit=limit * self.rerank_factor if rerank else limit,
+                search_params={"metric_type": metric, "params": {"nprobe": self.config['nprobe']}},
+                output_fields=SESSION_OUTPUT_FIELDS + [full_field] if rerank else SESSION_OUTPUT_FIELDS
+            )
+            if rerank:
+                results = [self._rerank(hits, q, limit, full_field) for hits, q in zip(results, query_embedding)]
+            attrs["hits"] = len(results[0]) if results else 0
+        return results
+
+    def _rerank(self, hits, query, limit: int, full_field: str) -> list:
+        """
+            Re-sort the candidates of one query by the exact metric on their stored full vectors
+        """
+        if not hits:
+            return []
+        metric = self.config['metric_type']
+        vectors = np.asarray([
+            from_f16_b64(h["entity"][full_field]) if full_field == "embedding_f16" else h["entity"][full_field]
+            for h in hits
+        ], dtype=np.float32)
+        scores = exact_scores(vectors, query, metric)
+        order = np.argsort(scores if metric == "L2" else -scores)[:limit]
+        return [
+            SearchHit(id=hits[i]["id"], distance=float(scores[i]),
+                      entity={k: v for k, v in hits[i]["entity"].items() if k != full_field})
+            for i in order.tolist()
+        ]
+
+    def _search_sparse(self, sparse_query: dict, limit: int, expr: str):
+        with span("milvus.sparse_search", collection=self.config['session_collection_name']) as attrs:
+            results = self.client.search(
+                collection_name=self.config['session_collection_name'],
+                data=[sparse_query],
+                anns_field="sparse",
+                filter=expr,
+                limit=limit,
+                search_params={"metric_type": "IP", "params": {"drop_ratio_search": 0.0}},
+                output_fields=SESSION_OUTPUT_FIELDS
+            )
+            attrs["hits"] = len(results[0]) if results else 0
         return results
 
     def make_pk(self, user_id: str, chat_id: str, session_id: int) -> str:
         return f"{user_id}::{chat_id}::{session_id}"
 
+    def insert_session_memory(self, row: dict):
+        self.prepare()
+        row = fit_row(row, SESSION_MEMORY_LIMITS)
+        if "sparse" in row and not self._session_has_sparse:
+            row = {k: v for k, v in row.items() if k != "sparse"}
+        if self.vector_storage == "binary":
+            # sign bits for the HAMMING index, float16 copy for the rerank
+            row = dict(row, embedding=pack_sign_bits(row["embedding"]), embedding_f16=to_f16_b64(row["embedding"]))
+        result = self.insert(self.config["session_collection_name"], row)
+        # the row's document stats were added when it was encoded
+        self.save_sparse_stats(force=False)
+        return result
+
+    def list_session_memory(self, user_id: str, chat_id: str) -> list[dict]:
+        self.prepare()
+        rows = self.client.query(
+            collection_name=self.config["session_collection_name"],
+            filter=f"user_id == {self.quote(user_id)} and chat_id == {self.quote(chat_id)}",
+            output_fields=["pk", "session_id", "full_session_json", "level", "first_summary_idx", "last_summary_idx"],
+        )
+        return [self.memory_meta(r) for r in rows]
+
+    def delete_session_memory(self, pks: list[str]):
+        if not pks:
+            return
+        name = self.config["session_collection_name"]
+        if self.sparse_encoder is not None and self._session_has_sparse:
+            self.prepare()
+            pk_list = ", ".join(self.quote(pk) for pk in pks)
+            for r in self.client.query(collection_name=name, filter=f"pk in [{pk_list}]", output_fields=["sparse"]):
+                self.sparse_encoder.forget(r.get("sparse"))
+        result = self.delete(name, ids=pks)
+        self.save_sparse_stats(force=False)
+        return result
+
+    def insert_chat_log(self, row: dict):
+        # write-behind: batched with other turns/sessions, flushed in the background
+        return self.buffered_insert(self.config["chat_logs_collection_name"], fit_row(row, CHAT_LOGS_LIMITS))
+
+    def load_chat_logs(self, user_id: str, chat_id: str, limit: int = 200,
+                       start_idx: int | None = None, end_idx: int | None = None) -> list[dict]:
+        self.prepare()
+        name = self.config["chat_logs_collection_name"]
+        expr = f"user_id == {self.quote(user_id)} and chat_id == {self.quote(chat_id)}"
+        if start_idx is not None:
+            expr += f" and idx >= {int(start_idx)}"
+        if end_idx is not None:
+            expr += f" and idx <= {int(end_idx)}"
+        rows = self.client.query(
+            collection_name=name,
+            filter=expr,
+            output_fields=["idx", "role", "content", "created_at"],
+            limit=limit,
+        )
+        # read-your-writes: merge rows still waiting in the write-behind buffer
+        seen = {(r["idx"], r["role"]) for r in rows}
+        for r in self.pending_rows(name):
+            if r["user_id"] != user_id or r["chat_id"] != chat_id or (r["idx"], r["role"]) in seen:
+                continue
+            if (start_idx is None or r["idx"] >= start_idx) and (end_idx is None or r["idx"] <= end_idx):
+                rows.append({k: r[k] for k in ("idx", "role", "content", "created_at")})
+
+        # sort by idx just in case
+        rows.sort(key=lambda r: r["idx"])
+        return rows
+
+    def save_context_window(self, row: dict):
+        # upsert (one row per chat) instead of re-inserting the same pk every turn
+        self.buffered_upsert(self.config["context_window_collection_name"], fit_row(row, CONTEXT_WINDOW_LIMITS))
+
+    def load_context_window_rows(self, pks: list[str]) -> dict[str, dict]:
+        name = self.config["context_window_collection_name"]
+        rows = {}
+        missing = []
+        for pk in pks:
+            pending = self.get_pending(name, pk)
+            if pending:
+                rows[pk] = pending
+            else:
+                missing.append(pk)
+        if missing:
+            self.prepare()
+            pk_list = ", ".join(self.quote(pk) for pk in missing)
+            for r in self.client.query(
+                collection_name=name,
+                filter=f"pk in [{pk_list}]",
+                output_fields=["*"],
+            ):
+                rows[r["pk"]] = r
+        return rows
+
     def create_session_memory_collection(self):
+        from pymilvus import MilvusClient, DataType
         if self.client.has_collection(self.config["session_collection_name"]):
             print(f"Collection '{self.config['session_collection_name']}' already exists.")
+            fields = self.client.describe_collection(self.config["session_collection_name"]).get("fields", [])
+            self._session_has_sparse = any(f.get("name") == "sparse" for f in fields)
+            if self.sparse_encoder is not None and not self._session_has_sparse:
+                print(f"[WARN] '{self.config['session_collection_name']}' has no sparse field: hybrid search is off "
+                      f"until the collection is recreated.", flush=True)
+            # the stored vector type wins over vector_storage
+            binary = any(f.get("name") == "embedding" and f.get("type") == DataType.BINARY_VECTOR for f in fields)
+            if binary != (self.vector_storage == "binary"):
+                storage = "binary" if binary else "float"
+                print(f"[WARN] '{self.config['session_collection_name']}' stores {storage} vectors, not "
+                      f"vector_storage={self.vector_storage}: using {storage} until the collection is recreated.", flush=True)
+                self.vector_storage = storage
             return
         # 1) Schema
 
         schema = MilvusClient.create_schema(auto_id=False, enable_dynamic_field=True)
         schema.add_field("pk", DataType.VARCHAR, max_length=MAX_USER_ID_LENGTH + MAX_CHAT_ID_LENGTH + 20, is_primary=True)
-        schema.add_field("user_id", DataType.VARCHAR, max_length=MAX_USER_ID_LENGTH)
+        # partition key: rows are hashed into partitions by user_id, so user-scoped searches only scan one
+        schema.add_field("user_id", DataType.VARCHAR, max_length=MAX_USER_ID_LENGTH, is_partition_key=True)
         schema.add_field("chat_id", DataType.VARCHAR, max_length=MAX_CHAT_ID_LENGTH)
         schema.add_field("session_id", DataType.INT64)
         schema.add_field("session_content", DataType.VARCHAR, max_length=MAX_MESSAGE_LENGTH)
         schema.add_field("full_session_json", DataType.VARCHAR, max_length=MAX_SESSION_JSON_LENGTH)
         
         # vector field
-        schema.add_field("embedding", DataType.FLOAT_VECTOR, dim=self.config['embedding_dimension'])
+        dim = self.config['embedding_dimension']
+        if self.vector_storage == "binary":
+            # 1 bit per dimension; the full vector is kept as base64 float16 text for the exact rerank
+            schema.add_field("embedding", DataType.BINARY_VECTOR, dim=dim)
+            # memory-mapped: it is only read for the few rerank candidates, so it need not be resident
+            schema.add_field("embedding_f16", DataType.VARCHAR, max_length=4 * ((2 * dim + 2) // 3), mmap_enabled=True)
+        else:
+            schema.add_field("embedding", DataType.FLOAT_VECTOR, dim=dim)
+        # BM25 term weights of the summary (src/functions/sparse_encoder.py), for hybrid search
+        schema.add_field("sparse", DataType.SPARSE_FLOAT_VECTOR)
         # 2) index 
         index_params = MilvusClient.prepare_index_params()
-        index_params.add_index(
-            field_name="embedding",
-            index_type=self.config['index_type'],
-            metric_type=self.config['metric_type'],
-            params={"nlist": self.config['nlist']}
-        )
+        index_params.add_index(field_name="embedding", **self.vector_index_params())
+        index_params.add_index(field_name="chat_id", index_type="INVERTED")
+        index_params.add_index(field_name="sparse", index_type="SPARSE_INVERTED_INDEX", metric_type="IP")
 
 
         self.client.create_collection(
             collection_name=self.config["session_collection_name"],
             schema=schema,
             index_params=index_params,
+            num_partitions=self.config.get("session_num_partitions", 64),
         )
+        self._session_has_sparse = True
         print(f"Collection '{self.config['session_collection_name']}' created.")
     
+    def vector_index_params(self) -> dict:
+        """
+            Index of the "embedding" field for vector_storage:
+                float -> index_type (IVF_FLAT), sq8 -> IVF_SQ8, pq -> IVF_PQ (pq_m x 8 bits), binary -> BIN_IVF_FLAT / HAMMING
+        """
+        params = {"nlist": self.config['nlist']}
+        if self.vector_storage == "sq8":
+            return {"index_type": "IVF_SQ8", "metric_type": self.config['metric_type'], "params": params}
+        if self.vector_storage == "pq":
+            params.update(m=self.config.get("pq_m", 48), nbits=8)
+            return {"index_type": "IVF_PQ", "metric_type": self.config['metric_type'], "params": params}
+        if self.vector_storage == "binary":
+            return {"index_type": "BIN_IVF_FLAT", "metric_type": "HAMMING", "params": params}
+        return {"index_type": self.config['index_type'], "metric_type": self.config['metric_type'], "params": params}
+
     # create collection to save current message window 
 
     def create_context_window_collection(self):
+        from pymilvus import MilvusClient, DataType
         name = self.config["context_window_collection_name"]
         if self.client.has_collection(name):
             print(f"Collection '{name}' already exists.")
@@ -124,6 +581,7 @@ class Milvus:
 
     # create collection to save all chat logs
     def create_chat_logs_collection(self):
+        from pymilvus import MilvusClient, DataType
         name = self.config["chat_logs_collection_name"]
         if self.client.has_collection(name):
             print(f"Collection '{name}' already exists.")
@@ -159,17 +617,62 @@ class Milvus:
         """
             Chèn dữ liệu vào collection
         """
-        return self.client.insert(
-            collection_name=collection_name,
-            data=data
-        )
-    def delete(self, collection_name, ids: list):
+        self.prepare()
+        with span("milvus.insert", collection=collection_name):
+            return self.client.insert(
+                collection_name=collection_name,
+                data=data
+            )
+    def upsert(self, collection_name, data):
+        """
+            Insert or replace rows by primary key
+        """
+        self.prepare()
+        with span("milvus.upsert", collection=collection_name):
+            return self.client.upsert(
+                collection_name=collection_name,
+                data=data
+            )
+
+    def buffered_insert(self, collection_name, row: dict):
+        if self.write_buffer is None:
+            return self.insert(collection_name, row)
+        self.write_buffer.add(collection_name, row, op="insert")
+
+    def buffered_upsert(self, collection_name, row: dict):
+        if self.write_buffer is None:
+            return self.upsert(collection_name, row)
+        self.write_buffer.add(collection_name, row, op="upsert")
+
+    def get_pending(self, collection_name: str, pk: str) -> dict | None:
+        return self.write_buffer.get_pending(collection_name, pk) if self.write_buffer else None
+
+    def pending_rows(self, collection_name: str) -> list[dict]:
+        return self.write_buffer.pending_rows(collection_name) if self.write_buffer else []
+
+    def flush(self):
+        if self.write_buffer is not None:
+            self.write_buffer.flush()
+        self.save_sparse_stats()
+
+    def close(self):
+        if self.write_buffer is not None:
+            self.write_buffer.close()
+            self.write_buffer = None
+        self.save_sparse_stats()
+
+    def delete(self, collection_name, ids: list | None = None, filter: str | None = None):
         """
-        Delete items by their IDs.
+        Delete items by their IDs or by a filter expression.
         """
-        collection_name = self.config["schema_config"]["collection_name"]
+        if ids is None and not filter:
+            raise ValueError("delete() needs ids or a filter expression")
+        self.prepare()
         try:
-            return self.client.delete(collection_name=collection_name, ids=ids)
+            with span("milvus.delete", collection=collection_name):
+                if ids is not None:
+                    return self.client.delete(collection_name=collection_name, ids=ids)
+                return self.client.delete(collection_name=collection_name, filter=filter)
         except Exception:
             print("Delete failed.")
             raise
@@ -178,6 +681,7 @@ class Milvus:
         coll = self.config["collection_name"]
         try:
             if self.client.has_collection(coll):
+                from pymilvus import Collection, connections
                 connections.connect(alias="default", host="localhost", port="19530")
                 collection = Collection(name=coll)
                 return collection.num_entities
@@ -0,0 +1,183 @@
+# src/functions/embedding_cache.py
+import hashlib
+import json
+import os
+import threading
+import unicodedata
+from collections import OrderedDict
+
+import numpy as np
+
+# sentence-transformers models whose tokenizer lower-cases its input (do_lower_case)
+UNCASED_MODELS = (
+    "all-MiniLM-L6-v2", "all-MiniLM-L12-v2", "paraphrase-MiniLM-L6-v2", "paraphrase-MiniLM-L3-v2",
+    "multi-qa-MiniLM-L6-cos-v1", "all-mpnet-base-v2", "multi-qa-mpnet-base-dot-v1",
+)
+
+
+class EmbeddingCache:
+    """
+        Embedding cache keyed by sha1(model name + normalized text). Normalizing collapses whitespace and,
+        for uncased models only (`lowercase`, default: a known UNCASED_MODELS name), lower-cases.
+        Returned vectors are read-only: they are the cached entries themselves.
+        - in-memory LRU bounded by `max_entries`
+        - optional on-disk store: a memory-mapped float32 matrix (`<path>.f32`) used as a ring
+          of `disk_capacity` rows, the sha1 key of every row (`<path>.keys`, checked on each read)
+          and a small JSON header (`<path>.index.json`), so it survives restarts
+    """
+    def __init__(self, model_name: str, dim: int, max_entries: int = 10000,
+                 disk_path: str | None = None, disk_capacity: int = 100000, flush_every: int = 64,
+                 lowercase: bool | None = None):
+        self.model_name = model_name
+        if lowercase is None:
+            lowercase = any(name in model_name for name in UNCASED_MODELS)
+        self.lowercase = lowercase
+        self.dim = dim
+        self.max_entries = max_entries
+        self.lru: OrderedDict[str, np.ndarray] = OrderedDict()
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+        self.disk_path = disk_path
+        self.disk_capacity = disk_capacity
+        self.flush_every = flush_every
+        self._dirty = 0
+        self._mm = None
+        self._keys = None                    # (capacity, 20) uint8: sha1 digest per row, zeros = empty
+        self._rows: dict[str, int] = {}
+        self._row_keys: list[str | None] = []
+        self._next_row = 0
+        if disk_path:
+            self._open_disk()
+
+    def normalize(self, text: str) -> str:
+        # whitespace never changes the tokens; case only doesn't for uncased tokenizers
+        text = " ".join(unicodedata.normalize("NFKC", text or "").split())
+        return text.lower() if self.lowercase else text
+
+    def key(self, text: str) -> str:
+        return hashlib.sha1(f"{self.model_name}\0{self.normalize(text)}".encode("utf-8")).hexdigest()
+
+    # ---------- disk store ----------
+    def _open_disk(self):
+        os.makedirs(os.path.dirname(self.disk_path) or ".", exist_ok=True)
+        data_path = self.disk_path + ".f32"
+        keys_path = self.disk_path + ".keys"
+        index_path = self.disk_path + ".index.json"
+
+        index = None
+        if os.path.exists(data_path) and os.path.exists(keys_path) and os.path.exists(index_path):
+            with open(index_path, "r") as f:
+                index = json.load(f)
+            if (index.get("model_name") != self.model_name or index.get("dim") != self.dim
+                    or index.get("capacity") != self.disk_capacity):
+                print(f"[WARN] embedding cache at {self.disk_path} was built for another model/shape. Starting fresh.")
+                index = None
+
+        mode = "r+" if index is not None else "w+"
+        self._mm = np.memmap(data_path, dtype=np.float32, mode=mode, shape=(self.disk_capacity, self.dim))
+        self._keys = np.memmap(keys_path, dtype=np.uint8, mode=mode, shape=(self.disk_capacity, 20))
+        self._row_keys = [None] * self.disk_capacity
+        if index is not None:
+            # the key file is written together with the rows, the header only every flush_every puts
+            # -> rebuild the key -> row map from it
+            for r in np.flatnonzero(self._keys.any(axis=1)).tolist():
+                k = bytes(self._keys[r]).hex()
+                self._rows[k] = r
+                self._row_keys[r] = k
+            self._next_row = int(index["next_row"])
+
+    def flush(self):
+        if self._mm is None:
+            return
+        with self._lock:
+            self._mm.flush()
+            self._keys.flush()
+            index = {
+                "model_name": self.model_name,
+                "dim": self.dim,
+                "capacity": self.disk_capacity,
+                "next_row": self._next_row,
+            }
+            tmp_path = self.disk_path + ".index.json.tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(index, f)
+            os.replace(tmp_path, self.disk_path + ".index.json")
+            self._dirty = 0
+
+    def _disk_put(self, key: str, vec: np.ndarray):
+        if key in self._rows:
+            return
+        row = self._next_row % self.disk_capacity
+        old_key = self._row_keys[row]
+        if old_key is not None:
+            self._rows.pop(old_key, None)
+        # tombstone -> vector -> key: a crash in between leaves an empty row, never a vector under another key
+        self._keys[row] = 0
+        self._mm[row] = vec
+        self._keys[row] = np.frombuffer(bytes.fromhex(key), dtype=np.uint8)
+        self._rows[key] = row
+        self._row_keys[row] = key
+        self._next_row += 1
+        self._dirty += 1
+
+    # ---------- API ----------
+    def get(self, text: str):
+        key = self.key(text)
+        with self._lock:
+            vec = self.lru.get(key)
+            if vec is not None:
+                self.lru.move_to_end(key)
+                self.hits += 1
+                return vec
+
+            row = self._rows.get(key) if self._mm is not None else None
+            if row is not None and bytes(self._keys[row]) != bytes.fromhex(key):
+                # row was reused for another text
+                self._rows.pop(key, None)
+                row = None
+            if row is not None:
+                vec = np.array(self._mm[row], dtype=np.float32)
+                vec.setflags(write=False)
+                self._lru_put(key, vec)
+                self.hits += 1
+                self.disk_hits += 1
+                return vec
+
+            self.misses += 1
+            return None
+
+    def _lru_put(self, key: str, vec: np.ndarray):
+        self.lru[key] = vec
+        self.lru.move_to_end(key)
+        while len(self.lru) > self.max_entries:
+            self.lru.popitem(last=False)
+
+    def put(self, text: str, vec):
+        key = self.key(text)
+        # own copy: neither the caller nor anyone reading it from the cache can change the entry
+        vec = np.array(vec, dtype=np.float32).reshape(-1)
+        vec.setflags(write=False)
+        with self._lock:
+            self._lru_put(key, vec)
+            if self._mm is not None:
+                self._disk_put(key, vec)
+        if self._dirty >= self.flush_every:
+            self.flush()
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            "memory_entries": len(self.lru),
+            "disk_entries": len(self._rows),
+        }
+
+    def close(self):
+        self.flush()
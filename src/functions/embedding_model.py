@@ -0,0 +1,242 @@
+# src/functions/embedding_model.py
+import os
+import threading
+import time
+
+import numpy as np
+
+
+class LazyEmbeddingModel:
+    """
+        SentenceTransformer that is imported and loaded on first use - or ahead of time by
+        load() from a startup warmup thread. encode() has the SentenceTransformer signature.
+    """
+    def __init__(self, model_name: str):
+        self.model_name = model_name
+        self._model = None
+        self._lock = threading.Lock()
+        self.load_ms = None
+
+    @property
+    def loaded(self) -> bool:
+        return self._model is not None
+
+    def load(self):
+        if self._model is not None:
+            return self._model
+        with self._lock:
+            if self._model is None:
+                t0 = time.perf_counter()
+                # torch + transformers: seconds to import -> only when the model is actually needed
+                from sentence_transformers import SentenceTransformer
+                self._model = SentenceTransformer(self.model_name)
+                self.load_ms = round((time.perf_counter() - t0) * 1000, 1)
+                print(f"Loaded embedding model '{self.model_name}' in {self.load_ms} ms.", flush=True)
+        return self._model
+
+    @property
+    def cache_name(self) -> str:
+        return self.model_name
+
+    def encode(self, texts, **kwargs):
+        return self.load().encode(texts, **kwargs)
+
+
+class OnnxEmbeddingModel:
+    """
+        The SentenceTransformer pipeline of MiniLM (tokenize -> transformer -> mean pooling -> L2 norm) on
+        onnxruntime with an int8-quantized graph: no torch import, smaller resident memory, faster on CPU.
+        Model file, first found:
+            - `embedding_onnx_path`: a .onnx file, or a directory holding one (quantized files preferred);
+              tokenizer.json is looked up next to it and in its parent directory
+            - `embedding_onnx_file` (default onnx/model_quint8_avx2.onnx) + tokenizer.json from the model's
+              Hugging Face repo, downloaded / cached by huggingface_hub
+        `embedding_threads` sets onnxruntime's intra-op threads (0 = one per core).
+        `embedding_parity_check`: after loading, compare against the torch model (imports torch) and warn
+        below `embedding_parity_min_cosine`.
+        A fp32 export can be quantized with: python -m src.functions.embedding_model quantize model.onnx
+    """
+    PREFERRED_FILES = ("model_qint8_avx512_vnni.onnx", "model_quint8_avx2.onnx", "model_quantized.onnx", "model_int8.onnx", "model.onnx")
+
+    def __init__(self, model_name: str, config: dict = None):
+        cfg = config or {}
+        self.model_name = model_name
+        self.onnx_path = cfg.get("embedding_onnx_path")
+        self.onnx_file = cfg.get("embedding_onnx_file", "onnx/model_quint8_avx2.onnx")
+        self.threads = cfg.get("embedding_threads", 0)
+        self.max_seq_length = cfg.get("embedding_max_seq_length", 256)
+        self.batch_size = cfg.get("embedding_batch_size", 32)
+        self.parity_check = cfg.get("embedding_parity_check", False)
+        self.parity_min_cosine = cfg.get("embedding_parity_min_cosine", 0.99)
+        self.parity = None
+        self._session = None
+        self._tokenizer = None
+        self._input_names: set[str] = set()
+        self._lock = threading.Lock()
+        self.load_ms = None
+        self.model_file = None
+
+    @property
+    def cache_name(self) -> str:
+        # quantized vectors differ slightly from the torch ones -> separate embedding-cache namespace
+        return f"{self.model_name}@onnx:{self.onnx_path or self.onnx_file}"
+
+    @property
+    def loaded(self) -> bool:
+        return self._session is not None
+
+    def _resolve_files(self) -> tuple[str, str]:
+        if self.onnx_path:
+            path = self.onnx_path
+            if os.path.isdir(path):
+                candidates = [os.path.join(path, f) for f in self.PREFERRED_FILES]
+                candidates += [os.path.join(path, "onnx", f) for f in self.PREFERRED_FILES]
+                found = [c for c in candidates if os.path.exists(c)]
+                if not found:
+                    raise FileNotFoundError(f"No .onnx model in {path}")
+                path = found[0]
+            model_dir = os.path.dirname(os.path.abspath(path))
+            for d in (model_dir, os.path.dirname(model_dir)):
+                tokenizer = os.path.join(d, "tokenizer.json")
+                if os.path.exists(tokenizer):
+                    return path, tokenizer
+            raise FileNotFoundError(f"No tokenizer.json next to {path}")
+
+        from huggingface_hub import hf_hub_download
+        return (
+            hf_hub_download(self.model_name, self.onnx_file),
+            hf_hub_download(self.model_name, "tokenizer.json"),
+        )
+
+    def load(self):
+        if self._session is not None:
+            return self._session
+        with self._lock:
+            if self._session is None:
+                t0 = time.perf_counter()
+                import onnxruntime as ort
+                from tokenizers import Tokenizer
+
+                model_file, tokenizer_file = self._resolve_files()
+                tokenizer = Tokenizer.from_file(tokenizer_file)
+                tokenizer.enable_truncation(max_length=self.max_seq_length)
+                if tokenizer.padding is None:
+                    tokenizer.enable_padding()
+
+                options = ort.SessionOptions()
+                options.intra_op_num_threads = self.threads
+                options.inter_op_num_threads = 1
+                options.execution_mode = ort.ExecutionMode.ORT_SEQUENTIAL
+                options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+                session = ort.InferenceSession(model_file, sess_options=options, providers=["CPUExecutionProvider"])
+
+                self._input_names = {i.name for i in session.get_inputs()}
+                self._tokenizer = tokenizer
+                self.model_file = model_file
+                self._session = session
+                self.load_ms = round((time.perf_counter() - t0) * 1000, 1)
+                print(f"Loaded ONNX embedding model '{model_file}' ({self.threads or 'all'} threads) in {self.load_ms} ms.", flush=True)
+                if self.parity_check:
+                    self._check_parity()
+        return self._session
+
+    def _check_parity(self):
+        self.parity = cosine_parity(self, LazyEmbeddingModel(self.model_name))
+        ok = self.parity["min"] >= self.parity_min_cosine
+        print(f"{'' if ok else '[WARN] '}ONNX vs torch embedding parity: min cos {self.parity['min']}, "
+              f"mean {self.parity['mean']} (threshold {self.parity_min_cosine})", flush=True)
+
+    def encode(self, texts, batch_size: int | None = None, **kwargs):
+        session = self.load()
+        single = isinstance(texts, str)
+        texts = [texts] if single else list(texts)
+        batch_size = batch_size or self.batch_size
+        out = []
+        for i in range(0, len(texts), batch_size):
+            encodings = self._tokenizer.encode_batch(texts[i:i + batch_size])
+            ids = np.asarray([e.ids for e in encodings], dtype=np.int64)
+            mask = np.asarray([e.attention_mask for e in encodings], dtype=np.int64)
+            feeds = {"input_ids": ids, "attention_mask": mask}
+            if "token_type_ids" in self._input_names:
+                feeds["token_type_ids"] = np.asarray([e.type_ids for e in encodings], dtype=np.int64)
+            hidden = session.run(None, feeds)[0]
+            if hidden.ndim == 3:
+                # mean pooling over real (non-padding) tokens
+                m = mask[..., None].astype(np.float32)
+                hidden = (hidden * m).sum(axis=1) / np.clip(m.sum(axis=1), 1e-9, None)
+            hidden = hidden / np.clip(np.linalg.norm(hidden, axis=1, keepdims=True), 1e-12, None)
+            out.append(hidden.astype(np.float32))
+        vectors = np.concatenate(out) if out else np.zeros((0, 0), dtype=np.float32)
+        return vectors[0] if single else vectors
+
+
+PARITY_TEXTS = [
+    "yo bro",
+    "can you give me nlp knowledge",
+    "The user prefers short answers in Vietnamese.",
+    "Bug PRJ-1042 is caused by a race in the Milvus write-behind buffer.",
+    "How do I configure nprobe and nlist for an IVF_FLAT index?",
+    "Tôi muốn học về xử lý ngôn ngữ tự nhiên.",
+]
+
+
+def cosine_parity(model, reference, texts: list[str] | None = None) -> dict:
+    """
+        Row-wise cosine between two embedders' vectors for the same texts
+    """
+    texts = texts or PARITY_TEXTS
+    a = np.asarray(model.encode(texts), dtype=np.float32)
+    b = np.asarray(reference.encode(texts), dtype=np.float32)
+    cos = (a * b).sum(axis=1) / (np.linalg.norm(a, axis=1) * np.linalg.norm(b, axis=1))
+    return {"min": round(float(cos.min()), 5), "mean": round(float(cos.mean()), 5), "n": len(texts)}
+
+
+def create_embedding_model(config: dict | None):
+    """
+        embedding_backend: "torch" (SentenceTransformer, default) or "onnx" (int8 onnxruntime)
+    """
+    cfg = config or {}
+    model_name = cfg.get("embedding_model_name", "sentence-transformers/all-MiniLM-L6-v2")
+    backend = cfg.get("embedding_backend", "torch")
+    if backend == "torch":
+        return LazyEmbeddingModel(model_name)
+    if backend != "onnx":
+        raise ValueError(f"Unknown embedding_backend: {backend!r} (expected 'torch' or 'onnx')")
+
+    return OnnxEmbeddingModel(model_name, cfg)
+
+
+def _main():
+    import argparse
+    parser = argparse.ArgumentParser(description="ONNX embedding backend tools")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+    q = sub.add_parser("quantize", help="dynamic int8 quantization of a fp32 .onnx export")
+    q.add_argument("src")
+    q.add_argument("dst", nargs="?", default=None)
+    p = sub.add_parser("parity", help="cosine parity + latency of the onnx backend against torch")
+    p.add_argument("--config", default="configs/app.yaml")
+    p.add_argument("--runs", type=int, default=50)
+    args = parser.parse_args()
+
+    if args.cmd == "quantize":
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+        dst = args.dst or args.src.replace(".onnx", "_quantized.onnx")
+        quantize_dynamic(args.src, dst, weight_type=QuantType.QInt8)
+        print(f"Wrote {dst}")
+        return
+
+    import yaml
+    with open(args.config, "r") as f:
+        config = yaml.safe_load(f)
+    onnx_model = create_embedding_model({**config, "embedding_backend": "onnx", "embedding_parity_check": False})
+    torch_model = create_embedding_model({**config, "embedding_backend": "torch"})
+    print("parity:", cosine_parity(onnx_model, torch_model))
+    for name, model in (("onnx", onnx_model), ("torch", torch_model)):
+        t0 = time.perf_counter()
+        for i in range(args.runs):
+            model.encode([f"{PARITY_TEXTS[i % len(PARITY_TEXTS)]} {i}"])
+        print(f"{name}: {round((time.perf_counter() - t0) * 1000 / args.runs, 2)} ms / single-text encode")
+
+
+if __name__ == "__main__":
+    _main()
@@ -0,0 +1,110 @@
+# src/functions/embedding_service.py
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from src.tracing import detached, span
+
+
+class EmbeddingService:
+    """
+        Micro-batching front of the SentenceTransformer shared by all sessions.
+        Concurrent embed() calls are collected for up to `embedding_batch_wait_ms` (or until
+        `embedding_batch_size` texts are waiting) and encoded with a single model.encode call
+        on one dedicated thread; each caller gets its row back through a future.
+    """
+    def __init__(self, model, config: dict = None):
+        config = config or {}
+        self.model = model
+        self.max_batch_size = config.get("embedding_batch_size", 32)
+        self.max_wait = config.get("embedding_batch_wait_ms", 5) / 1000.0
+        self.queue: asyncio.Queue = asyncio.Queue()
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="embedding")
+        self._task = None
+
+        # metrics
+        self.num_batches = 0
+        self.num_items = 0
+        self.batch_size_histogram: dict[int, int] = {}
+        self.queue_latency_total = 0.0
+        self.queue_latency_max = 0.0
+
+    def _ensure_started(self):
+        if self._task is None or self._task.done():
+            self._task = detached(asyncio.create_task, self._run())
+
+    async def embed(self, text: str):
+        """
+            Return the embedding of one text (1-D vector)
+        """
+        self._ensure_started()
+        fut = asyncio.get_running_loop().create_future()
+        await self.queue.put((text, fut, time.perf_counter()))
+        return await fut
+
+    async def _collect_batch(self) -> list:
+        batch = [await self.queue.get()]
+        deadline = time.perf_counter() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.perf_counter()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self._collect_batch()
+            # callers that gave up (cancelled) don't need encoding
+            batch = [item for item in batch if not item[1].done()]
+            if not batch:
+                continue
+
+            started = time.perf_counter()
+            self._record(batch, started)
+            texts = [text for text, _, _ in batch]
+            try:
+                with span("embedding.encode_batch", batch_size=len(texts)):
+                    vectors = await loop.run_in_executor(self._executor, self.model.encode, texts)
+            except Exception as e:
+                for _, fut, _ in batch:
+                    if not fut.done():
+                        fut.set_exception(e)
+                continue
+
+            for (_, fut, _), vec in zip(batch, vectors):
+                if not fut.done():
+                    fut.set_result(vec)
+
+    def _record(self, batch: list, started: float):
+        self.num_batches += 1
+        self.num_items += len(batch)
+        self.batch_size_histogram[len(batch)] = self.batch_size_histogram.get(len(batch), 0) + 1
+        for _, _, enqueued in batch:
+            latency = started - enqueued
+            self.queue_latency_total += latency
+            self.queue_latency_max = max(self.queue_latency_max, latency)
+
+    def stats(self) -> dict:
+        return {
+            "batches": self.num_batches,
+            "items": self.num_items,
+            "avg_batch_size": round(self.num_items / self.num_batches, 2) if self.num_batches else 0.0,
+            "batch_size_histogram": dict(sorted(self.batch_size_histogram.items())),
+            "avg_queue_latency_ms": round(self.queue_latency_total / self.num_items * 1000, 3) if self.num_items else 0.0,
+            "max_queue_latency_ms": round(self.queue_latency_max * 1000, 3),
+        }
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        self._executor.shutdown(wait=False)
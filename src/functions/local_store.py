@@ -0,0 +1,521 @@
+# src/functions/local_store.py
+import atexit
+import heapq
+import json
+import os
+import threading
+
+import numpy as np
+
+from src.functions.memory_store import MemoryStore, SearchHit
+from src.functions.quantization import make_codec
+from src.functions.sparse_encoder import SparseEncoder
+from src.tracing import span
+
+
+class VectorIndex:
+    """
+        In-process vector index: one contiguous float32 matrix (capacity doubles as it grows).
+        Search is brute force over the candidate rows; once `ivf_min_rows` vectors are stored an
+        IVF layer (k-means with `nlist` centroids, `nprobe` lists searched) is trained and
+        retrained whenever the data has doubled since the last training.
+        metric: COSINE / IP (higher is better) or L2 (squared distance, lower is better).
+
+        With a codec (src/functions/quantization.py) the float matrix is replaced by compact codes
+        once `quant_min_rows` vectors are stored; the codes rank the candidates and, when
+        `full_vectors(rows)` is given, the best `rerank_factor` x k of them are rescored exactly.
+    """
+    def __init__(self, dim: int, metric: str = "COSINE", nlist: int = 128, nprobe: int = 10, ivf_min_rows: int = 20000,
+                 codec=None, quant_min_rows: int = 1000, rerank_factor: int = 4, full_vectors=None):
+        self.dim = dim
+        self.metric = metric.upper()
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self.ivf_min_rows = ivf_min_rows
+
+        self.data = np.zeros((1024, dim), dtype=np.float32)
+        self.alive = np.zeros(1024, dtype=bool)
+        self.size = 0
+
+        self.centroids = None                              # (nlist, dim)
+        self.assign = np.full(1024, -1, dtype=np.int32)    # row -> list id
+        self.trained_size = 0
+
+        self.codec = codec
+        self.codes = None                                  # (capacity, code_size) uint8 once quantized
+        self.quant_min_rows = max(quant_min_rows, 256 if codec is not None and codec.name == "pq" else 1)
+        self.rerank_factor = rerank_factor
+        self.full_vectors = full_vectors                   # rows -> raw float32 vectors, for the rerank
+
+    def _prepare(self, vec) -> np.ndarray:
+        vec = np.asarray(vec, dtype=np.float32).reshape(-1)
+        if self.metric == "COSINE":
+            norm = np.linalg.norm(vec)
+            if norm > 0:
+                vec = vec / norm
+        return vec
+
+    def _prepare_many(self, matrix) -> np.ndarray:
+        matrix = np.asarray(matrix, dtype=np.float32).reshape(-1, self.dim)
+        if self.metric == "COSINE":
+            matrix = matrix / np.maximum(np.linalg.norm(matrix, axis=1, keepdims=True), 1e-12)
+        return matrix
+
+    def _grow(self):
+        capacity = len(self.alive) * 2
+        for name, fill in (("data", 0), ("codes", 0), ("alive", False), ("assign", -1)):
+            old = getattr(self, name)
+            if old is None:
+                continue
+            new = np.full((capacity,) + old.shape[1:], fill, dtype=old.dtype)
+            new[: self.size] = old[: self.size]
+            setattr(self, name, new)
+
+    def add(self, vec) -> int:
+        if self.size == len(self.alive):
+            self._grow()
+        row = self.size
+        vec = self._prepare(vec)
+        if self.codes is not None:
+            self.codes[row] = self.codec.encode(vec.reshape(1, -1))[0]
+        else:
+            self.data[row] = vec
+        self.alive[row] = True
+        if self.centroids is not None:
+            self.assign[row] = int(np.argmax(self._scores(self.centroids, vec)))
+        self.size += 1
+        if self.codec is not None and self.codes is None and self.size >= self.quant_min_rows:
+            self.quantize()
+        return row
+
+    def remove(self, row: int):
+        self.alive[row] = False
+
+    def _scores(self, matrix: np.ndarray, q: np.ndarray) -> np.ndarray:
+        # always "higher is better"; L2 is negated squared distance
+        if self.metric == "L2":
+            diff = matrix - q
+            return -np.einsum("ij,ij->i", diff, diff)
+        return matrix @ q
+
+    def _vectors(self, rows: np.ndarray) -> np.ndarray:
+        """
+            Float vectors of `rows` (normalized like the stored data): the matrix itself, else the
+            full vectors on disk, else the codec's reconstruction
+        """
+        if self.codes is None:
+            return self.data[rows]
+        if self.full_vectors is not None:
+            return self._prepare_many(self.full_vectors(rows))
+        return self.codec.decode(self.codes[rows])
+
+    # ---------- quantization ----------
+    def quantize(self, seed: int = 0):
+        """
+            Train the codec on (a sample of) the stored vectors, encode them all and drop the float matrix
+        """
+        rows = np.flatnonzero(self.alive[: self.size])
+        if len(rows) == 0:
+            rows = np.arange(self.size)
+        rng = np.random.default_rng(seed)
+        sample = self.data[np.sort(rng.choice(rows, size=min(len(rows), 65536), replace=False))]
+        self.codec.train(sample)
+        codes = np.zeros((len(self.alive), self.codec.code_size), dtype=np.uint8)
+        for i in range(0, self.size, 65536):
+            codes[i:min(i + 65536, self.size)] = self.codec.encode(self.data[i:min(i + 65536, self.size)])
+        self.codes = codes
+        self.data = None
+        print(f"Vector index: {self.size} vector(s) quantized with {self.codec.name} "
+              f"({self.codec.code_size} bytes per vector instead of {self.dim * 4}).", flush=True)
+
+    def bytes_per_vector(self) -> int:
+        return self.codec.code_size if self.codes is not None else self.dim * 4
+
+    def memory_bytes(self) -> int:
+        """
+            Resident bytes of the index: vectors or codes, codebooks, centroids and row bookkeeping
+        """
+        total = self.alive.nbytes + self.assign.nbytes
+        total += self.codes.nbytes + self.codec.memory_bytes() if self.codes is not None else self.data.nbytes
+        if self.centroids is not None:
+            total += self.centroids.nbytes
+        return total
+
+    # ---------- IVF ----------
+    def _maybe_train(self):
+        n = int(self.alive[: self.size].sum())
+        if n < self.ivf_min_rows or n < 2 * self.nlist:
+            return
+        if self.centroids is not None and self.size < 2 * self.trained_size:
+            return
+        self.train()
+
+    def train(self, iterations: int = 10, seed: int = 0):
+        rows = np.flatnonzero(self.alive[: self.size])
+        rng = np.random.default_rng(seed)
+        sample = self._vectors(np.sort(rng.choice(rows, size=min(len(rows), 256 * self.nlist), replace=False)))
+        centroids = sample[rng.choice(len(sample), size=self.nlist, replace=False)].copy()
+        for _ in range(iterations):
+            labels = self._nearest(centroids, sample)
+            for c in range(self.nlist):
+                members = sample[labels == c]
+                if len(members):
+                    centroids[c] = members.mean(axis=0)
+            if self.metric == "COSINE":
+                centroids /= np.maximum(np.linalg.norm(centroids, axis=1, keepdims=True), 1e-12)
+        self.centroids = centroids
+        for i in range(0, self.size, 65536):
+            block = np.arange(i, min(i + 65536, self.size))
+            self.assign[block] = self._nearest(centroids, self._vectors(block))
+        self.trained_size = self.size
+
+    def _nearest(self, centroids: np.ndarray, matrix: np.ndarray, chunk: int = 65536) -> np.ndarray:
+        out = np.empty(len(matrix), dtype=np.int32)
+        for i in range(0, len(matrix), chunk):
+            block = matrix[i:i + chunk]
+            if self.metric == "L2":
+                sims = 2 * block @ centroids.T - np.einsum("ij,ij->i", centroids, centroids)
+            else:
+                sims = block @ centroids.T
+            out[i:i + chunk] = np.argmax(sims, axis=1)
+        return out
+
+    @staticmethod
+    def _top(rows: np.ndarray, scores: np.ndarray, k: int) -> tuple[np.ndarray, np.ndarray]:
+        if len(rows) > k:
+            top = np.argpartition(-scores, k - 1)[:k]
+            rows, scores = rows[top], scores[top]
+        order = np.argsort(-scores)
+        return rows[order], scores[order]
+
+    def search(self, query, k: int, candidates: np.ndarray | None = None) -> tuple[np.ndarray, np.ndarray]:
+        """
+            Returns (rows, scores) of the best k rows, restricted to `candidates` when given
+        """
+        q = self._prepare(query)
+        self._maybe_train()
+        rows = np.arange(self.size) if candidates is None else np.asarray(candidates, dtype=np.int64)
+        rows = rows[self.alive[rows]]
+        if self.centroids is not None and len(rows) > self.ivf_min_rows:
+            probe = np.argsort(-self._scores(self.centroids, q))[: self.nprobe]
+            rows = rows[np.isin(self.assign[rows], probe)]
+        if len(rows) == 0:
+            return rows, np.zeros(0, dtype=np.float32)
+
+        if self.codes is None:
+            return self._top(rows, self._scores(self.data[rows], q), k)
+
+        # codes give approximate scores; rescore the best few exactly from the full vectors
+        rerank = self.full_vectors is not None and self.rerank_factor > 1
+        rows, scores = self._top(rows, self.codec.scores(self.codes[rows], q, self.metric), k * self.rerank_factor if rerank else k)
+        if not rerank:
+            return rows, scores
+        return self._top(rows, self._scores(self._vectors(rows), q), k)
+
+
+class LocalStore(MemoryStore):
+    """
+        Embedded backend (storage_backend: "local"): no Milvus / etcd / minio needed.
+        Everything is served from memory; every write is appended to files under `local_store_path`
+        and replayed on startup:
+            session_memory.jsonl + session_memory.f32   row metadata + raw float32 vectors (same order);
+                                                        with vector_storage sq8 / pq / binary only the codes
+                                                        stay in memory and the .f32 file serves the rerank
+            session_memory.deleted.jsonl                deleted vector rows
+            sparse_stats.json                           BM25 corpus statistics (hybrid search)
+            chat_logs.jsonl                             one line per (idx, role)
+            context_window.jsonl                        one line per upsert (compacted on startup)
+    """
+    def __init__(self, config: dict):
+        self.config = config
+        self.path = config.get("local_store_path") or os.path.join(config.get("chat_history_path", "chatbot_logs/"), "local_store")
+        os.makedirs(self.path, exist_ok=True)
+        self.dim = config.get("embedding_dimension", 384)
+
+        self.index = VectorIndex(
+            self.dim,
+            metric=config.get("metric_type", "COSINE"),
+            nlist=config.get("nlist", 128),
+            nprobe=config.get("nprobe", 10),
+            ivf_min_rows=config.get("local_ivf_min_rows", 20000),
+            codec=make_codec(config.get("vector_storage", "float"), self.dim, pq_m=config.get("pq_m", 48)),
+            quant_min_rows=config.get("local_quant_min_rows", 1000),
+            rerank_factor=config.get("rerank_factor", 4) if config.get("vector_rerank", True) else 1,
+            full_vectors=self._full_vectors,
+        )
+        self.session_rows: list[dict] = []                          # vector row -> metadata
+        self.session_pk: dict[str, int] = {}                        # pk -> live vector row
+        self.user_rows: dict[str, list[int]] = {}
+        self.chat_rows: dict[tuple[str, str], list[int]] = {}
+        self.postings: dict[int, dict[int, float]] = {}             # sparse term -> {vector row: weight}
+        self.chat_logs: dict[tuple[str, str], dict[tuple[int, str], dict]] = {}
+        self.context_windows: dict[str, dict] = {}
+        self._lock = threading.RLock()
+
+        self._session_meta_path = os.path.join(self.path, "session_memory.jsonl")
+        self._session_vec_path = os.path.join(self.path, "session_memory.f32")
+        self._session_deleted_path = os.path.join(self.path, "session_memory.deleted.jsonl")
+        self._chat_logs_path = os.path.join(self.path, "chat_logs.jsonl")
+        self._context_window_path = os.path.join(self.path, "context_window.jsonl")
+        self._vec_map = None                                        # read-only memmap of session_memory.f32
+        self.sparse_encoder = None
+        if config.get("hybrid_search", True):
+            self.sparse_encoder = SparseEncoder.from_config(config, self.path)
+        self._load()
+
+        self._files = {
+            "session_meta": open(self._session_meta_path, "a", encoding="utf-8"),
+            "session_vec": open(self._session_vec_path, "ab"),
+            "session_deleted": open(self._session_deleted_path, "a", encoding="utf-8"),
+            "chat_logs": open(self._chat_logs_path, "a", encoding="utf-8"),
+            "context_window": open(self._context_window_path, "a", encoding="utf-8"),
+        }
+        # sparse stats are saved on an interval -> write the last changes on interpreter shutdown
+        atexit.register(self.close)
+        print(f"Local memory store at '{self.path}': {len(self.session_pk)} session(s), "
+              f"{sum(len(v) for v in self.chat_logs.values())} chat log row(s), {len(self.context_windows)} window row(s).")
+
+    # ---------- files ----------
+    @staticmethod
+    def _read_jsonl(path: str) -> list[dict]:
+        """
+            Read all complete lines; a torn last line (crash mid-write) is cut off the file
+        """
+        if not os.path.exists(path):
+            return []
+        records, good_bytes = [], 0
+        with open(path, "rb") as f:
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break
+                try:
+                    records.append(json.loads(line))
+                except json.JSONDecodeError:
+                    break
+                good_bytes += len(line)
+        if good_bytes != os.path.getsize(path):
+            with open(path, "r+b") as f:
+                f.truncate(good_bytes)
+        return records
+
+    def _full_vectors(self, rows: np.ndarray) -> np.ndarray:
+        """
+            Raw float32 vectors of index rows, read from session_memory.f32 (vector row i is record i
+            of the file); only the exact rerank of compressed storage needs them
+        """
+        rows = np.asarray(rows, dtype=np.int64)
+        if self._vec_map is None or (len(rows) and rows.max() >= len(self._vec_map)):
+            # the file has grown since it was mapped
+            if "session_vec" in getattr(self, "_files", {}):
+                self._files["session_vec"].flush()
+            n = os.path.getsize(self._session_vec_path) // (self.dim * 4)
+            self._vec_map = np.memmap(self._session_vec_path, dtype=np.float32, mode="r", shape=(n, self.dim))
+        return np.asarray(self._vec_map[rows])
+
+    def _load(self):
+        meta = self._read_jsonl(self._session_meta_path)
+        n_vecs = os.path.getsize(self._session_vec_path) // (self.dim * 4) if os.path.exists(self._session_vec_path) else 0
+        n = min(len(meta), n_vecs)
+        # vector and metadata are appended in that order -> drop whatever half-written tail exists
+        if os.path.exists(self._session_vec_path) and os.path.getsize(self._session_vec_path) != n * self.dim * 4:
+            with open(self._session_vec_path, "r+b") as f:
+                f.truncate(n * self.dim * 4)
+        if len(meta) != n:
+            meta = meta[:n]
+            self._rewrite_jsonl(self._session_meta_path, meta)
+        # mapped, not read: with compressed storage the float vectors never all sit in memory
+        vecs = np.memmap(self._session_vec_path, dtype=np.float32, mode="r", shape=(n, self.dim)) if n else []
+        for row, vec in zip(meta, vecs):
+            self._index_session_row(row, vec)
+        for tomb in self._read_jsonl(self._session_deleted_path):
+            self._remove_session_row(tomb["pk"], tomb["row"])
+
+        for row in self._read_jsonl(self._chat_logs_path):
+            self._index_chat_log(row)
+
+        lines = self._read_jsonl(self._context_window_path)
+        for row in lines:
+            self.context_windows[row["pk"]] = row
+        if len(lines) > 2 * len(self.context_windows) + 64:
+            self._rewrite_jsonl(self._context_window_path, list(self.context_windows.values()))
+
+    @staticmethod
+    def _rewrite_jsonl(path: str, rows: list[dict]):
+        tmp = path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            for row in rows:
+                f.write(json.dumps(row, ensure_ascii=False) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+
+    def _append(self, name: str, row: dict):
+        f = self._files[name]
+        f.write(json.dumps(row, ensure_ascii=False) + "\n")
+        f.flush()
+
+    # ---------- session memory ----------
+    def _index_session_row(self, row: dict, vec):
+        old = self.session_pk.get(row["pk"])
+        if old is not None:
+            self.index.remove(old)
+            self._remove_postings(old)
+        r = self.index.add(vec)
+        if row.get("sparse"):
+            # JSON turns the term ids into strings
+            row["sparse"] = {int(t): float(w) for t, w in row["sparse"].items()}
+            for t, w in row["sparse"].items():
+                self.postings.setdefault(t, {})[r] = w
+        self.session_rows.append(row)
+        self.session_pk[row["pk"]] = r
+        self.user_rows.setdefault(row["user_id"], []).append(r)
+        self.chat_rows.setdefault((row["user_id"], row["chat_id"]), []).append(r)
+
+    def insert_session_memory(self, row: dict):
+        vec = np.asarray(row["embedding"], dtype=np.float32).reshape(-1)
+        meta = {k: v for k, v in row.items() if k != "embedding"}
+        with span("local_store.insert", collection="session_memory"), self._lock:
+            self._files["session_vec"].write(vec.tobytes())
+            self._files["session_vec"].flush()
+            self._append("session_meta", meta)
+            old = self.session_pk.get(meta["pk"])
+            if old is not None and self.sparse_encoder is not None:
+                # replaced row leaves the corpus stats (only here: on _load replay the saved stats already reflect it)
+                self.sparse_encoder.forget(self.session_rows[old].get("sparse"))
+            self._index_session_row(meta, vec)
+            self.save_sparse_stats(force=False)
+
+    def _remove_postings(self, row: int):
+        for t in self.session_rows[row].get("sparse") or {}:
+            postings = self.postings.get(t)
+            if postings is not None:
+                postings.pop(row, None)
+                if not postings:
+                    del self.postings[t]
+
+    def _remove_session_row(self, pk: str, row: int):
+        if self.session_pk.get(pk) == row:
+            del self.session_pk[pk]
+            self.index.remove(row)
+            self._remove_postings(row)
+
+    def list_session_memory(self, user_id: str, chat_id: str) -> list[dict]:
+        with self._lock:
+            rows = self.chat_rows.get((user_id, chat_id), [])
+            return [self.memory_meta(self.session_rows[r]) for r in rows if self.index.alive[r]]
+
+    def delete_session_memory(self, pks: list[str]):
+        with span("local_store.delete", collection="session_memory"), self._lock:
+            for pk in pks:
+                row = self.session_pk.get(pk)
+                if row is not None:
+                    self._append("session_deleted", {"pk": pk, "row": row})
+                    if self.sparse_encoder is not None:
+                        self.sparse_encoder.forget(self.session_rows[row].get("sparse"))
+                    self._remove_session_row(pk, row)
+            self.save_sparse_stats(force=False)
+
+    def _hit(self, row: int, distance: float | None) -> SearchHit:
+        entity = {k: v for k, v in self.session_rows[row].items() if k != "sparse"}
+        return SearchHit(id=entity["pk"], distance=distance, entity=entity)
+
+    def _sparse_search(self, sparse_query: dict, k: int, candidates: list | None) -> list:
+        # term-at-a-time over the postings of the query terms only
+        scores: dict[int, float] = {}
+        for t, w in sparse_query.items():
+            for r, dw in self.postings.get(t, {}).items():
+                scores[r] = scores.get(r, 0.0) + w * dw
+        allowed = set(candidates) if candidates is not None else None
+        best = heapq.nlargest(k, (
+            (score, r) for r, score in scores.items()
+            if self.index.alive[r] and (allowed is None or r in allowed)
+        ))
+        return [self._hit(r, score) for score, r in best]
+
+    def retrieve_relevant_session_memory(self, query_embedding, top_k: int = 5,
+                                         user_id: str | None = None, chat_id: str | None = None, scope: str | None = None,
+                                         query_text: str | None = None) -> list:
+        scope = self.search_scope(scope)
+        queries = np.asarray(query_embedding, dtype=np.float32).reshape(-1, self.dim)
+        hybrid = self.use_hybrid(queries, query_text)
+        sparse_query = self.sparse_encoder.encode_query(query_text) if hybrid else {}
+        limit = self.hybrid_candidates(top_k) if hybrid else top_k
+        # both searches are in-memory; they run back to back under the store lock
+        with span("local_store.search", scope=scope, hybrid=hybrid) as attrs, self._lock:
+            candidates = None
+            if scope != "global" and user_id is not None:
+                if scope == "chat" and chat_id is not None:
+                    candidates = self.chat_rows.get((user_id, chat_id), [])
+                else:
+                    candidates = self.user_rows.get(user_id, [])
+
+            results = []
+            for q in queries:
+                rows, scores = self.index.search(q, limit, candidates)
+                # L2 scores are negated internally; report the distance itself
+                distances = -scores if self.index.metric == "L2" else scores
+                results.append([self._hit(r, float(d)) for r, d in zip(rows.tolist(), distances.tolist())])
+            if hybrid:
+                sparse_hits = self._sparse_search(sparse_query, limit, candidates) if sparse_query else []
+                attrs.update(dense_hits=len(results[0]), sparse_hits=len(sparse_hits))
+                results = [self.fuse_rrf(results[0], sparse_hits, top_k)]
+            attrs["hits"] = len(results[0]) if results else 0
+        return results
+
+    # ---------- chat logs ----------
+    def _index_chat_log(self, row: dict):
+        self.chat_logs.setdefault((row["user_id"], row["chat_id"]), {})[(int(row["idx"]), row["role"])] = row
+
+    def insert_chat_log(self, row: dict):
+        with self._lock:
+            self._append("chat_logs", row)
+            self._index_chat_log(row)
+
+    def load_chat_logs(self, user_id: str, chat_id: str, limit: int = 200,
+                       start_idx: int | None = None, end_idx: int | None = None) -> list[dict]:
+        with self._lock:
+            rows = [
+                {k: r[k] for k in ("idx", "role", "content", "created_at")}
+                for (idx, _), r in self.chat_logs.get((user_id, chat_id), {}).items()
+                if (start_idx is None or idx >= start_idx) and (end_idx is None or idx <= end_idx)
+            ]
+        rows.sort(key=lambda r: r["idx"])
+        return rows[:limit]
+
+    def iter_chat_logs(self, user_id: str, chat_id: str, start_idx: int | None = None,
+                       end_idx: int | None = None, page_size: int | None = None):
+        # rows are already in memory: no paging, just a sorted snapshot of the range
+        with self._lock:
+            keys = sorted(
+                k for k in self.chat_logs.get((user_id, chat_id), {})
+                if (start_idx is None or k[0] >= start_idx) and (end_idx is None or k[0] <= end_idx)
+            )
+            rows = self.chat_logs.get((user_id, chat_id), {})
+            selected = [rows[k] for k in keys]
+        for r in selected:
+            yield {k: r[k] for k in ("idx", "role", "content", "created_at")}
+
+    # ---------- context window ----------
+    def save_context_window(self, row: dict):
+        with self._lock:
+            self._append("context_window", row)
+            self.context_windows[row["pk"]] = row
+
+    def load_context_window_rows(self, pks: list[str]) -> dict[str, dict]:
+        with self._lock:
+            return {pk: dict(self.context_windows[pk]) for pk in pks if pk in self.context_windows}
+
+    def flush(self):
+        with self._lock:
+            for f in self._files.values():
+                if not f.closed:
+                    f.flush()
+                    os.fsync(f.fileno())
+            self.save_sparse_stats()
+
+    def close(self):
+        with self._lock:
+            self.flush()
+            for f in self._files.values():
+                f.close()
+            self._vec_map = None
@@ -0,0 +1,188 @@
+# src/functions/memory_store.py
+
+
+class SearchHit(dict):
+    """
+        One search result: {"id", "distance", "entity"}, readable as hit["entity"] or hit.entity
+        (same shape as a pymilvus hit)
+    """
+    def __getattr__(self, name):
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError(name) from None
+
+
+class MemoryStore:
+    """
+        Storage used by ChatPipeline / QueryUnderstanding, one group of methods per collection:
+        - session memory: summarized sessions + embedding + BM25 sparse vector, searched by vector (hybrid with keywords)
+        - chat logs: one row per (idx, role), read back by idx range
+        - context window: per-chat header / snapshot rows, read by pk
+        Writes to chat logs / context window may be buffered; reads must still see them.
+        Implementations: Milvus (src/functions/database.py), LocalStore (src/functions/local_store.py).
+    """
+    config: dict
+
+    def search_scope(self, scope: str | None = None) -> str:
+        # "chat" (this chat only), "user" (all chats of this user) or "global" (no filter)
+        return scope or self.config.get("memory_search_scope", "user")
+
+    # ---------- session memory ----------
+    def retrieve_relevant_session_memory(self, query_embedding, top_k: int = 5,
+                                         user_id: str | None = None, chat_id: str | None = None, scope: str | None = None,
+                                         query_text: str | None = None) -> list:
+        """
+            Returns one list of SearchHit-like results per query vector, best first.
+            With query_text (and `hybrid_search` on) a sparse BM25 search runs next to the dense one
+            and both rankings are fused (see fuse_rrf).
+        """
+        raise NotImplementedError
+
+    def use_hybrid(self, query_embedding, query_text: str | None) -> bool:
+        # one query vector <-> one query text
+        return bool(query_text) and getattr(self, "sparse_encoder", None) is not None and len(query_embedding) == 1
+
+    def hybrid_candidates(self, top_k: int) -> int:
+        # each side returns more than top_k so that fusion has something to re-rank
+        return max(top_k, self.config.get("hybrid_candidates", 20))
+
+    def fuse_rrf(self, dense: list, sparse: list, top_k: int) -> list:
+        """
+            Weighted reciprocal rank fusion of two best-first hit lists:
+                score(d) = w_dense / (rrf_k + rank_dense(d)) + w_sparse / (rrf_k + rank_sparse(d))
+            Fused hits carry "score" (the RRF score) and keep the dense "distance" when there is one.
+        """
+        k = self.config.get("rrf_k", 60)
+        fused = {}
+        for hits, weight, source in (
+            (dense, self.config.get("hybrid_dense_weight", 1.0), "dense"),
+            (sparse, self.config.get("hybrid_sparse_weight", 1.0), "sparse"),
+        ):
+            for rank, hit in enumerate(hits, start=1):
+                pk = hit["id"]
+                if pk not in fused:
+                    fused[pk] = SearchHit(id=pk, distance=None, score=0.0, entity=hit["entity"])
+                fused[pk]["score"] += weight / (k + rank)
+                if source == "dense":
+                    fused[pk]["distance"] = hit["distance"]
+        return sorted(fused.values(), key=lambda h: -h["score"])[:top_k]
+
+    def insert_session_memory(self, row: dict):
+        raise NotImplementedError
+
+    def list_session_memory(self, user_id: str, chat_id: str) -> list[dict]:
+        """
+            Metadata of one chat's session-memory rows (no vectors):
+            {"pk", "session_id", "full_session_json", "level", "first_summary_idx", "last_summary_idx"}
+        """
+        raise NotImplementedError
+
+    def delete_session_memory(self, pks: list[str]):
+        """
+            Delete rows by pk (and take them out of the sparse statistics)
+        """
+        raise NotImplementedError
+
+    @staticmethod
+    def memory_meta(r: dict) -> dict:
+        """
+            list_session_memory's metadata of one stored (or just inserted) session-memory row
+        """
+        # rows written before hierarchical summaries have no level / range -> leaf covering session_id
+        session_id = int(r.get("session_id", 0))
+        return {
+            "pk": r["pk"],
+            "session_id": session_id,
+            "full_session_json": r.get("full_session_json", "{}"),
+            "level": int(r.get("level", 0) or 0),
+            "first_summary_idx": int(r.get("first_summary_idx", session_id)),
+            "last_summary_idx": int(r.get("last_summary_idx", session_id)),
+        }
+
+    # ---------- chat logs ----------
+    def insert_chat_log(self, row: dict):
+        raise NotImplementedError
+
+    def load_chat_logs(self, user_id: str, chat_id: str, limit: int = 200,
+                       start_idx: int | None = None, end_idx: int | None = None) -> list[dict]:
+        """
+            Rows {"idx", "role", "content", "created_at"} sorted by idx, idx bounds inclusive
+        """
+        raise NotImplementedError
+
+    def iter_chat_logs(self, user_id: str, chat_id: str, start_idx: int | None = None,
+                       end_idx: int | None = None, page_size: int | None = None):
+        """
+            Yield rows lazily in idx order, one idx-range query per `page_size` turns, so memory stays
+            bounded however long the chat is. Turn idx are contiguous: without end_idx, iteration
+            stops at the first empty page.
+        """
+        page_size = page_size or self.config.get("chat_log_page_size", 256)
+        lo = start_idx or 0
+        while end_idx is None or lo <= end_idx:
+            hi = lo + page_size - 1 if end_idx is None else min(lo + page_size - 1, end_idx)
+            # at most one user + one assistant row per idx
+            rows = self.load_chat_logs(user_id, chat_id, limit=2 * (hi - lo + 1), start_idx=lo, end_idx=hi)
+            if not rows and end_idx is None:
+                return
+            yield from rows
+            lo = hi + 1
+
+    def tail_chat_logs(self, user_id: str, chat_id: str, n_turns: int, next_idx: int) -> list[dict]:
+        """
+            Rows of the last n_turns turns before next_idx (the chat's next turn idx, kept in its context-window header)
+        """
+        if n_turns <= 0 or next_idx <= 0:
+            return []
+        return list(self.iter_chat_logs(user_id, chat_id, start_idx=max(next_idx - n_turns, 0), end_idx=next_idx - 1))
+
+    # ---------- context window ----------
+    def save_context_window(self, row: dict):
+        """
+            Insert or replace one row by pk
+        """
+        raise NotImplementedError
+
+    def load_context_window_rows(self, pks: list[str]) -> dict[str, dict]:
+        """
+            pk -> row for the pks that exist
+        """
+        raise NotImplementedError
+
+    def prepare(self):
+        """
+            One-time connection / collection checks; safe to call from a warmup thread
+        """
+        pass
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+    def save_sparse_stats(self, force: bool = True):
+        """
+            force=False: only when the encoder's save interval has passed (after inserts / deletes)
+        """
+        encoder = getattr(self, "sparse_encoder", None)
+        if encoder is not None:
+            try:
+                encoder.save() if force else encoder.maybe_save()
+            except Exception as e:
+                print(f"[WARN] could not save sparse stats: {e}", flush=True)
+
+
+def create_memory_store(config: dict) -> MemoryStore:
+    """
+        storage_backend: "milvus" (default) or "local" (embedded, no Milvus server needed)
+    """
+    backend = config.get("storage_backend", "milvus")
+    if backend == "local":
+        from src.functions.local_store import LocalStore
+        return LocalStore(config)
+    if backend == "milvus":
+        from src.functions.database import Milvus
+        return Milvus(config)
+    raise ValueError(f"Unknown storage_backend: {backend!r} (expected 'milvus' or 'local')")
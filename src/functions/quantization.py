@@ -0,0 +1,231 @@
+# src/functions/quantization.py
+"""
+    Compressed vector codes for session memory (vector_storage):
+        float    float32, dim * 4 bytes per vector (no codec)
+        sq8      scalar quantization: one uint8 per dimension, per-dimension min/max      -> dim bytes
+        pq       product quantization: pq_m sub-vectors, 256 centroids each               -> pq_m bytes
+        binary   one bit per dimension (sign around the training mean), Hamming ranking   -> dim / 8 bytes
+    Codes only rank candidates; the exact rerank on full vectors happens in the index / store.
+"""
+import base64
+
+import numpy as np
+
+# popcount of every byte value, for Hamming distances on packed bits
+POPCOUNT = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+
+class Codec:
+    """
+        train(sample) once, then encode(vectors) -> uint8 codes; scores(codes, q, metric) are "higher is better"
+        approximations of the metric's score (negated squared distance for L2)
+    """
+    name = "float"
+    trained = False
+
+    def __init__(self, dim: int):
+        self.dim = dim
+
+    @property
+    def code_size(self) -> int:
+        raise NotImplementedError
+
+    def train(self, sample: np.ndarray):
+        raise NotImplementedError
+
+    def encode(self, vectors: np.ndarray) -> np.ndarray:
+        raise NotImplementedError
+
+    def decode(self, codes: np.ndarray) -> np.ndarray:
+        raise NotImplementedError
+
+    def scores(self, codes: np.ndarray, q: np.ndarray, metric: str) -> np.ndarray:
+        # default: decode and score exactly on the reconstruction
+        x = self.decode(codes)
+        if metric == "L2":
+            diff = x - q
+            return -np.einsum("ij,ij->i", diff, diff)
+        return x @ q
+
+    def memory_bytes(self) -> int:
+        # codebooks / ranges, not the codes
+        return 0
+
+
+class SQ8Codec(Codec):
+    name = "sq8"
+
+    def __init__(self, dim: int):
+        super().__init__(dim)
+        self.lo = None
+        self.scale = None
+
+    @property
+    def code_size(self) -> int:
+        return self.dim
+
+    def train(self, sample: np.ndarray):
+        self.lo = sample.min(axis=0).astype(np.float32)
+        hi = sample.max(axis=0).astype(np.float32)
+        self.scale = np.maximum(hi - self.lo, 1e-12) / 255.0
+        self.trained = True
+
+    def encode(self, vectors: np.ndarray) -> np.ndarray:
+        return np.clip(np.rint((vectors - self.lo) / self.scale), 0, 255).astype(np.uint8)
+
+    def decode(self, codes: np.ndarray) -> np.ndarray:
+        return codes.astype(np.float32) * self.scale + self.lo
+
+    def scores(self, codes: np.ndarray, q: np.ndarray, metric: str) -> np.ndarray:
+        if metric == "L2":
+            return super().scores(codes, q, metric)
+        # q . (lo + scale * c) = q . lo + (q * scale) . c  - no decoded copy
+        return codes.astype(np.float32) @ (q * self.scale) + float(q @ self.lo)
+
+    def memory_bytes(self) -> int:
+        return 2 * self.dim * 4
+
+
+class PQCodec(Codec):
+    name = "pq"
+
+    def __init__(self, dim: int, m: int = 48, iterations: int = 12, seed: int = 0):
+        super().__init__(dim)
+        if dim % m:
+            raise ValueError(f"pq_m={m} must divide the embedding dimension {dim}")
+        self.m = m
+        self.sub = dim // m
+        self.iterations = iterations
+        self.seed = seed
+        self.codebooks = None                 # (m, 256, sub)
+
+    @property
+    def code_size(self) -> int:
+        return self.m
+
+    def train(self, sample: np.ndarray):
+        rng = np.random.default_rng(self.seed)
+        k = min(256, len(sample))
+        books = np.zeros((self.m, 256, self.sub), dtype=np.float32)
+        for j in range(self.m):
+            x = sample[:, j * self.sub:(j + 1) * self.sub]
+            c = x[rng.choice(len(x), size=k, replace=False)].copy()
+            for _ in range(self.iterations):
+                labels = self._assign(x, c)
+                sums = np.zeros_like(c)
+                np.add.at(sums, labels, x)
+                counts = np.bincount(labels, minlength=k)
+                filled = counts > 0
+                c[filled] = sums[filled] / counts[filled, None]
+            books[j, :k] = c
+            if k < 256:
+                books[j, k:] = c[0]
+        self.codebooks = books
+        self.trained = True
+
+    @staticmethod
+    def _assign(x: np.ndarray, c: np.ndarray) -> np.ndarray:
+        # nearest centroid by L2: argmin |c|^2 - 2 x.c
+        return np.argmin(np.einsum("ij,ij->i", c, c)[None, :] - 2 * x @ c.T, axis=1)
+
+    def encode(self, vectors: np.ndarray) -> np.ndarray:
+        codes = np.empty((len(vectors), self.m), dtype=np.uint8)
+        for j in range(self.m):
+            codes[:, j] = self._assign(vectors[:, j * self.sub:(j + 1) * self.sub], self.codebooks[j])
+        return codes
+
+    def decode(self, codes: np.ndarray) -> np.ndarray:
+        return np.concatenate([self.codebooks[j][codes[:, j]] for j in range(self.m)], axis=1)
+
+    def scores(self, codes: np.ndarray, q: np.ndarray, metric: str) -> np.ndarray:
+        # asymmetric distance: one (m, 256) lookup table per query, then m table lookups per code
+        qs = q.reshape(self.m, 1, self.sub)
+        if metric == "L2":
+            diff = self.codebooks - qs
+            table = -np.einsum("mks,mks->mk", diff, diff)
+        else:
+            table = np.einsum("mks,mks->mk", self.codebooks, np.broadcast_to(qs, self.codebooks.shape))
+        return table[np.arange(self.m)[None, :], codes].sum(axis=1)
+
+    def memory_bytes(self) -> int:
+        return self.codebooks.nbytes if self.codebooks is not None else 0
+
+
+class BinaryCodec(Codec):
+    name = "binary"
+
+    def __init__(self, dim: int):
+        super().__init__(dim)
+        self.mean = np.zeros(dim, dtype=np.float32)
+
+    @property
+    def code_size(self) -> int:
+        return (self.dim + 7) // 8
+
+    def train(self, sample: np.ndarray):
+        # centering makes the sign bits balanced
+        self.mean = sample.mean(axis=0).astype(np.float32)
+        self.trained = True
+
+    def encode(self, vectors: np.ndarray) -> np.ndarray:
+        return np.packbits(vectors > self.mean, axis=1)
+
+    def decode(self, codes: np.ndarray) -> np.ndarray:
+        # only a direction: +-1 around the mean
+        return np.unpackbits(codes, axis=1)[:, : self.dim].astype(np.float32) * 2 - 1
+
+    def scores(self, codes: np.ndarray, q: np.ndarray, metric: str) -> np.ndarray:
+        qbits = self.encode(q.reshape(1, -1))[0]
+        hamming = POPCOUNT[np.bitwise_xor(codes, qbits)].sum(axis=1, dtype=np.int32)
+        # angle estimate from the share of differing bits (random-hyperplane LSH)
+        return np.cos(np.pi * hamming / self.dim).astype(np.float32)
+
+    def memory_bytes(self) -> int:
+        return self.mean.nbytes
+
+
+def make_codec(storage: str, dim: int, pq_m: int = 48) -> Codec | None:
+    """
+        None for "float"
+    """
+    storage = (storage or "float").lower()
+    if storage == "float":
+        return None
+    if storage == "sq8":
+        return SQ8Codec(dim)
+    if storage == "pq":
+        return PQCodec(dim, m=pq_m)
+    if storage == "binary":
+        return BinaryCodec(dim)
+    raise ValueError(f"Unknown vector_storage: {storage!r} (expected float, sq8, pq or binary)")
+
+
+# ---------- Milvus binary storage ----------
+def pack_sign_bits(vec) -> bytes:
+    """
+        BINARY_VECTOR value: one bit per dimension, set where the component is > 0
+    """
+    return np.packbits(np.asarray(vec, dtype=np.float32).reshape(-1) > 0).tobytes()
+
+
+def to_f16_b64(vec) -> str:
+    # full-precision copy kept next to a binary vector for the exact rerank (2 bytes per dimension)
+    return base64.b64encode(np.asarray(vec, dtype=np.float16).reshape(-1).tobytes()).decode("ascii")
+
+
+def from_f16_b64(s: str) -> np.ndarray:
+    return np.frombuffer(base64.b64decode(s), dtype=np.float16).astype(np.float32)
+
+
+def exact_scores(vectors: np.ndarray, q: np.ndarray, metric: str) -> np.ndarray:
+    """
+        Milvus-style scores: COSINE / IP similarity (higher is better), L2 squared distance (lower is better)
+    """
+    q = np.asarray(q, dtype=np.float32).reshape(-1)
+    if metric == "L2":
+        diff = vectors - q
+        return np.einsum("ij,ij->i", diff, diff)
+    if metric == "COSINE":
+        norms = np.linalg.norm(vectors, axis=1) * max(float(np.linalg.norm(q)), 1e-12)
+        return (vectors @ q) / np.maximum(norms, 1e-12)
+    return vectors @ q
@@ -1,8 +1,13 @@
 from src.llm.prompts import Prompts
-from sentence_transformers import SentenceTransformer
+from src.functions.embedding_model import create_embedding_model
+from src.functions.embedding_service import EmbeddingService
+from src.functions.embedding_cache import EmbeddingCache
+from src.tracing import span
 from src.llm.schemas import AMBIGUOUS_BOOL_SCHEMA, REWRITTEN_QUERY_SCHEMA
-from src.llm.schemas import CLARIFYING_QUESTIONS_SCHEMA
+from src.llm.schemas import CLARIFYING_QUESTIONS_SCHEMA, QUERY_UNDERSTANDING_SCHEMA
 import json
+import time
+import asyncio
 from typing import Dict, Any, List
 
 def _get(obj, key, default=None):
@@ -13,23 +18,57 @@ def _get(obj, key, default=None):
     return getattr(obj, key, default)
 
 class QueryUnderstanding:
-    def __init__(self, llm, config, session_db):
+    def __init__(self, llm, config, session_db, embedding_model=None):
         self.llm = llm 
         self.config = config 
-        self.embedding = SentenceTransformer('sentence-transformers/all-MiniLM-L6-v2')
+        self.model_name = config.get("embedding_model_name", 'sentence-transformers/all-MiniLM-L6-v2') if config else 'sentence-transformers/all-MiniLM-L6-v2'
+        # loaded on first use or by warmup(); any object with a SentenceTransformer-style encode() can be passed in
+        # embedding_backend picks the runtime: "torch" (SentenceTransformer) or "onnx" (int8 onnxruntime)
+        self.embedding = embedding_model or create_embedding_model(config)
+        self.embedding_service = EmbeddingService(self.embedding, config)
+        self.embedding_cache = EmbeddingCache(
+            getattr(self.embedding, "cache_name", self.model_name),
+            dim=config.get("embedding_dimension", 384) if config else 384,
+            max_entries=config.get("embedding_cache_size", 10000) if config else 10000,
+            disk_path=config.get("embedding_cache_path") if config else None,
+            disk_capacity=config.get("embedding_cache_disk_capacity", 100000) if config else 100000,
+            lowercase=config.get("embedding_uncased") if config else None,
+        )
+        self._inflight_embeddings: Dict[str, asyncio.Future] = {}
+
+        # semantic tier of the LLM result cache reuses the same (cached, batched) MiniLM embeddings
+        cache = getattr(self.llm, "cache", None)
+        if cache is not None and cache.embed_fn is None:
+            cache.embed_fn = self.aget_embedding
         self.session_db = session_db
+        # "multi": separate ambiguity / rewrite / clarifying calls, "fused": one structured call
+        self.mode = config.get("query_understanding_mode", "multi") if config else "multi"
     
-    def is_ambiguous(self, query: str) -> bool:
+    def warmup(self):
+        """
+            Load the embedding model and run one encode so the first real query doesn't pay for it
+        """
+        load = getattr(self.embedding, "load", None)
+        if load is not None:
+            load()
+        self.embedding.encode(["warmup"])
+
+    async def is_ambiguous(self, query: str) -> bool:
         messages = Prompts.ambiguous_bool(query)
-        out = self.llm.chat_structured(messages=messages, json_schema=AMBIGUOUS_BOOL_SCHEMA)
+        out = await self.llm.chat_structured(messages=messages, json_schema=AMBIGUOUS_BOOL_SCHEMA)
         print(out)
 
         
         return bool(out["is_ambiguous"])
     
-    def rewrite_query(self, query: str) -> str:
+    async def understand_query(self, query: str) -> dict:
+        messages = Prompts.fused_query_understanding(query)
+        out = await self.llm.chat_structured(messages=messages, json_schema=QUERY_UNDERSTANDING_SCHEMA)
+        return out
+
+    async def rewrite_query(self, query: str) -> str:
         prompt = Prompts.rewrite_query_messages(query)
-        response = self.llm.chat_structured(messages=prompt, json_schema=REWRITTEN_QUERY_SCHEMA)
+        response = await self.llm.chat_structured(messages=prompt, json_schema=REWRITTEN_QUERY_SCHEMA)
         return response["rewritten_query"]
     
     
@@ -60,8 +99,8 @@ class QueryUnderstanding:
         """
         Context augmentation = build a structured context object that can be injected into the LLM prompt
         """
-        # 1) Keep recent window small + stable shape
-        recent_messages = self._truncate_list(current_messages_window, max_n=8)
+        # 1) Keep recent window small + stable shape (newest turns; PromptPacker trims further to the token budget)
+        recent_messages = current_messages_window[-8:]
 
         # 2) Parse retrieved sessions (Milvus hits)
         retrieved_memories = []
@@ -69,12 +108,14 @@ class QueryUnderstanding:
         agg_key_facts = []
 
         for hit in (relevant_fields or [])[:3]:  # top-3 only (avoid prompt bloat)
-            # Depending on your Milvus result object, adjust these fields
-            pk = getattr(hit, "id", None) or getattr(hit, "pk", None) or ""
-            score = getattr(hit, "score", None)
+            # Milvus hit objects or SearchHit dicts from the local store
+            pk = _get(hit, "id", None) or _get(hit, "pk", None) or ""
+            score = _get(hit, "score", None)
+            if score is None:
+                score = _get(hit, "distance", None)
 
             # You store full_session_json in entity (based on your snippet)
-            entity = getattr(hit, "entity", None) or {}
+            entity = _get(hit, "entity", None) or {}
             full_json_str = entity.get("full_session_json", "{}")
             sess = self._safe_json_load(full_json_str, default={})
 
@@ -132,9 +173,9 @@ class QueryUnderstanding:
 
         return augmented_context
 
-    def clarifying_questions_generation(self, query: str) -> list:
+    async def clarifying_questions_generation(self, query: str) -> list:
         messages = Prompts.clarifying_questions_generation(query)
-        out = self.llm.chat_structured(messages=messages, json_schema=CLARIFYING_QUESTIONS_SCHEMA)
+        out = await self.llm.chat_structured(messages=messages, json_schema=CLARIFYING_QUESTIONS_SCHEMA)
         return out["questions"]
     
     def load_json(self, json_str: str) -> dict:
@@ -146,21 +187,121 @@ class QueryUnderstanding:
     
     
 
-    def analyze_query(self, query: str, current_messages_window: list) -> dict:
-        if self.is_ambiguous(query):
-            is_ambiguous = True
-            rewritten_query = self.rewrite_query(query)
+    async def _timed(self, timings: dict, stage: str, coro):
+        t0 = time.perf_counter()
+        try:
+            with span(f"query_understanding.{stage}"):
+                return await coro
+        finally:
+            timings[stage] = round((time.perf_counter() - t0) * 1000, 2)
+
+    async def _embed_and_retrieve(self, text: str, timings: dict, tenant: dict, prefix: str = ""):
+        embedding = await self._timed(timings, f"{prefix}embedding", self.aget_embedding(text))
+        return await self._timed(
+            timings, f"{prefix}retrieval",
+            asyncio.to_thread(self.session_db.retrieve_relevant_session_memory, embedding, top_k=self.config['topk'],
+                              query_text=text, **tenant),
+        )
+
+    async def retrieve(self, query: str, timings: dict, user_id: str | None = None, chat_id: str | None = None):
+        """
+            Embed + memory search for one query; the task can be handed to analyze_query as raw_retrieval
+        """
+        return await self._embed_and_retrieve(query, timings, {"user_id": user_id, "chat_id": chat_id})
+
+    async def _clarify(self, query: str, timings: dict, known_ambiguous: bool | None = None) -> list:
+        # reuse the first ambiguity verdict when the query was not rewritten
+        if known_ambiguous is None:
+            known_ambiguous = await self._timed(timings, "is_ambiguous_rewritten", self.is_ambiguous(query))
+        if not known_ambiguous:
+            return []
+        return await self._timed(timings, "clarifying_questions", self.clarifying_questions_generation(query))
+
+    async def _plan_multi(self, query: str, timings: dict, raw_retrieval: asyncio.Task, tenant: dict):
+        """
+            Execution plan (-> = depends on, || = concurrent):
+                is_ambiguous(query) || embed(query) -> retrieve
+                is_ambiguous -> rewrite_query (only if ambiguous)
+                rewritten != query: embed(rewritten) -> retrieve || is_ambiguous(rewritten) -> clarifying questions
+                rewritten == query: reuse raw retrieval and the first ambiguity verdict
+        """
+        is_ambiguous = await self._timed(timings, "is_ambiguous", self.is_ambiguous(query))
+        if is_ambiguous:
+            rewritten_query = await self._timed(timings, "rewrite_query", self.rewrite_query(query))
         else:
-            is_ambiguous = False
             rewritten_query = query
-        
+
         print("Rewritten query:", rewritten_query, flush = True)
-        embedding_rewritten_query = self.get_embedding(rewritten_query)
 
+        if rewritten_query == query:
+            relevant_session, clarifying_questions = await asyncio.gather(
+                raw_retrieval,
+                self._clarify(rewritten_query, timings, known_ambiguous=is_ambiguous),
+            )
+        else:
+            raw_retrieval.cancel()
+            relevant_session, clarifying_questions = await asyncio.gather(
+                self._embed_and_retrieve(rewritten_query, timings, tenant, prefix="rewritten_"),
+                self._clarify(rewritten_query, timings),
+            )
+        return is_ambiguous, rewritten_query, clarifying_questions, relevant_session
+
+    async def _plan_fused(self, query: str, timings: dict, raw_retrieval: asyncio.Task, tenant: dict):
+        """
+            understand_query(query) || embed(query) -> retrieve
+            rewritten != query: embed(rewritten) -> retrieve
+        """
+        out = await self._timed(timings, "understand_query", self.understand_query(query))
+        is_ambiguous = bool(out.get("is_ambiguous", False))
+        rewritten_query = (out.get("rewritten_query") or "").strip() if is_ambiguous else ""
+        rewritten_query = rewritten_query or query
+        clarifying_questions = (out.get("questions") or []) if is_ambiguous else []
+
+        print("Rewritten query:", rewritten_query, flush = True)
 
+        if rewritten_query == query:
+            relevant_session = await raw_retrieval
+        else:
+            raw_retrieval.cancel()
+            relevant_session = await self._embed_and_retrieve(rewritten_query, timings, tenant, prefix="rewritten_")
+        return is_ambiguous, rewritten_query, clarifying_questions, relevant_session
+
+    async def analyze_query(self, query: str, current_messages_window: list,
+                            user_id: str | None = None, chat_id: str | None = None,
+                            raw_retrieval: asyncio.Task | None = None, timings: dict | None = None) -> dict:
+        """
+            raw_retrieval: an already started retrieve(query) task (the speculative answer shares it)
+        """
+        timings = {} if timings is None else timings
+        t0 = time.perf_counter()
+
+        plan = self._plan_fused if self.mode == "fused" else self._plan_multi
+        # memory search is scoped to this user/chat (see memory_search_scope)
+        tenant = {"user_id": user_id, "chat_id": chat_id}
+        if raw_retrieval is None:
+            raw_retrieval = asyncio.create_task(self._embed_and_retrieve(query, timings, tenant))
+        try:
+            is_ambiguous, rewritten_query, clarifying_questions, relevant_session = await plan(query, timings, raw_retrieval, tenant)
+        finally:
+            if not raw_retrieval.done():
+                raw_retrieval.cancel()
+
+        msg = self._result(query, current_messages_window, is_ambiguous, rewritten_query, clarifying_questions,
+                           relevant_session, timings, t0)
+        print("Analyzed query info:", msg, flush=True)
+        return msg
+
+    def speculative_result(self, query: str, current_messages_window: list, relevant_session, timings: dict) -> dict:
+        """
+            What analyze_query returns for `query` if it turns out unambiguous (not rewritten), built from
+            the original query's retrieval alone - the answer prompt only depends on rewritten_query and
+            final_augmented_context, so an answer started from this is the one the full analysis would get
+        """
+        return self._result(query, current_messages_window, False, query, [], relevant_session, dict(timings), time.perf_counter())
+
+    def _result(self, query: str, current_messages_window: list, is_ambiguous: bool, rewritten_query: str,
+                clarifying_questions: list, relevant_session, timings: dict, t0: float) -> dict:
         # retrieve relevant context from session database
-        
-        relevant_session = self.session_db.retrieve_relevant_session_memory(embedding_rewritten_query, top_k=self.config['topk'])
         if relevant_session[0] != []:
             top1_session = relevant_session[0]
             full_session_json = _get(top1_session, "full_session_json", "{}")
@@ -172,13 +313,9 @@ class QueryUnderstanding:
             open_questions = []
         # augment context
         final_augmented_context = self.context_augmentation(current_messages_window, relevant_session[0])
-        # generate clarifying questions
 
-        if self.is_ambiguous(rewritten_query):
-            clarifying_questions = self.clarifying_questions_generation(rewritten_query)
-        else:
-            clarifying_questions = []
-        
+        timings["total"] = round((time.perf_counter() - t0) * 1000, 2)
+
         msg = {
             "original_query": query,
             "is_ambiguous": is_ambiguous,
@@ -186,13 +323,45 @@ class QueryUnderstanding:
             "needed_context_from_memory": [user_prefs,
             open_questions],
             "clarifying_questions": clarifying_questions,
-            "final_augmented_context": final_augmented_context
+            "final_augmented_context": final_augmented_context,
+            "stage_timings_ms": timings,
         }
 
-        print("Analyzed query info:", msg, flush=True)
-        
         return msg
 
     def get_embedding(self, text: str):
+        cached = self.embedding_cache.get(text)
+        if cached is not None:
+            return cached.reshape(1, -1)
         embedding = self.embedding.encode([text])
-        return embedding
\ No newline at end of file
+        self.embedding_cache.put(text, embedding[0])
+        return embedding
+
+    async def aget_embedding(self, text: str):
+        # batched with other sessions' requests; same (1, dim) shape as get_embedding
+        with span("embedding") as attrs:
+            cached = self.embedding_cache.get(text)
+            if cached is not None:
+                attrs["cache"] = "hit"
+                return cached.reshape(1, -1)
+
+            # identical texts already being encoded -> wait for that result instead of encoding twice
+            key = self.embedding_cache.key(text)
+            inflight = self._inflight_embeddings.get(key)
+            if inflight is not None:
+                attrs["cache"] = "inflight"
+                embedding = await asyncio.shield(inflight)
+                return embedding.reshape(1, -1)
+
+            attrs["cache"] = "miss"
+            task = asyncio.ensure_future(self.embedding_service.embed(text))
+            self._inflight_embeddings[key] = task
+            try:
+                embedding = await asyncio.shield(task)
+            finally:
+                if task.done():
+                    self._inflight_embeddings.pop(key, None)
+                else:
+                    task.add_done_callback(lambda _: self._inflight_embeddings.pop(key, None))
+            self.embedding_cache.put(text, embedding)
+            return embedding.reshape(1, -1)
\ No newline at end of file
@@ -1,17 +1,48 @@
+import asyncio
 import json
 import os 
 
+from src.functions.database import MAX_SESSION_JSON_LENGTH
 from src.llm.prompts import Prompts
 from src.llm.schemas import SESSION_SUMMARY_CONTENT_SCHEMA
 
+
+def bound_summary(result: dict, max_items: int, max_bytes: int = MAX_SESSION_JSON_LENGTH) -> dict:
+    """
+        Keep a summary storable (full_session_json / latest_summary_json columns): every list keeps its newest
+        `max_items` items, then the oldest item of the largest list is dropped until the JSON fits in max_bytes
+    """
+    ss = result["session_summary"]
+    profile = ss.get("user_profile") or {}
+    lists = [(ss, k) for k in ("key_facts", "decisions", "open_questions", "todos")] + [(profile, k) for k in ("prefs", "constraints")]
+    for parent, k in lists:
+        if len(parent.get(k) or []) > max_items:
+            parent[k] = parent[k][-max_items:]
+
+    def size(items) -> int:
+        return len(json.dumps(items, ensure_ascii=False).encode("utf-8"))
+
+    dropped = 0
+    while size(result) > max_bytes:
+        parent, k = max(lists, key=lambda pk: size(pk[0].get(pk[1]) or []))
+        if not parent.get(k):
+            break
+        parent[k] = parent[k][1:]
+        dropped += 1
+    if dropped:
+        print(f"[WARN] summary {ss.get('summary_idx')}: dropped {dropped} oldest item(s) to fit {max_bytes} bytes", flush=True)
+    return result
+
+
 class Summarization:
     def __init__(self, llm, config):
         self.llm = llm 
         self.chat_id = config['chat_id'] if config and 'chat_id' in config else "default_chat"
         self.config = config
         self.prompt = Prompts.summarization
+        self.max_items = (config or {}).get("summary_max_items", 12)
     
-    def _save(self, summary: dict, summary_idx: int):
+    def _save(self, summary: dict, summary_idx: int | str):
         os.makedirs(self.config["chat_history_path"], exist_ok=True)
         os.makedirs(os.path.join(self.config["chat_history_path"], f"{self.config['chat_id']}"), exist_ok=True)
         save_path = os.path.join(self.config["chat_history_path"], f"{self.config['chat_id']}", f"{summary_idx}_summary.json")
@@ -20,26 +51,64 @@ class Summarization:
         print(f"Saved session summary to {save_path}")
 
 
-    def summarize_session(self, chat_window: list, summary_idx: int) -> dict:
+    async def summarize_session(self, chat_window: list, summary_idx: int, previous_summary: dict | None = None) -> dict:
+        """
+            Summarize one closed window (a level-0 memory). With previous_summary (rolling mode) the new turns
+            are folded into it: profile / open questions / todos come back fully updated, key facts and
+            decisions only for the new turns - so consecutive memories don't overlap.
+        """
         start_idx = chat_window[0]["idx"]
         end_idx = chat_window[-1]["idx"]
 
-        messages = Prompts.summarization(chat_window)  # list messages
-        content = self.llm.chat_structured(messages, SESSION_SUMMARY_CONTENT_SCHEMA)
+        previous = (previous_summary or {}).get("session_summary")
+        if previous:
+            messages = Prompts.rolling_summarization(previous, chat_window)
+        else:
+            messages = Prompts.summarization(chat_window)  # list messages
+        content = await self.llm.chat_structured(messages, SESSION_SUMMARY_CONTENT_SCHEMA)
 
         result = {
             "session_summary": {
                 "session_id": self.chat_id,
                 "summary_idx": summary_idx,
+                "level": 0,
                 **content
             },
             "message_range_summarized": {"from": start_idx, "to": end_idx}
         }
 
+        result = bound_summary(result, self.max_items)
+
         print(f"Generated session summary for messages {start_idx} to {end_idx}")
         print(json.dumps(result, indent=4))
         
-        self._save(result, summary_idx)
+        await asyncio.to_thread(self._save, result, summary_idx)
+        return result
+
+    async def consolidate(self, summaries: list, level: int, first_summary_idx: int, last_summary_idx: int) -> dict:
+        """
+            Merge consecutive summaries (oldest first), covering summary_idx first..last, into one memory at `level`
+        """
+        messages = Prompts.consolidate_summaries([s.get("session_summary", {}) for s in summaries])
+        content = await self.llm.chat_structured(messages, SESSION_SUMMARY_CONTENT_SCHEMA)
+
+        result = {
+            "session_summary": {
+                "session_id": self.chat_id,
+                "summary_idx": last_summary_idx,
+                "level": level,
+                "summary_range": {"from": first_summary_idx, "to": last_summary_idx},
+                **content
+            },
+            "message_range_summarized": {
+                "from": summaries[0].get("message_range_summarized", {}).get("from"),
+                "to": summaries[-1].get("message_range_summarized", {}).get("to"),
+            }
+        }
+        result = bound_summary(result, self.max_items)
+        summary_range = result["session_summary"]["summary_range"]
+        print(f"Consolidated summaries {summary_range['from']}..{summary_range['to']} into level {level}")
+        await asyncio.to_thread(self._save, result, f"L{level}_{summary_range['from']}-{summary_range['to']}")
         return result
 
 
@@ -0,0 +1,148 @@
+# src/functions/sparse_encoder.py
+import json
+import math
+import os
+import re
+import threading
+import time
+import zlib
+
+# words plus identifiers glued by . - _ / : # @ (file names, ids, versions, emails, code symbols)
+TOKEN_RE = re.compile(r"\w+(?:[.\-/:#@]\w+)*")
+# Milvus sparse indices must be < 2^32 - 1
+MAX_TERM_ID = 0xFFFFFFFF
+
+
+def tokenize(text: str) -> list[str]:
+    """
+        Lower-cased words; an identifier like "user-42.json" is kept whole and also split into its parts
+    """
+    tokens = []
+    for tok in TOKEN_RE.findall(str(text or "").lower()):
+        tokens.append(tok)
+        if not tok.isalnum():
+            tokens.extend(p for p in re.split(r"[^\w]|_", tok) if p)
+    return tokens
+
+
+def term_id(token: str) -> int:
+    # crc32: stable across processes (unlike hash())
+    return zlib.crc32(token.encode("utf-8")) % MAX_TERM_ID
+
+
+class SparseEncoder:
+    """
+        BM25 as sparse vectors, so exact names / identifiers / code tokens can be matched by an inner product:
+        - document: term -> tf * (k1 + 1) / (tf + k1 * (1 - b + b * len / avgdl))
+        - query: term -> idf(term), from document frequencies counted as documents are encoded
+        IP(query, document) is then the document's BM25 score. Terms are hashed to int ids (no vocabulary).
+        Corpus statistics (doc count, total length, df) are kept in `stats_path`, local to the process: one
+        writer per file, saved at most every `save_interval` seconds while they change (maybe_save) and on
+        flush / close of the store.
+    """
+    def __init__(self, stats_path: str | None = None, k1: float = 1.2, b: float = 0.75, save_interval: float = 30.0):
+        self.stats_path = stats_path
+        self.k1 = k1
+        self.b = b
+        self.save_interval = save_interval
+        self._last_save = time.monotonic()
+        self.n_docs = 0
+        self.total_len = 0
+        self.df: dict[int, int] = {}
+        self._dirty = False
+        self._lock = threading.Lock()
+        self._load()
+
+    @classmethod
+    def from_config(cls, config: dict, default_dir: str) -> "SparseEncoder":
+        return cls(
+            stats_path=config.get("sparse_stats_path") or os.path.join(default_dir, "sparse_stats.json"),
+            k1=config.get("bm25_k1", 1.2),
+            b=config.get("bm25_b", 0.75),
+            save_interval=config.get("sparse_stats_save_interval", 30),
+        )
+
+    def _load(self):
+        if not self.stats_path or not os.path.exists(self.stats_path):
+            return
+        try:
+            with open(self.stats_path, "r", encoding="utf-8") as f:
+                stats = json.load(f)
+            self.n_docs = int(stats.get("n_docs", 0))
+            self.total_len = int(stats.get("total_len", 0))
+            self.df = {int(t): int(c) for t, c in stats.get("df", {}).items()}
+        except Exception as e:
+            print(f"[WARN] could not read sparse stats {self.stats_path}: {e}", flush=True)
+
+    def save(self):
+        if not self.stats_path or not self._dirty:
+            return
+        with self._lock:
+            stats = {"n_docs": self.n_docs, "total_len": self.total_len, "df": dict(self.df)}
+            self._dirty = False
+            self._last_save = time.monotonic()
+        os.makedirs(os.path.dirname(self.stats_path) or ".", exist_ok=True)
+        tmp = self.stats_path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(stats, f)
+        os.replace(tmp, self.stats_path)
+
+    def maybe_save(self):
+        """
+            save() if the stats changed and the last save is at least save_interval seconds old
+        """
+        if self._dirty and time.monotonic() - self._last_save >= self.save_interval:
+            self.save()
+
+    @staticmethod
+    def _term_counts(text: str) -> dict[int, int]:
+        counts = {}
+        for tok in tokenize(text):
+            t = term_id(tok)
+            counts[t] = counts.get(t, 0) + 1
+        return counts
+
+    def encode_document(self, text: str) -> dict[int, float]:
+        """
+            Sparse vector of a document being stored; also adds it to the corpus statistics
+        """
+        counts = self._term_counts(text)
+        length = sum(counts.values())
+        with self._lock:
+            self.n_docs += 1
+            self.total_len += length
+            for t in counts:
+                self.df[t] = self.df.get(t, 0) + 1
+            self._dirty = True
+            avgdl = self.total_len / self.n_docs if self.n_docs else 1.0
+        norm = self.k1 * (1 - self.b + self.b * length / max(avgdl, 1e-6))
+        return {t: tf * (self.k1 + 1) / (tf + norm) for t, tf in counts.items()}
+
+    def forget(self, sparse: dict):
+        """
+            Remove a deleted document (its stored sparse vector) from the statistics
+        """
+        if not sparse:
+            return
+        with self._lock:
+            avgdl = self.total_len / self.n_docs if self.n_docs else 0
+            self.n_docs = max(self.n_docs - 1, 0)
+            self.total_len = max(self.total_len - int(round(avgdl)), 0)
+            for t in sparse:
+                t = int(t)
+                c = self.df.get(t, 0) - 1
+                if c > 0:
+                    self.df[t] = c
+                else:
+                    self.df.pop(t, None)
+            self._dirty = True
+
+    def encode_query(self, text: str) -> dict[int, float]:
+        counts = self._term_counts(text)
+        with self._lock:
+            n = self.n_docs
+            # terms no stored document contains can't match anything - leave them out
+            return {
+                t: qtf * math.log(1 + (n - self.df[t] + 0.5) / (self.df[t] + 0.5))
+                for t, qtf in counts.items() if self.df.get(t)
+            }
@@ -0,0 +1,152 @@
+# src/llm/cache.py
+import copy
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+
+class StructuredCache:
+    """
+        Result cache for chat_structured, configured under `llm_cache`:
+        - exact tier: key = hash(model, schema name, messages), TTL + LRU size bound
+        - semantic tier (optional): for the same model/schema/system prompt, reuse a result whose
+          last user message embeds within `semantic_threshold` cosine similarity
+        Both tiers are enabled per schema name (`llm_cache.schemas.<name>.exact/semantic`).
+    """
+    def __init__(self, config: dict = None):
+        cfg = (config or {}).get("llm_cache", {}) or {}
+        self.enabled = cfg.get("enabled", False)
+        self.ttl = cfg.get("ttl_s", 3600)
+        self.max_entries = cfg.get("max_entries", 5000)
+        self.semantic_threshold = cfg.get("semantic_threshold", 0.95)
+        self.max_semantic_entries = cfg.get("max_semantic_entries", 1000)
+        self.schemas = cfg.get("schemas", {}) or {}
+
+        self.embed_fn = None  # async callable(text) -> vector, set by QueryUnderstanding
+        self.exact: OrderedDict[str, tuple[float, dict]] = OrderedDict()
+        # (model, schema, prompt prefix hash) -> list of [unit vector, value, expires]
+        self.semantic: dict[str, list] = {}
+        self._lock = threading.Lock()
+
+        self.exact_hits = 0
+        self.semantic_hits = 0
+        self.misses = 0
+
+    def _flags(self, schema_name: str) -> tuple[bool, bool]:
+        if not self.enabled:
+            return False, False
+        flags = self.schemas.get(schema_name, {}) or {}
+        return bool(flags.get("exact", False)), bool(flags.get("semantic", False))
+
+    @staticmethod
+    def _hash(obj) -> str:
+        return hashlib.sha256(json.dumps(obj, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+    def _exact_key(self, model: str, messages: list, json_schema: dict) -> str:
+        return self._hash([model, json_schema.get("name"), messages])
+
+    def _semantic_key(self, model: str, messages: list, json_schema: dict) -> str:
+        # everything except the text of the last user message must match exactly
+        return self._hash([model, json_schema.get("name"), messages[:-1], messages[-1].get("role")])
+
+    @staticmethod
+    def _unit(vec) -> np.ndarray:
+        vec = np.asarray(vec, dtype=np.float32).reshape(-1)
+        norm = np.linalg.norm(vec)
+        return vec / norm if norm > 0 else vec
+
+    # ---------- exact tier ----------
+    def _get_exact(self, model: str, messages: list, json_schema: dict):
+        key = self._exact_key(model, messages, json_schema)
+        now = time.monotonic()
+        with self._lock:
+            item = self.exact.get(key)
+            if item is not None:
+                expires, value = item
+                if expires > now:
+                    self.exact.move_to_end(key)
+                    self.exact_hits += 1
+                    return copy.deepcopy(value)
+                del self.exact[key]
+        return None
+
+    def get(self, model: str, messages: list, json_schema: dict):
+        use_exact, _ = self._flags(json_schema.get("name"))
+        if not use_exact:
+            return None
+        value = self._get_exact(model, messages, json_schema)
+        if value is None:
+            self.misses += 1
+        return value
+
+    def put(self, model: str, messages: list, json_schema: dict, value: dict):
+        use_exact, _ = self._flags(json_schema.get("name"))
+        if not use_exact:
+            return
+        key = self._exact_key(model, messages, json_schema)
+        with self._lock:
+            self.exact[key] = (time.monotonic() + self.ttl, copy.deepcopy(value))
+            self.exact.move_to_end(key)
+            while len(self.exact) > self.max_entries:
+                self.exact.popitem(last=False)
+
+    # ---------- exact + semantic tiers ----------
+    async def aget(self, model: str, messages: list, json_schema: dict):
+        """
+            Returns (value, tier, vector). `vector` is the query embedding computed for the semantic
+            tier (or None) and should be passed back to aput to avoid embedding twice.
+        """
+        use_exact, use_semantic = self._flags(json_schema.get("name"))
+        if not (use_exact or use_semantic):
+            return None, None, None
+
+        if use_exact:
+            value = self._get_exact(model, messages, json_schema)
+            if value is not None:
+                return value, "exact", None
+
+        if not use_semantic or self.embed_fn is None:
+            self.misses += 1
+            return None, None, None
+
+        vec = self._unit(await self.embed_fn(messages[-1].get("content", "")))
+        key = self._semantic_key(model, messages, json_schema)
+        now = time.monotonic()
+        with self._lock:
+            entries = [e for e in self.semantic.get(key, []) if e[2] > now]
+            self.semantic[key] = entries
+            if entries:
+                sims = np.stack([e[0] for e in entries]) @ vec
+                best = int(np.argmax(sims))
+                if sims[best] >= self.semantic_threshold:
+                    self.semantic_hits += 1
+                    return copy.deepcopy(entries[best][1]), "semantic", vec
+        self.misses += 1
+        return None, None, vec
+
+    async def aput(self, model: str, messages: list, json_schema: dict, value: dict, vec=None):
+        self.put(model, messages, json_schema, value)
+        _, use_semantic = self._flags(json_schema.get("name"))
+        if not use_semantic or self.embed_fn is None:
+            return
+        if vec is None:
+            vec = self._unit(await self.embed_fn(messages[-1].get("content", "")))
+        key = self._semantic_key(model, messages, json_schema)
+        with self._lock:
+            entries = self.semantic.setdefault(key, [])
+            entries.append([vec, copy.deepcopy(value), time.monotonic() + self.ttl])
+            if len(entries) > self.max_semantic_entries:
+                del entries[: len(entries) - self.max_semantic_entries]
+
+    def stats(self) -> dict:
+        return {
+            "exact_hits": self.exact_hits,
+            "semantic_hits": self.semantic_hits,
+            "misses": self.misses,
+            "exact_entries": len(self.exact),
+            "semantic_entries": sum(len(v) for v in self.semantic.values()),
+        }
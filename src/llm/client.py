@@ -1,21 +1,81 @@
 # src/llm/client.py
 import os
-from groq import Groq
+import time
+import asyncio
+import httpx
+from types import SimpleNamespace
+from groq import Groq, AsyncGroq
 from src.llm.prompts import Prompts
+from src.llm.rate_limit import TokenBucket
+from src.llm.cache import StructuredCache
+from src.llm.tokens import TokenCounter
+from src.llm.prompt_packer import PromptPacker
+from src.tracing import span, usage_attrs
 
 import json 
 from typing import Dict, Any, List
 
+
+# ---------- structured output (shared by GroqClient / AsyncGroqClient) ----------
+def json_contract(messages: List[Dict[str, str]]) -> List[Dict[str, str]]:
+    contract = {
+        "role": "system",
+        "content": "Return ONLY valid JSON that matches the provided schema. No extra keys, no text."
+    }
+    return [contract, *messages]
+
+
+def structured_requests(config: dict | None, max_retries: int, model: str, messages: list, json_schema: dict):
+    """
+        (attempt, mode, create kwargs) of the structured-output retry loop: `max_retries` strict
+        json_schema attempts, then one json_object fallback
+    """
+    common = dict(
+        model=model,
+        temperature=config['chatbot_temperature'] if config else 0.0,
+        max_completion_tokens=config.get("max_completion_tokens", 256) if config else 256,
+    )
+    for attempt in range(max_retries):
+        yield attempt, "json_schema", dict(
+            common, messages=messages, response_format={"type": "json_schema", "json_schema": json_schema},
+        )
+    yield max_retries, "json_object", dict(
+        common,
+        messages=messages + [{"role": "user", "content": "Output JSON object only."}],
+        response_format={"type": "json_object"},
+    )
+
+
+def parse_structured(completion) -> Dict[str, Any]:
+    parsed = completion.choices[0].message.content
+    # IMPORTANT: parsed thường là dict rồi. Không json.loads.
+    if isinstance(parsed, dict):
+        return parsed
+    # đôi khi SDK trả string JSON -> parse
+    if isinstance(parsed, str):
+        return json.loads(parsed)
+    raise TypeError(f"Unexpected parsed type: {type(parsed)}")
+
+
+def structured_error(errors: dict) -> RuntimeError:
+    return RuntimeError(f"Structured output failed. Last strict err={errors.get('json_schema')}, fallback err={errors.get('json_object')}")
+
+
 class GroqClient:
-    def __init__(self, config: dict = None):
-        api_key = os.getenv("GROQ_API_KEY")
-        if not api_key:
-            raise RuntimeError(
-                "Missing GROQ_API_KEY. Put it in .env or export GROQ_API_KEY=..."
-            )
-        self.client = Groq(api_key=api_key)
+    def __init__(self, config: dict = None, client=None):
+        # client: anything exposing chat.completions.create like groq.Groq (e.g. src/bench/fakes.py)
+        if client is None:
+            api_key = os.getenv("GROQ_API_KEY")
+            if not api_key:
+                raise RuntimeError(
+                    "Missing GROQ_API_KEY. Put it in .env or export GROQ_API_KEY=..."
+                )
+            client = Groq(api_key=api_key)
+        self.client = client
         self.config = config
         self.max_retries = self.config.get("groq_max_retries", 3) if self.config else 2
+        self.cache = StructuredCache(config)
+        self.prompt_packer = PromptPacker(TokenCounter(config), config)
 
     def chat(self, user_text: str) -> str:
         resp = self.client.chat.completions.create(
@@ -37,7 +97,7 @@ class GroqClient:
     
     def query_understanding(self, messages: List[Dict[str, str]]) -> Dict[str, Any]: 
 
-        messages = Prompts.get_answer_generation_messages(messages)
+        messages, pack_report = self.prompt_packer.pack(messages)
         resp = self.client.chat.completions.create(
             model=self.config['model_name'] if self.config else "meta-llama/llama-4-scout-17b-16e-instruct",
             messages=messages,
@@ -49,74 +109,262 @@ class GroqClient:
             "role": resp.choices[0].message.role,
             "content": resp.choices[0].message.content,
             "usage": resp.usage,
+            "prompt_pack": pack_report,
         }
         return return_msg
     
-    def _ensure_json_contract(self, messages: List[Dict[str, str]]) -> List[Dict[str, str]]:
-        contract = {
-            "role": "system",
-            "content": "Return ONLY valid JSON that matches the provided schema. No extra keys, no text."
-        }
-        return [contract, *messages]
-
     def chat_structured(self, messages, json_schema) -> Dict[str, Any]:
-        messages = self._ensure_json_contract(messages)
+        messages = json_contract(messages)
         model = self.config["model_name"] if self.config else "meta-llama/llama-4-scout-17b-16e-instruct"
 
-        last_err = None
+        with span("llm.chat_structured", schema=json_schema.get("name")) as attrs:
+            cached = self.cache.get(model, messages, json_schema)
+            if cached is not None:
+                attrs["cache"] = "exact"
+                return cached
+            attrs["cache"] = "miss"
+            out = self._chat_structured(model, messages, json_schema, attrs)
+            self.cache.put(model, messages, json_schema, out)
+            return out
 
-        # --- 1) strict json_schema path ---
-        for attempt in range(self.max_retries):
+    def _chat_structured(self, model, messages, json_schema, attrs: dict) -> Dict[str, Any]:
+        errors = {}
+        for attempt, mode, kwargs in structured_requests(self.config, self.max_retries, model, messages, json_schema):
+            attrs["retries"] = attempt
             try:
-                completion = self.client.chat.completions.create(
-                    model=model,
-                    messages=messages,
-                    response_format={"type": "json_schema", "json_schema": json_schema},
-                    temperature=self.config['chatbot_temperature'] if self.config else 0.0,
-                    max_completion_tokens=self.config.get("max_completion_tokens", 256) if self.config else 256,
+                with span("llm.structured_attempt", schema=json_schema.get("name"), attempt=attempt, mode=mode) as attempt_attrs:
+                    completion = self.client.chat.completions.create(**kwargs)
+                    attempt_attrs.update(usage_attrs(completion.usage))
+                return parse_structured(completion)
+            except Exception as e:
+                errors[mode] = e
+        raise structured_error(errors) from errors.get("json_object")
+
+
+class AsyncGroqClient:
+    """
+        asyncio-native counterpart of GroqClient.
+        One instance is meant to be shared by every session in the process: it keeps a keep-alive
+        HTTP pool warm, bounds in-flight requests with a semaphore and paces requests/tokens with
+        token buckets so that many sessions overlapping their calls don't trigger provider 429s.
+    """
+    def __init__(self, config: dict = None, client=None):
+        self.config = config
+        self.max_retries = self.config.get("groq_max_retries", 3) if self.config else 2
+        cfg = config or {}
+
+        # client: anything exposing an async chat.completions.create like groq.AsyncGroq (e.g. src/bench/fakes.py)
+        self.http_client = None
+        if client is None:
+            api_key = os.getenv("GROQ_API_KEY")
+            if not api_key:
+                raise RuntimeError(
+                    "Missing GROQ_API_KEY. Put it in .env or export GROQ_API_KEY=..."
                 )
+            self.http_client = httpx.AsyncClient(
+                limits=httpx.Limits(
+                    max_connections=cfg.get("groq_max_connections", 100),
+                    max_keepalive_connections=cfg.get("groq_max_keepalive_connections", 20),
+                    keepalive_expiry=cfg.get("groq_keepalive_expiry", 60),
+                ),
+                timeout=httpx.Timeout(cfg.get("groq_timeout", 60)),
+            )
+            client = AsyncGroq(api_key=api_key, http_client=self.http_client)
+        self.client = client
 
-                parsed = completion.choices[0].message.content
+        self.cache = StructuredCache(config)
+        # shared by all sessions: calibrated against every response's usage.prompt_tokens
+        self.token_counter = TokenCounter(config)
+        self.prompt_packer = PromptPacker(self.token_counter, config)
+        self.semaphore = asyncio.Semaphore(cfg.get("groq_max_concurrency", 32))
+        rpm = cfg.get("groq_requests_per_minute")
+        tpm = cfg.get("groq_tokens_per_minute")
+        self.request_bucket = TokenBucket(rpm) if rpm else None
+        self.token_bucket = TokenBucket(tpm) if tpm else None
 
-                # IMPORTANT: parsed thường là dict rồi. Không json.loads.
-                if isinstance(parsed, dict):
-                    return parsed
+    async def _reserve(self, kwargs: dict) -> tuple[int, int]:
+        """
+            Returns (reserved tokens, raw prompt token count); pass both back to _settle
+        """
+        prompt_tokens = self.token_counter.count_messages(kwargs["messages"])
+        estimate = self.token_counter.scaled(prompt_tokens) + kwargs.get("max_completion_tokens", 0)
+        if self.request_bucket:
+            await self.request_bucket.acquire(1)
+        if self.token_bucket:
+            await self.token_bucket.acquire(estimate)
+        return estimate, prompt_tokens
 
-                # đôi khi SDK trả string JSON -> parse
-                if isinstance(parsed, str):
-                    return json.loads(parsed)
+    def _settle(self, reservation: tuple[int, int], usage):
+        estimate, prompt_tokens = reservation
+        if usage is not None:
+            self.token_counter.calibrate(prompt_tokens, getattr(usage, "prompt_tokens", None))
+        if self.token_bucket and usage is not None:
+            diff = usage.total_tokens - estimate
+            if diff > 0:
+                self.token_bucket.debit(diff)
+            else:
+                self.token_bucket.credit(-diff)
 
-                raise TypeError(f"Unexpected parsed type: {type(parsed)}")
+    async def _create(self, **kwargs):
+        reservation = await self._reserve(kwargs)
+        async with self.semaphore:
+            resp = await self.client.chat.completions.create(**kwargs)
+        self._settle(reservation, getattr(resp, "usage", None))
+        return resp
 
-            except Exception as e:
-                last_err = e
-
-        # --- 2) fallback json_object + normalize + validate ---
-        try:
-            completion = self.client.chat.completions.create(
-                model=model,
-                messages=messages + [{
-                    "role": "user",
-                    "content": "Output JSON object only."
-                }],
-                response_format={"type": "json_object"},
-                temperature=self.config['chatbot_temperature'] if self.config else 0.0,
-                max_completion_tokens=self.config.get("max_completion_tokens", 256) if self.config else 256,
+    async def chat(self, user_text: str) -> Dict[str, Any]:
+        resp = await self._create(
+            model=self.config['model_name'] if self.config else "meta-llama/llama-4-scout-17b-16e-instruct",
+            messages=[
+                {"role": "system", "content": Prompts.SYSTEM},
+                {"role": "user", "content": user_text},
+            ],
+            temperature=self.config['chatbot_temperature'] if self.config else 0.7,
+            max_completion_tokens=self.config['max_completion_tokens'] if self.config else 512,
+        )
+
+        return_msg = {
+            "role": resp.choices[0].message.role,
+            "content": resp.choices[0].message.content,
+            "usage": resp.usage,
+        }
+        return return_msg
+
+    async def query_understanding(self, messages: List[Dict[str, str]]) -> Dict[str, Any]:
+        messages, pack_report = self.prompt_packer.pack(messages)
+        with span("llm.answer") as attrs:
+            resp = await self._create(
+                model=self.config['model_name'] if self.config else "meta-llama/llama-4-scout-17b-16e-instruct",
+                messages=messages,
+                temperature=self.config['chatbot_temperature'] if self.config else 0.7,
+                max_completion_tokens=self.config['max_completion_tokens'] if self.config else 512,
             )
-            raw = completion.choices[0].message.content
-            obj = json.loads(raw)
+            attrs.update(usage_attrs(resp.usage))
+
+        return_msg = {
+            "role": resp.choices[0].message.role,
+            "content": resp.choices[0].message.content,
+            "usage": resp.usage,
+            "prompt_pack": pack_report,
+        }
+        return return_msg
+
+    def stream_query_understanding(self, messages: Dict[str, Any]) -> "AnswerStream":
+        """
+            Same as query_understanding but with stream=True: iterate the result for tokens,
+            then read .message (role/content/usage) once the stream is exhausted.
+        """
+        messages, pack_report = self.prompt_packer.pack(messages)
+        kwargs = dict(
+            model=self.config['model_name'] if self.config else "meta-llama/llama-4-scout-17b-16e-instruct",
+            messages=messages,
+            temperature=self.config['chatbot_temperature'] if self.config else 0.7,
+            max_completion_tokens=self.config['max_completion_tokens'] if self.config else 512,
+            stream=True,
+        )
+        return AnswerStream(self, kwargs, pack_report)
 
-            return obj
+    async def chat_structured(self, messages, json_schema) -> Dict[str, Any]:
+        messages = json_contract(messages)
+        model = self.config["model_name"] if self.config else "meta-llama/llama-4-scout-17b-16e-instruct"
 
-        except Exception as e:
-            raise RuntimeError(f"Structured output failed. Last strict err={last_err}, fallback err={e}") from e
+        with span("llm.chat_structured", schema=json_schema.get("name")) as attrs:
+            cached, tier, vec = await self.cache.aget(model, messages, json_schema)
+            if cached is not None:
+                attrs["cache"] = tier
+                return cached
+            attrs["cache"] = "miss"
+            out = await self._chat_structured(model, messages, json_schema, attrs)
+            await self.cache.aput(model, messages, json_schema, out, vec=vec)
+            return out
 
-        
-    
-    
+    async def _chat_structured(self, model, messages, json_schema, attrs: dict) -> Dict[str, Any]:
+        errors = {}
+        for attempt, mode, kwargs in structured_requests(self.config, self.max_retries, model, messages, json_schema):
+            attrs["retries"] = attempt
+            try:
+                with span("llm.structured_attempt", schema=json_schema.get("name"), attempt=attempt, mode=mode) as attempt_attrs:
+                    completion = await self._create(**kwargs)
+                    attempt_attrs.update(usage_attrs(completion.usage))
+                return parse_structured(completion)
+            except Exception as e:
+                errors[mode] = e
+        raise structured_error(errors) from errors.get("json_object")
 
+    async def close(self):
+        if self.http_client is not None:
+            await self.http_client.aclose()
 
-    
 
+class AnswerStream:
+    """
+        Async iterator over the tokens of one streamed completion.
+        The concurrency slot is held for the whole stream, not just until the response headers.
+    """
+    def __init__(self, client: AsyncGroqClient, kwargs: dict, pack_report: dict | None = None):
+        self.client = client
+        self.kwargs = kwargs
+        self.pack_report = pack_report
+        self.role = "assistant"
+        self.parts: List[str] = []
+        self.usage = None
 
-    
+    def __aiter__(self):
+        return self._iter()
+
+    async def _iter(self):
+        with span("llm.answer") as attrs:
+            t0 = time.perf_counter()
+            reservation = await self.client._reserve(self.kwargs)
+            attrs["queue_ms"] = round((time.perf_counter() - t0) * 1000, 3)
+            finished = False
+            try:
+                async with self.client.semaphore:
+                    stream = await self.client.client.chat.completions.create(**self.kwargs)
+                    async for chunk in stream:
+                        # groq reports usage on the last chunk under x_groq
+                        usage = getattr(chunk, "usage", None) or getattr(getattr(chunk, "x_groq", None), "usage", None)
+                        if usage is not None:
+                            self.usage = usage
+                        if not chunk.choices:
+                            continue
+                        delta = chunk.choices[0].delta
+                        if getattr(delta, "role", None):
+                            self.role = delta.role
+                        token = getattr(delta, "content", None)
+                        if token:
+                            if not self.parts:
+                                attrs["ttft_ms"] = round((time.perf_counter() - t0) * 1000, 3)
+                            self.parts.append(token)
+                            yield token
+                finished = True
+            finally:
+                if finished:
+                    self._settle_usage(reservation)
+                    attrs.update(usage_attrs(self.usage))
+                else:
+                    self._settle_aborted(reservation)
+
+    def _settle_usage(self, reservation: tuple[int, int]):
+        if self.usage is None:
+            # no usage reported -> approximate with the number of streamed chunks
+            n = len(self.parts)
+            self.usage = SimpleNamespace(prompt_tokens=0, completion_tokens=n, total_tokens=n)
+        self.client._settle(reservation, self.usage)
+
+    def _settle_aborted(self, reservation: tuple[int, int]):
+        # cancelled / failed mid-stream (e.g. a discarded speculative answer): the prompt was sent,
+        # only the tokens streamed so far were generated
+        _, prompt_tokens = reservation
+        n = len(self.parts)
+        prompt = self.client.token_counter.scaled(prompt_tokens)
+        self.client._settle(reservation, SimpleNamespace(prompt_tokens=None, completion_tokens=n, total_tokens=prompt + n))
+
+    @property
+    def message(self) -> Dict[str, Any]:
+        return {
+            "role": self.role,
+            "content": "".join(self.parts),
+            "usage": self.usage,
+            "prompt_pack": self.pack_report,
+        }
@@ -0,0 +1,112 @@
+# src/llm/prompt_packer.py
+from src.llm.prompts import Prompts
+from src.llm.tokens import TokenCounter
+from src.tracing import span
+
+
+class PromptPacker:
+    """
+        Builds the answer-generation prompt within `prompt_token_budget` tokens.
+        The budget is filled by priority:
+            1. the (rewritten) user query - always kept
+            2. recent turns, newest first (a turn that doesn't fit ends the window)
+            3. user preferences and constraints
+            4. key facts of retrieved sessions, best-ranked hit first
+            5. open questions
+        The window is rendered as plain "user: ... / assistant: ..." lines instead of message dicts.
+        Every pack returns a report of what was kept/dropped (also recorded on the prompt.pack span).
+    """
+    def __init__(self, token_counter: TokenCounter, config: dict = None):
+        cfg = config or {}
+        self.counter = token_counter
+        self.budget = cfg.get("prompt_token_budget", 2000)
+        self._scaffold_tokens = None
+
+    def _scaffold(self) -> int:
+        # system prompt + headings + instructions, independent of the content
+        if self._scaffold_tokens is None:
+            self._scaffold_tokens = self.counter.count_messages(Prompts.packed_answer_generation_messages("", "", ""))
+        return self._scaffold_tokens
+
+    @staticmethod
+    def render_turn(msg: dict) -> str:
+        return f"user: {msg.get('user', {}).get('content', '')}\nassistant: {msg.get('assistant', {}).get('content', '')}"
+
+    @staticmethod
+    def _ranked_facts(retrieved_memories: list) -> list:
+        # hits come back best-first from the store; keep that order, drop duplicates
+        seen, facts = set(), []
+        for mem in retrieved_memories:
+            for fact in mem.get("key_facts", []) or []:
+                fact = str(fact).strip()
+                if fact and fact not in seen:
+                    seen.add(fact)
+                    facts.append(fact)
+        return facts
+
+    def pack(self, context_json: dict) -> tuple[list, dict]:
+        """
+            Returns (messages, report)
+        """
+        with span("prompt.pack") as attrs:
+            query = context_json.get("rewritten_query", "") or ""
+            ca = context_json.get("final_augmented_context", {}) or {}
+            recent = ca.get("recent_messages", []) or []
+            signals = ca.get("memory_signals", {}) or {}
+            facts = self._ranked_facts(ca.get("retrieved_memories", []) or [])
+
+            # budget is in real (calibrated) tokens, counts are raw tokenizer tokens
+            budget = self.budget / self.counter.scale if self.counter.scale > 0 else self.budget
+            used = self._scaffold() + self.counter.count(query)
+            report = {"budget": self.budget}
+
+            # recent turns, newest first
+            turns, turn_tokens = [], 0
+            for msg in reversed(recent):
+                tokens = self.counter.message_tokens(msg)
+                if used + tokens > budget:
+                    break
+                used += tokens
+                turn_tokens += tokens
+                turns.append(msg)
+            turns.reverse()
+            report["turns_included"] = len(turns)
+            report["turns_dropped"] = len(recent) - len(turns)
+
+            # memory sections, in priority order
+            sections = []
+            for key, title, items in (
+                ("prefs", "User preferences", signals.get("user_prefs", []) or []),
+                ("constraints", "User constraints", signals.get("user_constraints", []) or []),
+                ("facts", "Relevant memory facts", facts),
+                ("open_questions", "Open questions", signals.get("open_questions", []) or []),
+            ):
+                kept = []
+                header_tokens = self.counter.count(title + ":") + 1
+                for item in items:
+                    tokens = self.counter.count(f"- {item}") + 1 + (0 if kept else header_tokens)
+                    if used + tokens > budget:
+                        continue
+                    used += tokens
+                    kept.append(str(item))
+                if kept:
+                    sections.append(f"{title}:\n- " + "\n- ".join(kept))
+                report[f"{key}_included"] = len(kept)
+                report[f"{key}_dropped"] = len(items) - len(kept)
+
+            messages = Prompts.packed_answer_generation_messages(
+                query,
+                "\n\n".join(sections),
+                "\n".join(self.render_turn(m) for m in turns),
+            )
+            report["used"] = self.counter.scaled(used)
+            # everything but the window: scaffold, query, memory
+            report["fixed"] = self.counter.scaled(used - turn_tokens)
+            report["over_budget"] = used > budget
+            attrs.update(report)
+
+        dropped = {k[: -len("_dropped")]: v for k, v in report.items() if k.endswith("_dropped") and v}
+        if dropped or report["over_budget"]:
+            print(f"[prompt] packed {report['used']}/{self.budget} tokens, dropped {dropped or 'nothing'}"
+                  + (" (query alone exceeds the budget)" if report["over_budget"] else ""), flush=True)
+        return messages, report
@@ -1,3 +1,5 @@
+import json
+
 
 class Prompts:
     SYSTEM = "You are a helpful assistant."
@@ -26,6 +28,63 @@ class Prompts:
         ]
 
 
+    @staticmethod
+    def rolling_summarization(previous_summary: dict, chat_history: list) -> list:
+        """
+            Fold new turns into the previous summary; the prompt holds one summary + one window, never the whole chat
+        """
+        system = (
+            "You are a summarization engine for a chat memory system.\n"
+            "You receive the PREVIOUS summary of this chat and the NEW turns since then.\n"
+            "Return ONLY valid JSON matching the provided schema. No markdown, no extra text.\n"
+            "Do NOT invent facts. Only extract what is explicitly stated.\n"
+            "If a field has no data, return an empty list.\n\n"
+            "Rules:\n"
+            "- prefs/constraints/open_questions/todos: return the full UPDATED lists - keep previous items that still hold,\n"
+            "  drop items the new turns resolved or contradicted, add new ones.\n"
+            "- key_facts/decisions: ONLY new items from the new turns; do not repeat previous ones.\n"
+            "- Keep lists concise (max ~8 items each).\n"
+        )
+
+        previous = {k: previous_summary.get(k, []) for k in ("user_profile", "key_facts", "decisions", "open_questions", "todos")}
+        user_content = "Previous summary:\n" + json.dumps(previous, ensure_ascii=False) + "\n\nNew chat transcript:\n"
+        for msg in chat_history:
+            user_content += f"user: {msg['user']['content']}\n"
+            user_content += f"assistant: {msg['assistant']['content']}\n"
+
+        return [
+            {"role": "system", "content": system},
+            {"role": "user", "content": user_content},
+        ]
+
+    @staticmethod
+    def consolidate_summaries(summaries: list) -> list:
+        """
+            Summary-of-summaries: merge consecutive summaries of one chat into one condensed memory
+        """
+        system = (
+            "You are a summarization engine for a chat memory system.\n"
+            "You receive consecutive summaries of ONE chat, oldest first. Merge them into a single condensed summary.\n"
+            "Return ONLY valid JSON matching the provided schema. No markdown, no extra text.\n"
+            "Do NOT invent facts. Only keep what the summaries state.\n\n"
+            "Rules:\n"
+            "- Deduplicate; when summaries disagree, the later one wins.\n"
+            "- prefs/constraints: keep only those still valid at the end.\n"
+            "- open_questions/todos: drop the ones answered or done later.\n"
+            "- key_facts/decisions: keep the most important, specific ones.\n"
+            "- Keep lists concise (max ~10 items each).\n"
+        )
+
+        user_content = ""
+        for i, summary in enumerate(summaries):
+            content = {k: summary.get(k, []) for k in ("user_profile", "key_facts", "decisions", "open_questions", "todos")}
+            user_content += f"Summary {i + 1}:\n{json.dumps(content, ensure_ascii=False)}\n\n"
+
+        return [
+            {"role": "system", "content": system},
+            {"role": "user", "content": user_content.strip()},
+        ]
+
     @staticmethod
     def ambiguous_bool(query: str) -> list:
         return [
@@ -68,27 +127,35 @@ class Prompts:
     
 
     @staticmethod
-    def get_answer_generation_messages(context_json: dict) -> list:
-        query = context_json.get("rewritten_query", "")
-        ca = context_json.get("final_augmented_context", {}) or {}
-        recent_messages = ca.get("recent_messages", []) or []
-        context_text = ca.get("context_text", "") or ""
-
-        # Render recent messages compact
-        recent_block = recent_messages
-        
-
+    def fused_query_understanding(query: str) -> list:
         system = (
-            "You are an assistant answering the user's query using ONLY the provided context.\n"
-            "You must be faithful to the context and avoid hallucinations.\n\n"
-            
+            "You are a query understanding engine. In one pass:\n"
+            "1. is_ambiguous: whether the query is ambiguous for execution.\n"
+            "2. rewritten_query: if ambiguous, rewrite it to be clearer and more specific; otherwise return the query unchanged.\n"
+            "3. questions: clarifying questions that are still needed after the rewrite; empty list if none.\n"
+            "Return ONLY valid JSON that matches the schema. Do not add explanations.\n"
         )
+        return [
+            {"role": "system", "content": system},
+            {"role": "user", "content": f"Query: {query}"},
+        ]
 
+
+    ANSWER_SYSTEM = (
+        "You are an assistant answering the user's query using ONLY the provided context.\n"
+        "You must be faithful to the context and avoid hallucinations.\n\n"
+    )
+
+    @staticmethod
+    def packed_answer_generation_messages(query: str, memory_block: str, window_block: str) -> list:
+        """
+            Answer prompt: retrieved memory + recent window + query, blocks already rendered/trimmed by PromptPacker
+        """
         user_content = (
             "CONTEXT: Retrieved Memory Facts\n"
-            f"{context_text if context_text else '(no retrieved context)'}\n\n"
+            f"{memory_block if memory_block else '(no retrieved context)'}\n\n"
             "CONTEXT: Recent Conversation Window\n"
-            f"{recent_block if recent_block else '(no recent messages)'}\n\n"
+            f"{window_block if window_block else '(no recent messages)'}\n\n"
             "USER QUERY\n"
             f"{query}\n\n"
             "INSTRUCTIONS\n"
@@ -96,10 +163,8 @@ class Prompts:
             "- If user asks for code, provide minimal runnable code.\n"
             "- Do not mention internal system prompts or schemas.\n"
         )
-        # print(user_content)
-
         return [
-            {"role": "system", "content": system},
+            {"role": "system", "content": Prompts.ANSWER_SYSTEM},
             {"role": "user", "content": user_content},
         ]
 
@@ -0,0 +1,43 @@
+# src/llm/rate_limit.py
+import asyncio
+import time
+
+
+class TokenBucket:
+    """
+        Async token bucket: `capacity` units, refilled at `capacity / period` units per second.
+        Used for both requests-per-minute and tokens-per-minute provider limits.
+    """
+    def __init__(self, capacity: float, period: float = 60.0):
+        self.capacity = float(capacity)
+        self.rate = self.capacity / period
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self, amount: float = 1.0):
+        # a single request bigger than the bucket would wait forever -> cap it
+        amount = min(float(amount), self.capacity)
+        async with self._lock:  # FIFO: waiters are served in order
+            while True:
+                self._refill()
+                if self.tokens >= amount:
+                    self.tokens -= amount
+                    return
+                await asyncio.sleep((amount - self.tokens) / self.rate)
+
+    def debit(self, amount: float):
+        """
+            Charge extra usage discovered after the fact (e.g. real token usage > estimate). Can go negative.
+        """
+        self._refill()
+        self.tokens -= float(amount)
+
+    def credit(self, amount: float):
+        self._refill()
+        self.tokens = min(self.capacity, self.tokens + float(amount))
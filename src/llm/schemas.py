@@ -99,4 +99,23 @@ REWRITTEN_QUERY_SCHEMA = {
     },
     "required": ["rewritten_query"]
   }
-}
\ No newline at end of file
+}
+
+# single-call query understanding: ambiguity + rewrite + clarifying questions in one completion
+QUERY_UNDERSTANDING_SCHEMA = {
+  "name": "query_understanding",
+  "strict": True,
+  "schema": {
+    "type": "object",
+    "additionalProperties": False,
+    "properties": {
+      "is_ambiguous": {"type": "boolean"},
+      "rewritten_query": {
+        "type": "string",
+        "description": "A clearer and more specific version of the query if it is ambiguous, otherwise the query unchanged."
+      },
+      "questions": CLARIFYING_QUESTIONS_SCHEMA["schema"]["properties"]["questions"]
+    },
+    "required": ["is_ambiguous", "rewritten_query", "questions"]
+  }
+}
@@ -0,0 +1,90 @@
+# src/llm/tokens.py
+import threading
+
+# role / separator tokens the chat template adds around every message
+MESSAGE_OVERHEAD = 4
+# tokens that prime the assistant reply
+REPLY_PRIMING = 3
+
+
+class TokenCounter:
+    """
+        Token accounting for prompts and the context window.
+        Tokenizer, first one available:
+            - `tokenizer_path`: a local tokenizer.json (HF tokenizers BPE, e.g. the model's own) - works offline
+            - `tokenizer_encoding`: a tiktoken encoding (default o200k_base); the BPE file is downloaded/cached once
+            - ~4 characters per token
+        Counts are raw tokenizer counts; scaled() multiplies them by `scale`, an EMA of
+        (usage.prompt_tokens / counted prompt tokens) learned from real responses, which absorbs the
+        chat template and any vocabulary mismatch.
+    """
+    def __init__(self, config: dict = None):
+        cfg = config or {}
+        self.tokenizer_path = cfg.get("tokenizer_path")
+        self.encoding_name = cfg.get("tokenizer_encoding", "o200k_base")
+        self.alpha = cfg.get("token_calibration_alpha", 0.2)
+        self.scale = 1.0
+        self.calibrations = 0
+        self._encode = None
+        self.backend = None
+        self._lock = threading.Lock()
+
+    def _encoder(self):
+        if self._encode is not None:
+            return self._encode
+        with self._lock:
+            if self._encode is None:
+                self._encode, self.backend = self._load()
+                print(f"Token counter backend: {self.backend}", flush=True)
+        return self._encode
+
+    def _load(self):
+        if self.tokenizer_path:
+            try:
+                from tokenizers import Tokenizer
+                tok = Tokenizer.from_file(self.tokenizer_path)
+                return (lambda text: len(tok.encode(text, add_special_tokens=False).ids)), f"tokenizers:{self.tokenizer_path}"
+            except Exception as e:
+                print(f"[WARN] could not load tokenizer_path={self.tokenizer_path}: {e}", flush=True)
+        try:
+            import tiktoken
+            enc = tiktoken.get_encoding(self.encoding_name)
+            return (lambda text: len(enc.encode(text, disallowed_special=()))), f"tiktoken:{self.encoding_name}"
+        except Exception as e:
+            print(f"[WARN] tiktoken encoding '{self.encoding_name}' unavailable ({type(e).__name__}), using ~4 chars/token", flush=True)
+        return (lambda text: (len(text) + 3) // 4), "chars/4"
+
+    def count(self, text: str) -> int:
+        if not text:
+            return 0
+        return self._encoder()(str(text))
+
+    def count_messages(self, messages: list) -> int:
+        return sum(self.count(m.get("content", "")) + MESSAGE_OVERHEAD for m in messages) + REPLY_PRIMING
+
+    def message_tokens(self, msg_obj: dict) -> int:
+        """
+            Tokens of one window message ({"user", "assistant", "idx"}), counted once and cached
+            on the message as "tokens"
+        """
+        tokens = msg_obj.get("tokens")
+        if tokens is None:
+            tokens = sum(self.count(msg_obj.get(role, {}).get("content", "")) + MESSAGE_OVERHEAD for role in ("user", "assistant"))
+            msg_obj["tokens"] = tokens
+        return tokens
+
+    def scaled(self, raw_tokens: int) -> int:
+        return int(round(raw_tokens * self.scale))
+
+    def calibrate(self, counted: int, actual: int | None):
+        """
+            counted: raw count of a prompt we sent, actual: usage.prompt_tokens reported for it
+        """
+        if not actual or counted <= 0:
+            return
+        ratio = min(max(actual / counted, 0.5), 2.0)
+        self.scale += self.alpha * (ratio - self.scale)
+        self.calibrations += 1
+
+    def stats(self) -> dict:
+        return {"backend": self.backend, "scale": round(self.scale, 4), "calibrations": self.calibrations}
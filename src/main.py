@@ -8,6 +8,7 @@ ROOT = Path(__file__).resolve().parents[1]
 load_dotenv(ROOT / ".env", override=False)
 
 from src.pipeline.chat_pipeline import ChatPipeline
+from src.tracing import tracer
 import argparse
 import yaml
 
@@ -24,6 +25,13 @@ def parse_args():
         default=None,
         help="Path to YAML config file",
     )
+    parser.add_argument(
+        "--serve",
+        action="store_true",
+        help="Run the multi-session HTTP/WebSocket server instead of the interactive chat",
+    )
+    parser.add_argument("--host", type=str, default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8000)
     return parser.parse_args()
 
 
@@ -32,6 +40,13 @@ def parse_args():
 def main():
     args = parse_args()
     config = load_config(args.config) if args.config else None
+    tracer.configure(config)
+    if args.serve:
+        if not config:
+            raise SystemExit("--serve requires --config")
+        from src.server import serve
+        serve(config, host=args.host, port=args.port)
+        return
     pipe = ChatPipeline(config)
     asyncio.run(pipe.infinite_chat())  
 
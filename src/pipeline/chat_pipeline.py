@@ -1,22 +1,57 @@
 # src/pipeline/chat_pipeline.py
 import time
-from src.llm.client import GroqClient
+from src.llm.client import GroqClient, AsyncGroqClient
 from src.functions.session_summary import Summarization
 from src.functions.query_understanding import QueryUnderstanding
-from src.functions.database import Milvus 
+from src.functions.database import MAX_WINDOW_JSON_LENGTH
+from src.functions.memory_store import create_memory_store
+from src.pipeline.memory_worker import MemoryWorker
+from src.pipeline.speculation import SpeculationStats, SpeculativeAnswer
+from src.startup import Warmup
+from src.tracing import start_trace, end_trace, span
 
 import json
 import os 
 import asyncio
 
 class ChatPipeline:
-    def __init__(self, config: dict = None):
+    def __init__(self, config: dict = None, llm=None, session_database=None, query_understanding=None, allm=None, memory_worker=None,
+                 speculation_stats=None):
+        # llm / allm / session_database / query_understanding / memory_worker can be passed in so that many
+        # sessions share one Groq client, one memory store, one embedding model and one background queue
         self.config = config
-        self.llm = GroqClient(config=config)
-        self.session_database = Milvus(config)
+        self.llm = llm or GroqClient(config=config)
+        self.allm = allm or AsyncGroqClient(config=config)
+        self.session_database = session_database or create_memory_store(config)
+        self.query_understanding = query_understanding or QueryUnderstanding(self.allm, self.config, self.session_database)
+
+        # standalone pipeline: load the embedding model in the background while the memory store is
+        # checked and the state below is loaded (shared objects are warmed up by SessionManager)
+        self.warmup = None
+        if query_understanding is None and (self.config or {}).get("startup_warmup", True):
+            self.warmup = Warmup({
+                "embedding_model": self.query_understanding.warmup,
+                "memory_store": self.session_database.prepare,
+            }).start()
+
         self.context_length = self._load_state_from_db()
-        self.session_summary = Summarization(self.llm, self.config)
-        self.query_understanding = QueryUnderstanding(self.llm, self.config, self.session_database)
+        self.last_message = None
+        self.memory_jobs: list[dict] = []          # journaled by _finish_turn, not queued yet
+        # through the shared async client: summaries take their share of its concurrency / RPM / TPM budget
+        self.session_summary = Summarization(self.allm, self.config)
+        self.memory_worker = memory_worker or MemoryWorker(
+            self.config or {},
+            handler=self.run_memory_job,
+            journal_path=os.path.join(
+                self.config["chat_history_path"] if self.config else "chatbot_logs/",
+                self.context_length["chat_id"],
+                "memory_journal.jsonl",
+            ),
+        )
+
+        # answer the original query while query understanding decides whether it needs a rewrite
+        self.speculative = (self.config or {}).get("speculative_answer", True)
+        self.speculation_stats = speculation_stats or SpeculationStats()
 
         # Load from Milvus
 
@@ -68,22 +103,44 @@ class ChatPipeline:
         return {
             "user": {"role": "user", "content": user_input},
             "assistant": {"role": "assistant", "content": return_msg["content"]},
-            "idx": len(self.context_length["all_messages"]),
+            "idx": self.context_length["next_idx"],
         }
     
     def make_pk(self, user_id: str, chat_id: str, session_id: int) -> str:
         return f"{user_id}::{chat_id}::{session_id}"
     
     
-    def insert_session_content(self, session_content: str, full_session_json: dict = None):
+    @staticmethod
+    def sparse_text(session_content: list, full_session_json: dict | None) -> str:
+        """
+            Text indexed for keyword (BM25) search: key facts plus the summary's other lists, where exact
+            names / ids / file names tend to end up
+        """
+        ss = (full_session_json or {}).get("session_summary", {})
+        profile = ss.get("user_profile", {}) or {}
+        parts = list(session_content)
+        for items in (ss.get("decisions"), ss.get("todos"), ss.get("open_questions"), profile.get("prefs"), profile.get("constraints")):
+            parts.extend(str(x) for x in items or [])
+        return "\n".join(parts)
+
+    def insert_session_content(self, session_content: str, full_session_json: dict = None, session_id: int | None = None, vec=None,
+                               level: int = 0, first_summary_idx: int | None = None):
+        """
+            level 0: summary of one window (session_id = its summary_idx);
+            level n > 0: consolidation of summaries first_summary_idx..session_id
+        """
         user_id = self.config.get('user_id', 'default_user') if self.config else 'default_user'
         chat_id = self.context_length['chat_id']
-        session_id = self.context_length['lastest_summary_idx'] - 1  # insert the last summarized session
-        pk = self.make_pk(user_id, chat_id, session_id)
+        if session_id is None:
+            session_id = self.context_length['lastest_summary_idx'] - 1  # insert the last summarized session
+        if first_summary_idx is None:
+            first_summary_idx = session_id
+        pk = self.make_pk(user_id, chat_id, session_id) if level == 0 else f"{user_id}::{chat_id}::L{level}::{first_summary_idx}-{session_id}"
 
         key_facts = '. '.join(session_content)
 
-        vec = self.query_understanding.get_embedding(key_facts)
+        if vec is None:
+            vec = self.query_understanding.get_embedding(key_facts)
 
         # vec đang là np.ndarray (1, dim) hoặc list
         if hasattr(vec, "tolist"):
@@ -100,15 +157,22 @@ class ChatPipeline:
             "session_id": session_id,
             "session_content": key_facts,
             "embedding": vec,
-            "full_session_json": json.dumps(full_session_json)
+            "full_session_json": json.dumps(full_session_json, ensure_ascii=False),
+            # dynamic fields
+            "level": int(level),
+            "first_summary_idx": int(first_summary_idx),
+            "last_summary_idx": int(session_id),
         }
+        sparse_encoder = getattr(self.session_database, "sparse_encoder", None)
+        if sparse_encoder is not None:
+            data["sparse"] = sparse_encoder.encode_document(self.sparse_text(session_content, full_session_json))
 
-        self.session_database.insert(collection_name=self.config["session_collection_name"], data=data)
+        self.session_database.insert_session_memory(data)
+        return self.session_database.memory_meta(data)
     
         
 
     def insert_chat_log(self, user_id: str, chat_id: str, idx: int, role: str, content: str):
-        name = self.config["chat_logs_collection_name"]
         pk = f"{user_id}::{chat_id}::{idx}::{role}"
         row = {
             "pk": pk,
@@ -119,39 +183,71 @@ class ChatPipeline:
             "content": content,
             "created_at": int(time.time()),
         }
-        return self.session_database.insert(collection_name=name, data=row)
+        return self.session_database.insert_chat_log(row)
     
     
     
 
-    def load_chat_logs(self, user_id: str, chat_id: str, limit: int = 200):
-        name = self.config["chat_logs_collection_name"]
-        expr = f'user_id == "{user_id}" and chat_id == "{chat_id}"'
-        # self.session_database.ensure_loaded(name)
-        rows = self.session_database.client.query(
-            collection_name=name,
-            filter=expr,
-            output_fields=["idx", "role", "content", "created_at"],
-            limit=limit,
-        )
-        # sort by idx just in case
-        rows.sort(key=lambda r: r["idx"])
-        return rows
+    def load_chat_logs(self, user_id: str, chat_id: str, limit: int = 200, start_idx: int | None = None, end_idx: int | None = None):
+        return self.session_database.load_chat_logs(user_id, chat_id, limit=limit, start_idx=start_idx, end_idx=end_idx)
+
+    def iter_chat_logs(self, user_id: str, chat_id: str, start_idx: int | None = None, end_idx: int | None = None):
+        """
+            Lazily page through the chat's logs in idx order (see MemoryStore.iter_chat_logs)
+        """
+        return self.session_database.iter_chat_logs(user_id, chat_id, start_idx=start_idx, end_idx=end_idx)
+
+    def recent_chat_logs(self, n_turns: int) -> list:
+        """
+            Rows of this chat's last n_turns turns
+        """
+        user_id = self.config.get("user_id", "default_user")
+        return self.session_database.tail_chat_logs(user_id, self.context_length["chat_id"], n_turns, self.context_length["next_idx"])
     
 
+    @staticmethod
+    def _pair_chat_logs(rows: list) -> list:
+        """
+            chat_logs rows (one per role) -> window messages {"user", "assistant", "idx"}
+        """
+        by_idx = {}
+        for r in rows:
+            msg = by_idx.setdefault(int(r["idx"]), {"idx": int(r["idx"])})
+            msg[r["role"]] = {"role": r["role"], "content": r["content"]}
+        return [
+            {"user": m.get("user", {"role": "user", "content": ""}),
+             "assistant": m.get("assistant", {"role": "assistant", "content": ""}),
+             "idx": idx}
+            for idx, m in sorted(by_idx.items())
+        ]
+
+    def _snapshot_prefix(self, window_obj: list) -> list:
+        # longest prefix of the window whose JSON fits in the window_json column
+        prefix, size = [], 2
+        for msg in window_obj:
+            size += len(json.dumps(msg, ensure_ascii=False).encode("utf-8")) + 2
+            if size > MAX_WINDOW_JSON_LENGTH:
+                break
+            prefix.append(msg)
+        return prefix
+
     def save_context_window_state(
         self,
         user_id: str,
         chat_id: str,
         current_context_length: int,
         lastest_summary_idx: int,
-        window_obj: dict,
+        window_obj: list,
         latest_summary_obj: dict | None = None,
     ):
-        name = self.config["context_window_collection_name"]
+        """
+            Delta persistence: the window itself lives in chat_logs, this writes only a small header
+            (window idx range + counters) per turn. Every `window_compaction_interval` turns a snapshot
+            of the window is written to a separate row so reloads need at most one short idx-range query.
+        """
         pk = f"{user_id}::{chat_id}"
-
-        
+        next_idx = self.context_length["next_idx"]
+        window_start_idx = window_obj[0]["idx"] if window_obj else next_idx
 
         row = {
             "pk": pk,
@@ -159,34 +255,72 @@ class ChatPipeline:
             "chat_id": chat_id,
             "current_context_length": int(current_context_length),
             "lastest_summary_idx": int(lastest_summary_idx),
-            "window_json": json.dumps(window_obj, ensure_ascii=False),
+            "window_json": "[]",
             "latest_summary_json": json.dumps(latest_summary_obj, ensure_ascii=False) if latest_summary_obj else "{}",
+            # dynamic fields
+            "window_start_idx": int(window_start_idx),
+            "next_idx": int(next_idx),
         }
-        return self.session_database.insert(collection_name=name, data=row)
+        self.session_database.save_context_window(row)
+
+        # compaction
+        interval = self.config.get("window_compaction_interval", 8)
+        snapshot_end = self.context_length.get("window_snapshot_end_idx", -1)
+        unsnapshotted = (next_idx - 1) - max(snapshot_end, window_start_idx - 1)
+        if window_obj and unsnapshotted >= interval:
+            prefix = self._snapshot_prefix(window_obj)
+            if prefix and prefix[-1]["idx"] > snapshot_end:
+                self.session_database.save_context_window({
+                    "pk": f"{pk}::snapshot",
+                    "user_id": user_id,
+                    "chat_id": chat_id,
+                    "current_context_length": 0,
+                    "lastest_summary_idx": int(lastest_summary_idx),
+                    "window_json": json.dumps(prefix, ensure_ascii=False),
+                    "latest_summary_json": "{}",
+                    "snapshot_start_idx": int(prefix[0]["idx"]),
+                    "snapshot_end_idx": int(prefix[-1]["idx"]),
+                })
+                self.context_length["window_snapshot_end_idx"] = prefix[-1]["idx"]
 
     def load_context_window_state(self, user_id: str, chat_id: str) -> dict | None:
-        name = self.config["context_window_collection_name"]
-        self.session_database.ensure_loaded(name)
         pk = f"{user_id}::{chat_id}"
-        rows = self.session_database.client.query(
-            collection_name=name,
-            filter=f'pk == "{pk}"',
-            output_fields=[
-                "current_context_length", "lastest_summary_idx", "window_json", "latest_summary_json"
-        ])
-
-        # "current_context_length", "lastest_summary_idx", "window_json", "latest_summary_json"
-        
-        if not rows:
+        rows = self.session_database.load_context_window_rows([pk, f"{pk}::snapshot"])
+
+        r = rows.get(pk)
+        if not r:
             return None
-        r = rows[0]
-        return {
+
+        state = {
             "current_context_length": int(r.get("current_context_length", 0)),
             "lastest_summary_idx": int(r.get("lastest_summary_idx", 0)),
-            "current_message_window": json.loads(r.get("window_json", "[]") or "[]"),
             "latest_summary": json.loads(r.get("latest_summary_json", "{}") or "{}"),
+            "window_snapshot_end_idx": -1,
         }
 
+        if "window_start_idx" not in r:
+            # legacy row: the whole window is serialized in window_json
+            window = json.loads(r.get("window_json", "[]") or "[]")
+            state["current_message_window"] = window
+            state["next_idx"] = window[-1]["idx"] + 1 if window else 0
+            return state
+
+        window_start = int(r["window_start_idx"])
+        next_idx = int(r["next_idx"])
+        window = []
+        snap = rows.get(f"{pk}::snapshot")
+        if snap and int(snap.get("snapshot_start_idx", -1)) == window_start:
+            window = json.loads(snap.get("window_json", "[]") or "[]")
+            state["window_snapshot_end_idx"] = int(snap["snapshot_end_idx"])
+
+        tail_start = window[-1]["idx"] + 1 if window else window_start
+        if tail_start < next_idx:
+            window.extend(self._pair_chat_logs(self.iter_chat_logs(user_id, chat_id, start_idx=tail_start, end_idx=next_idx - 1)))
+
+        state["current_message_window"] = window
+        state["next_idx"] = next_idx
+        return state
+
     def _default_state(self):
         return {
             "chat_id": self.config.get("chat_id", "default_chat") if self.config else "default_chat",
@@ -197,7 +331,8 @@ class ChatPipeline:
             "all_messages": [],
             "lastest_summary_idx": 0,
             "latest_summary": None,
-            "logs": [],
+            "next_idx": 0,                   # idx of the next chat turn
+            "window_snapshot_end_idx": -1,   # last idx covered by the compacted window snapshot
         }
 
     def _load_state_from_db(self):
@@ -220,110 +355,287 @@ class ChatPipeline:
         default_state["lastest_summary_idx"] = state.get("lastest_summary_idx", 0)
         default_state["current_message_window"] = state.get("current_message_window", [])
         default_state["latest_summary"] = state.get("latest_summary", None)
-
-        # load logs (optional)
-        try:
-            default_state["logs"] = self.load_chat_logs(user_id, chat_id, limit=500)
-        except Exception:
-            default_state["logs"] = []
-
+        default_state["next_idx"] = state.get("next_idx", 0)
+        default_state["window_snapshot_end_idx"] = state.get("window_snapshot_end_idx", -1)
+        # full chat logs are not loaded here: use iter_chat_logs / recent_chat_logs when needed
         return default_state
 
 
 
 
 
-    async def infinite_chat(self):
-        print("Start chatting with the LLM (type 'exit' to quit)...", flush=True)
-
-        while True:
-            # input() là blocking -> đưa vào thread để await được
-            user_input = await asyncio.to_thread(input, "You: ")
-            
-            if user_input.lower() in {"exit", "quit"}:
-                print("Exiting chat. Goodbye!", flush=True)
-                break
-            
-            query_understanding_result = await asyncio.to_thread(self.query_understanding.analyze_query, user_input, self.context_length["current_message_window"])
-            
-            # llm.chat sync -> chạy trong thread, vẫn await được
-            return_msg = await asyncio.to_thread(self.llm.query_understanding, query_understanding_result)
-
-            all_tokens = return_msg["usage"].completion_tokens + len(query_understanding_result["rewritten_query"].split()) 
-
-            self.context_length["current_context_length"] += all_tokens
-
-            msg_obj = self.chat_formation(user_input, return_msg)
+    async def chat_turn_stream(self, user_input: str, submit_jobs: bool = True):
+        """
+            Run one turn and yield answer tokens as they arrive.
+            Chat logs, context-window state and summarization are written after the last token;
+            the final message is available as self.last_message once the generator is exhausted.
+            submit_jobs=False leaves the turn's memory job to submit_memory_jobs() (SessionManager
+            calls it after releasing the session lock).
+        """
+        user_id = self.config.get("user_id", "default_user") if self.config else "default_user"
+        trace = start_trace("turn", user_id=user_id, chat_id=self.context_length["chat_id"], idx=self.context_length["next_idx"])
+        answer = None
+        try:
+            with span("analyze_query"):
+                if self.speculative:
+                    query_understanding_result, answer = await self._analyze_speculatively(user_input, user_id)
+                else:
+                    query_understanding_result = await self.query_understanding.analyze_query(
+                        user_input, self.context_length["current_message_window"],
+                        user_id=user_id, chat_id=self.context_length["chat_id"],
+                    )
+
+            stream = answer or self.allm.stream_query_understanding(query_understanding_result)
+            async for token in (answer.replay() if answer else stream):
+                yield token
+
+            return_msg = stream.message
+            with span("persist_turn"):
+                await self._finish_turn(user_input, query_understanding_result, return_msg)
+            self.last_message = return_msg
+            if submit_jobs:
+                await self.submit_memory_jobs()
+        finally:
+            if answer is not None:
+                # client went away mid-stream -> stop generating
+                await answer.cancel()
+            end_trace(trace)
+
+    async def _analyze_speculatively(self, user_input: str, user_id: str):
+        """
+            Start the answer for the original query as soon as its retrieval is back, while the ambiguity
+            check / rewrite is still running. Returns (analysis, SpeculativeAnswer or None):
+                not rewritten -> the speculative answer is kept (its prompt is exactly the final one)
+                rewritten     -> it is cancelled; None tells the caller to generate from the analysis
+        """
+        qu = self.query_understanding
+        chat_id = self.context_length["chat_id"]
+        window = self.context_length["current_message_window"]
+        timings = {}
+        retrieval = asyncio.create_task(qu.retrieve(user_input, timings, user_id=user_id, chat_id=chat_id))
+        analysis = asyncio.create_task(qu.analyze_query(
+            user_input, window, user_id=user_id, chat_id=chat_id, raw_retrieval=retrieval, timings=timings,
+        ))
+        answer = None
+        try:
+            await asyncio.wait({retrieval, analysis}, return_when=asyncio.FIRST_COMPLETED)
+            if not analysis.done() and not retrieval.cancelled() and retrieval.exception() is None:
+                guess = qu.speculative_result(user_input, window, retrieval.result(), timings)
+                answer = SpeculativeAnswer(self.allm.stream_query_understanding(guess))
+            result = await analysis
+        except BaseException:
+            analysis.cancel()
+            if answer is not None:
+                await answer.cancel()
+            raise
+
+        with span("speculation") as attrs:
+            if answer is None:
+                outcome = "skipped"
+                self.speculation_stats.record(outcome)
+            elif result["rewritten_query"] == user_input:
+                outcome = "hit"
+                head_start_ms = (time.perf_counter() - answer.started) * 1000
+                attrs["head_start_ms"] = round(head_start_ms, 3)
+                self.speculation_stats.record(outcome, head_start_ms=head_start_ms)
+            else:
+                outcome = "miss"
+                await answer.cancel()
+                attrs["wasted_tokens"] = len(answer.tokens)
+                self.speculation_stats.record(outcome, wasted_tokens=len(answer.tokens))
+                answer = None
+            attrs["speculation"] = outcome
+        return result, answer
+
+    async def chat_turn(self, user_input: str, submit_jobs: bool = True) -> dict:
+        """
+            Run one full turn (query understanding -> answer -> persistence -> summary) and return the answer message
+        """
+        async for _ in self.chat_turn_stream(user_input, submit_jobs=submit_jobs):
+            pass
+        return self.last_message
+
+    def _context_tokens(self, return_msg: dict, window: list) -> int:
+        """
+            Real prompt budget: the packed answer prompt without its window block (system prompt, retrieved
+            memory, query, instructions) + every message of the window, each counted once when appended
+        """
+        counter = self.allm.token_counter
+        fixed = (return_msg.get("prompt_pack") or {}).get("fixed", 0)
+        return fixed + counter.scaled(sum(counter.message_tokens(m) for m in window))
+
+    async def _finish_turn(self, user_input: str, query_understanding_result: dict, return_msg: dict):
+        msg_obj = self.chat_formation(user_input, return_msg)
+        window = self.context_length["current_message_window"] + [msg_obj]
+        context_tokens = self._context_tokens(return_msg, window)
+        user_id = self.config.get("user_id", "default_user")
+        chat_id = self.context_length["chat_id"]
+
+        job = None
+        if context_tokens > self.context_length["max_context_length"]:
+            print(f"Context length exceeded maximum limit. [{context_tokens}/{self.context_length['max_context_length']}] Queued summary...", flush=True)
+
+            # summarization + memory insert run in the background worker; the window is journaled
+            # before the in-memory state is reset, so nothing is lost if we crash before it's summarized.
+            # It is queued by submit_memory_jobs() once the turn has released its session.
+            job = await self.memory_worker.journal({
+                "user_id": user_id,
+                "chat_id": chat_id,
+                "summary_idx": self.context_length["lastest_summary_idx"],
+                "window": window,
+            })
+            self.memory_jobs.append(job)
+
+        # no await from here on: a memory job's commit_summary sees the state before or after the turn, never half of it
+        self.context_length["current_message_window"] = window
+        self.context_length["all_messages"].append(msg_obj)
+        self.context_length["next_idx"] = msg_obj["idx"] + 1
+        self.context_length["current_context_length"] = context_tokens
+
+        # insert chat log into Milvus
+        idx = msg_obj["idx"]
+        self.insert_chat_log(user_id, chat_id, idx, "user", user_input)
+        self.insert_chat_log(user_id, chat_id, idx, "assistant", return_msg["content"])
+
+        if job is not None:
+            self.context_length["lastest_summary_idx"] += 1
+            self.context_length["current_context_length"] = 0
+            self.context_length["current_message_window"] = []
+
+        # save context window state into Milvus
+        self.save_context_window_state(
+            user_id,
+            chat_id,
+            self.context_length["current_context_length"],
+            self.context_length["lastest_summary_idx"],
+            self.context_length["current_message_window"],
+            self.context_length["latest_summary"],
+        )
 
-            # fall back insert chat logs
-            self.context_length["current_message_window"].append(msg_obj)
-            self.context_length["all_messages"].append(msg_obj)
+    async def submit_memory_jobs(self):
+        """
+            Queue the memory jobs journaled by the last turn(s). Call it without holding the session's
+            turn lock: it waits while the worker queue is full.
+        """
+        while self.memory_jobs:
+            await self.memory_worker.enqueue(self.memory_jobs.pop(0))
+
+    async def run_memory_job(self, job: dict):
+        """
+            Background part of a turn: summarize a closed window and store it as session memory
+        """
+        summary = await self.summarize_memory_job(job)
+        self.commit_summary(job, summary)
+
+    async def summarize_memory_job(self, job: dict) -> dict:
+        """
+            Summarize the job's window and insert it (then consolidate) into session memory; returns the summary
+        """
+        trace = start_trace("memory_job", user_id=job["user_id"], chat_id=job["chat_id"], summary_idx=job["summary_idx"])
+        try:
+            # rolling: fold this window into the previous summary (jobs of one chat run in order)
+            previous = self.context_length["latest_summary"] if self.config.get("summary_rolling", True) else None
+            with span("summarization", window_size=len(job["window"]), rolling=bool(previous)):
+                summary = await self.session_summary.summarize_session(job["window"], job["summary_idx"], previous)
 
-            # insert chat log into Milvus
-            user_id = self.config.get("user_id", "default_user")
-            chat_id = self.context_length["chat_id"]
-            idx = msg_obj["idx"]
-            await asyncio.to_thread(
-                self.insert_chat_log,
-                user_id,
-                chat_id,
-                idx,
-                "user",
-                user_input
-            )
+            key_facts = summary["session_summary"]["key_facts"]
+            vec = await self.query_understanding.aget_embedding('. '.join(key_facts))
             await asyncio.to_thread(
-                self.insert_chat_log,
-                user_id,
-                chat_id,
-                idx,
-                "assistant",
-                return_msg["content"]
+                self.insert_session_content,
+                key_facts,
+                summary,
+                job["summary_idx"],
+                vec,
             )
-
-            # save context window state into Milvus
-            await asyncio.to_thread(
-                self.save_context_window_state,
-                user_id,
-                chat_id,
+            await self._consolidate_memories(job["user_id"], job["chat_id"])
+        finally:
+            end_trace(trace)
+        return summary
+
+    def commit_summary(self, job: dict, summary: dict):
+        """
+            Make the summary the session's latest one and persist the session header right away: the
+            turns it covers have already left the window, so it must not wait for the next turn's save.
+            Synchronous (no await), like the state update at the end of _finish_turn, so it needs no turn
+            lock: it lands between two turns' updates on the loop.
+        """
+        latest = self.context_length["latest_summary"] or {}
+        if job["summary_idx"] >= latest.get("session_summary", {}).get("summary_idx", -1):
+            self.context_length["latest_summary"] = summary
+            self.save_context_window_state(
+                job["user_id"],
+                job["chat_id"],
                 self.context_length["current_context_length"],
                 self.context_length["lastest_summary_idx"],
                 self.context_length["current_message_window"],
                 self.context_length["latest_summary"],
             )
-
-
-            if self.context_length["current_context_length"] > self.context_length["max_context_length"]:
-                print(f"Context length exceeded maximum limit. [{self.context_length['current_context_length']}/{self.context_length['max_context_length']}] Generating summary...", flush=True)
-
-                # summarize_session sync -> chạy trong thread, await cho “đợi xong mới cho nhập”
-                summary = await asyncio.to_thread(
-                    self.session_summary.summarize_session,
-                    self.context_length["current_message_window"],
-                    self.context_length["lastest_summary_idx"],
-                )
-
-                await asyncio.to_thread(
-                    self.insert_session_content,
-                    summary["session_summary"]["key_facts"],
-                    summary
+        print(f"Summary {job['summary_idx']} done.", flush=True)
+
+    async def _consolidate_memories(self, user_id: str, chat_id: str):
+        """
+            Summary-of-summaries: whenever `summary_consolidation_fanout` memories of one level exist for this
+            chat, the oldest of them are merged into one memory of the next level and deleted, so a chat keeps
+            at most fanout - 1 memories per level (logarithmic in its length) in session memory.
+        """
+        fanout = self.config.get("summary_consolidation_fanout", 4)
+        if not fanout or fanout < 2:
+            return
+        rows = await asyncio.to_thread(self.session_database.list_session_memory, user_id, chat_id)
+        while True:
+            by_level = {}
+            for r in rows:
+                by_level.setdefault(r["level"], []).append(r)
+            full = sorted(level for level, rs in by_level.items() if len(rs) >= fanout)
+            if not full:
+                return
+            level = full[0]
+            group = sorted(by_level[level], key=lambda r: r["first_summary_idx"])[:fanout]
+            first, last = group[0]["first_summary_idx"], group[-1]["last_summary_idx"]
+
+            with span("summary_consolidation", level=level + 1, fanout=fanout):
+                summaries = [json.loads(r["full_session_json"] or "{}") for r in group]
+                merged = await self.session_summary.consolidate(summaries, level + 1, first, last)
+                key_facts = merged["session_summary"]["key_facts"]
+                vec = await self.query_understanding.aget_embedding('. '.join(key_facts))
+                # insert the merged memory before deleting its parts: a crash in between only leaves duplicates
+                meta = await asyncio.to_thread(
+                    self.insert_session_content, key_facts, merged, last, vec, level + 1, first,
                 )
+                await asyncio.to_thread(self.session_database.delete_session_memory, [r["pk"] for r in group])
 
+            merged_pks = {r["pk"] for r in group}
+            rows = [r for r in rows if r["pk"] not in merged_pks] + [meta]
 
-                self.context_length["latest_summary"] = summary
-                self.context_length["lastest_summary_idx"] += 1
+    async def infinite_chat(self):
+        # replays memory jobs a crash left in the journal now, not at the first summary of this run
+        await self.memory_worker.start()
+        print("Start chatting with the LLM (type 'exit' to quit)...", flush=True)
 
-                self.context_length["current_context_length"] = 0
-                self.context_length["current_message_window"] = []
-                print("Summary done.\n", flush=True)
+        while True:
+            # input() là blocking -> đưa vào thread để await được
+            user_input = await asyncio.to_thread(input, "You: ")
+            
+            if user_input.lower() in {"exit", "quit"}:
+                print("Exiting chat. Goodbye!", flush=True)
+                break
 
-            print(f"LLM: {return_msg['content']}\n", flush=True)
+            print("LLM: ", end="", flush=True)
+            async for token in self.chat_turn_stream(user_input):
+                print(token, end="", flush=True)
+            print("\n", flush=True)
             print(
                 f"[Context Length: {self.context_length['current_context_length']}/{self.context_length['max_context_length']}]",
                 flush=True
             )
             
 
+        await self.memory_worker.close()
+        await asyncio.to_thread(self.session_database.close)
         self.save_chat_history()
+        await self.query_understanding.embedding_service.close()
+        self.query_understanding.embedding_cache.close()
+        await self.allm.close()
 
     def chat(self, text: str):
         return self.llm.chat(text)
@@ -0,0 +1,168 @@
+# src/pipeline/memory_worker.py
+import asyncio
+import json
+import os
+import uuid
+
+from src.tracing import detached
+
+
+class MemoryWorker:
+    """
+        Background queue for summarization + session-memory writes.
+        - per-session ordering: jobs of one (user_id, chat_id) run one after another, in submit order
+        - backpressure: submit() / enqueue() wait when `memory_queue_size` jobs are already queued. A turn
+          journals its job while it holds the session lock and enqueues it only after releasing it: a
+          worker finishing a job of the same session must never wait on a turn stuck on a full queue
+        - durability: every job is appended to a JSONL journal before it is queued and marked done
+          afterwards, so a crash never loses a window that was not summarized yet (replayed on start)
+    """
+    def __init__(self, config: dict, handler, journal_path: str):
+        self.config = config
+        self.handler = handler  # async callable(job: dict)
+        self.journal_path = journal_path
+        self.num_workers = config.get("memory_workers", 2)
+        self.max_retries = config.get("memory_job_retries", 3)
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=config.get("memory_queue_size", 100))
+
+        self._session_locks: dict[tuple[str, str], asyncio.Lock] = {}
+        self._session_jobs: dict[tuple[str, str], int] = {}
+        self._pending: set[str] = set()
+        self._journal_lock = asyncio.Lock()
+        self._tasks: list[asyncio.Task] = []
+        self._started = False
+
+    # ---------- journal ----------
+    def _append_journal(self, record: dict):
+        os.makedirs(os.path.dirname(self.journal_path) or ".", exist_ok=True)
+        with open(self.journal_path, "a") as f:
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+    def _truncate_journal(self):
+        with open(self.journal_path, "w") as f:
+            f.flush()
+            os.fsync(f.fileno())
+
+    def _load_pending_jobs(self) -> list[dict]:
+        if not os.path.exists(self.journal_path):
+            return []
+        jobs, done = {}, set()
+        with open(self.journal_path, "r") as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # torn last line after a crash
+                    continue
+                if record.get("op") == "enqueue":
+                    jobs[record["job"]["job_id"]] = record["job"]
+                elif record.get("op") == "done":
+                    done.add(record["job_id"])
+        return [job for job_id, job in jobs.items() if job_id not in done]
+
+    async def _mark_done(self, job_id: str):
+        async with self._journal_lock:
+            self._pending.discard(job_id)
+            if self._pending:
+                await asyncio.to_thread(self._append_journal, {"op": "done", "job_id": job_id})
+            else:
+                # nothing outstanding -> compact the journal
+                await asyncio.to_thread(self._truncate_journal)
+
+    # ---------- queue ----------
+    def _session_key(self, job: dict) -> tuple[str, str]:
+        return (job["user_id"], job["chat_id"])
+
+    def _count(self, job: dict):
+        key = self._session_key(job)
+        self._session_jobs[key] = self._session_jobs.get(key, 0) + 1
+
+    def has_pending(self, user_id: str, chat_id: str) -> bool:
+        """
+            True while a job of this session is queued or running
+        """
+        return (user_id, chat_id) in self._session_jobs
+
+    async def start(self):
+        if self._started:
+            return
+        self._started = True
+        pending = await asyncio.to_thread(self._load_pending_jobs)
+        self._tasks = [detached(asyncio.create_task, self._run()) for _ in range(self.num_workers)]
+        if pending:
+            print(f"Replaying {len(pending)} pending memory job(s) from {self.journal_path}", flush=True)
+            self._pending.update(job["job_id"] for job in pending)
+            for job in pending:
+                self._count(job)
+                await self.queue.put(job)
+
+    async def journal(self, job: dict) -> dict:
+        """
+            Make the job durable (replayed on next start if it never runs) without queueing it;
+            returns it with its job_id, to be passed to enqueue()
+        """
+        await self.start()
+        job = {**job, "job_id": uuid.uuid4().hex}
+        async with self._journal_lock:
+            # registered as pending under the lock so a concurrent compaction can't drop the record
+            self._pending.add(job["job_id"])
+            await asyncio.to_thread(self._append_journal, {"op": "enqueue", "job": job})
+        # counted from here: has_pending() keeps the session loaded until the job has run
+        self._count(job)
+        return job
+
+    async def enqueue(self, job: dict):
+        """
+            Queue a journaled job (waits while the queue is full)
+        """
+        await self.queue.put(job)
+
+    async def submit(self, job: dict) -> str:
+        job = await self.journal(job)
+        await self.enqueue(job)
+        return job["job_id"]
+
+    async def _run(self):
+        while True:
+            job = await self.queue.get()
+            key = self._session_key(job)
+            # no await between get() and taking the lock -> per-session FIFO is preserved
+            lock = self._session_locks.setdefault(key, asyncio.Lock())
+            try:
+                async with lock:
+                    await self._process(job)
+            finally:
+                self._session_jobs[key] -= 1
+                if self._session_jobs[key] == 0:
+                    self._session_jobs.pop(key, None)
+                    self._session_locks.pop(key, None)
+                self.queue.task_done()
+
+    async def _process(self, job: dict):
+        for attempt in range(self.max_retries):
+            try:
+                await self.handler(job)
+                await self._mark_done(job["job_id"])
+                return
+            except Exception as e:
+                print(f"[WARN] memory job {job['job_id']} failed (attempt {attempt + 1}/{self.max_retries}): {e}", flush=True)
+                await asyncio.sleep(2 ** attempt)
+        # stays in the journal -> retried on next start
+        print(f"[ERROR] memory job {job['job_id']} left pending in {self.journal_path}", flush=True)
+
+    async def drain(self):
+        await self.queue.join()
+
+    async def close(self, drain: bool = True):
+        if drain and self._tasks:
+            await self.drain()
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        self._started = False
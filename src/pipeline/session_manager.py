@@ -0,0 +1,184 @@
+# src/pipeline/session_manager.py
+import asyncio
+import os
+import time
+
+from src.llm.client import GroqClient, AsyncGroqClient
+from src.functions.query_understanding import QueryUnderstanding
+from src.functions.memory_store import create_memory_store
+from src.pipeline.chat_pipeline import ChatPipeline
+from src.pipeline.memory_worker import MemoryWorker
+from src.pipeline.speculation import SpeculationStats
+from src.startup import Warmup
+from src.tracing import detached
+
+
+class Session:
+    def __init__(self, pipeline: ChatPipeline):
+        self.pipeline = pipeline
+        self.lock = asyncio.Lock()  # one turn at a time per (user_id, chat_id)
+        self.last_used = time.monotonic()
+
+
+class SessionManager:
+    """
+        Host many (user_id, chat_id) sessions in one process.
+        Groq client, memory store and SentenceTransformer are shared; per-session state
+        (ChatPipeline.context_length) is loaded lazily from the context_window collection
+        and dropped again when the session has been idle for too long.
+    """
+    def __init__(self, config: dict, llm=None, allm=None, session_database=None, query_understanding=None):
+        # the shared pieces can be passed in (e.g. the stand-ins of src/bench/fakes.py)
+        self.config = config
+        self.llm = llm or GroqClient(config=config)
+        self.allm = allm or AsyncGroqClient(config=config)
+        self.session_database = session_database or create_memory_store(config)
+        self.query_understanding = query_understanding or QueryUnderstanding(self.allm, config, self.session_database)
+        self.memory_worker = MemoryWorker(
+            config,
+            handler=self.run_memory_job,
+            journal_path=config.get("memory_journal_path") or os.path.join(config["chat_history_path"], "memory_journal.jsonl"),
+        )
+        self.speculation_stats = SpeculationStats()
+
+        # constructing the pieces above is cheap (model / Milvus are lazy) -> load them in the background
+        self.warmup = None
+        if config.get("startup_warmup", True):
+            self.warmup = Warmup({
+                "embedding_model": self.query_understanding.warmup,
+                "memory_store": self.session_database.prepare,
+            }).start()
+
+        self.idle_timeout = config.get("session_idle_timeout", 900)
+        self.max_sessions = config.get("max_sessions", 10000)
+        self.evict_interval = config.get("session_evict_interval", 60)
+
+        self.sessions: dict[tuple[str, str], Session] = {}
+        self._loading: dict[tuple[str, str], asyncio.Future] = {}
+        self._evict_task = None
+
+    def _session_config(self, user_id: str, chat_id: str) -> dict:
+        return {**self.config, "user_id": user_id, "chat_id": chat_id}
+
+    def _build_pipeline(self, user_id: str, chat_id: str) -> ChatPipeline:
+        return ChatPipeline(
+            self._session_config(user_id, chat_id),
+            llm=self.llm,
+            allm=self.allm,
+            session_database=self.session_database,
+            query_understanding=self.query_understanding,
+            memory_worker=self.memory_worker,
+            speculation_stats=self.speculation_stats,
+        )
+
+    @property
+    def ready(self) -> bool:
+        return self.warmup is None or self.warmup.ready.is_set()
+
+    async def get_session(self, user_id: str, chat_id: str) -> Session:
+        key = (user_id, chat_id)
+        session = self.sessions.get(key)
+        if session is not None:
+            session.last_used = time.monotonic()
+            return session
+
+        # several requests for the same new session -> load state from Milvus only once
+        fut = self._loading.get(key)
+        if fut is None:
+            fut = asyncio.get_running_loop().create_future()
+            self._loading[key] = fut
+            try:
+                pipeline = await asyncio.to_thread(self._build_pipeline, user_id, chat_id)
+                session = Session(pipeline)
+                self.sessions[key] = session
+                fut.set_result(session)
+            except Exception as e:
+                fut.set_exception(e)
+                # nobody else may be waiting on it -> avoid "exception never retrieved"
+                fut.exception()
+                raise
+            finally:
+                self._loading.pop(key, None)
+
+            if len(self.sessions) > self.max_sessions:
+                self.evict(max_idle=0, keep=self.max_sessions)
+            return session
+
+        session = await fut
+        session.last_used = time.monotonic()
+        return session
+
+    async def chat(self, user_id: str, chat_id: str, user_input: str) -> dict:
+        session = await self.get_session(user_id, chat_id)
+        async with session.lock:
+            return_msg = await session.pipeline.chat_turn(user_input, submit_jobs=False)
+            session.last_used = time.monotonic()
+        # outside the lock: waits while the memory queue is full, and workers take the lock-free commit path
+        await session.pipeline.submit_memory_jobs()
+        return return_msg
+
+    async def chat_stream(self, user_id: str, chat_id: str, user_input: str):
+        """
+            Yield answer tokens; the session lock is held until persistence after the last token is done.
+            The turn's memory job (if any) is queued after the lock is released.
+        """
+        session = await self.get_session(user_id, chat_id)
+        try:
+            async with session.lock:
+                async for token in session.pipeline.chat_turn_stream(user_input, submit_jobs=False):
+                    yield token
+                session.last_used = time.monotonic()
+        finally:
+            # also when the client went away after the turn was persisted: the job is journaled already
+            await session.pipeline.submit_memory_jobs()
+
+    async def run_memory_job(self, job: dict):
+        # route background summaries to their session (reloaded if it was evicted meanwhile)
+        session = await self.get_session(job["user_id"], job["chat_id"])
+        # no session lock here: a turn may be waiting on a full memory queue that only this worker drains
+        await session.pipeline.run_memory_job(job)
+
+    def evict(self, max_idle: float | None = None, keep: int | None = None) -> int:
+        """
+            Drop idle sessions (state is already persisted every turn). Busy sessions and sessions with
+            memory jobs queued or running (they write their summary back into the session) are never evicted.
+        """
+        max_idle = self.idle_timeout if max_idle is None else max_idle
+        now = time.monotonic()
+        candidates = sorted(
+            (s.last_used, key) for key, s in self.sessions.items()
+            if not s.lock.locked() and not self.memory_worker.has_pending(*key) and now - s.last_used >= max_idle
+        )
+        n_drop = len(candidates)
+        if keep is not None:
+            n_drop = min(n_drop, max(len(self.sessions) - keep, 0))
+
+        for _, key in candidates[:n_drop]:
+            self.sessions.pop(key, None)
+        if n_drop:
+            print(f"Evicted {n_drop} idle session(s), {len(self.sessions)} active.", flush=True)
+        return n_drop
+
+    async def _evict_loop(self):
+        while True:
+            await asyncio.sleep(self.evict_interval)
+            self.evict()
+
+    async def start(self):
+        await self.memory_worker.start()
+        if self._evict_task is None:
+            self._evict_task = detached(asyncio.create_task, self._evict_loop())
+
+    async def close(self):
+        if self._evict_task is not None:
+            self._evict_task.cancel()
+            try:
+                await self._evict_task
+            except asyncio.CancelledError:
+                pass
+            self._evict_task = None
+        await self.memory_worker.close()
+        await asyncio.to_thread(self.session_database.close)
+        await self.query_understanding.embedding_service.close()
+        self.query_understanding.embedding_cache.close()
+        await self.allm.close()
@@ -0,0 +1,98 @@
+# src/pipeline/speculation.py
+import asyncio
+import threading
+import time
+
+
+class SpeculativeAnswer:
+    """
+        Drives an AnswerStream in a background task and buffers its tokens until the turn decides
+        whether to keep it (replay the buffer, then follow the live stream) or cancel it.
+    """
+    def __init__(self, stream):
+        self.stream = stream
+        self.tokens: list[str] = []
+        self.started = time.perf_counter()
+        self.done = False
+        self._changed = asyncio.Event()
+        self.task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        try:
+            async for token in self.stream:
+                self.tokens.append(token)
+                self._changed.set()
+        finally:
+            self.done = True
+            self._changed.set()
+
+    async def replay(self):
+        """
+            Yield every token: the buffered ones first, then the rest as they arrive
+        """
+        i = 0
+        while True:
+            while i < len(self.tokens):
+                yield self.tokens[i]
+                i += 1
+            if self.done:
+                break
+            self._changed.clear()
+            if i == len(self.tokens) and not self.done:
+                await self._changed.wait()
+        # re-raise a failed stream
+        await self.task
+
+    async def cancel(self):
+        if not self.task.done():
+            self.task.cancel()
+        try:
+            await self.task
+        except asyncio.CancelledError:
+            pass
+        except Exception:
+            # a discarded guess failing doesn't matter
+            pass
+
+    @property
+    def message(self) -> dict:
+        return self.stream.message
+
+
+class SpeculationStats:
+    """
+        Outcome counters of speculative answering, shared by all sessions of a process:
+            hit      the query was not rewritten -> the speculative answer was kept
+            miss     the query was rewritten -> the speculative answer was cancelled and regenerated
+            skipped  query understanding finished before the original query's retrieval (nothing to speculate on)
+    """
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.skipped = 0
+        self.head_start_ms = 0.0          # answer time already spent when the verdict arrived, over all hits
+        self.wasted_tokens = 0            # tokens streamed by cancelled answers
+        self._lock = threading.Lock()
+
+    def record(self, outcome: str, head_start_ms: float = 0.0, wasted_tokens: int = 0):
+        with self._lock:
+            if outcome == "hit":
+                self.hits += 1
+                self.head_start_ms += head_start_ms
+            elif outcome == "miss":
+                self.misses += 1
+                self.wasted_tokens += wasted_tokens
+            else:
+                self.skipped += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            decided = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "skipped": self.skipped,
+                "hit_rate": round(self.hits / decided, 4) if decided else None,
+                "avg_head_start_ms": round(self.head_start_ms / self.hits, 2) if self.hits else None,
+                "wasted_tokens": self.wasted_tokens,
+            }
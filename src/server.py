@@ -0,0 +1,167 @@
+# src/server.py
+import asyncio
+import contextlib
+import json
+
+from aiohttp import web, WSMsgType
+
+from src.pipeline.session_manager import SessionManager
+from src.tracing import tracer
+
+MANAGER_KEY = web.AppKey("session_manager", SessionManager)
+
+
+def _answer_payload(return_msg: dict, session) -> dict:
+    state = session.pipeline.context_length
+    return {
+        "role": return_msg["role"],
+        "content": return_msg["content"],
+        "context_length": state["current_context_length"],
+        "max_context_length": state["max_context_length"],
+    }
+
+
+async def handle_chat(request: web.Request) -> web.Response:
+    """
+        POST /chat  {"user_id": ..., "chat_id": ..., "message": ...}
+    """
+    try:
+        body = await request.json()
+        user_id = str(body["user_id"])
+        chat_id = str(body["chat_id"])
+        message = str(body["message"])
+    except (json.JSONDecodeError, KeyError, TypeError):
+        return web.json_response({"error": "expected JSON body with user_id, chat_id, message"}, status=400)
+
+    manager = request.app[MANAGER_KEY]
+    return_msg = await manager.chat(user_id, chat_id, message)
+    session = await manager.get_session(user_id, chat_id)
+    return web.json_response(_answer_payload(return_msg, session))
+
+
+async def handle_chat_stream(request: web.Request) -> web.StreamResponse:
+    """
+        POST /chat/stream  same body as /chat, answer tokens are streamed back as chunked text/plain
+    """
+    try:
+        body = await request.json()
+        user_id = str(body["user_id"])
+        chat_id = str(body["chat_id"])
+        message = str(body["message"])
+    except (json.JSONDecodeError, KeyError, TypeError):
+        return web.json_response({"error": "expected JSON body with user_id, chat_id, message"}, status=400)
+
+    manager = request.app[MANAGER_KEY]
+    resp = web.StreamResponse(headers={"Content-Type": "text/plain; charset=utf-8"})
+    resp.enable_chunked_encoding()
+    await resp.prepare(request)
+    try:
+        # aclosing: a failed write (client gone) closes the turn now, releasing its session lock
+        async with contextlib.aclosing(manager.chat_stream(user_id, chat_id, message)) as tokens:
+            async for token in tokens:
+                await resp.write(token.encode("utf-8"))
+    except ConnectionResetError:
+        return resp
+    except Exception as e:
+        # headers are sent already -> report the error in the body
+        print(f"[ERROR] /chat/stream {user_id}/{chat_id}: {e}", flush=True)
+        try:
+            await resp.write(f"\n[error] {e}".encode("utf-8"))
+        except ConnectionResetError:
+            return resp
+    await resp.write_eof()
+    return resp
+
+
+async def handle_ws(request: web.Request) -> web.WebSocketResponse:
+    """
+        GET /ws?user_id=...&chat_id=...  then send {"message": ...} frames.
+        Each answer is streamed as {"token": ...} frames followed by one final answer frame with "done": true.
+    """
+    user_id = request.query.get("user_id")
+    chat_id = request.query.get("chat_id")
+    if not user_id or not chat_id:
+        raise web.HTTPBadRequest(text="user_id and chat_id query params are required")
+
+    ws = web.WebSocketResponse(heartbeat=30)
+    await ws.prepare(request)
+    manager = request.app[MANAGER_KEY]
+
+    async for msg in ws:
+        if msg.type != WSMsgType.TEXT:
+            continue
+        try:
+            message = str(json.loads(msg.data)["message"])
+        except (json.JSONDecodeError, KeyError, TypeError):
+            await ws.send_json({"error": "expected {\"message\": ...}"})
+            continue
+
+        try:
+            async with contextlib.aclosing(manager.chat_stream(user_id, chat_id, message)) as tokens:
+                async for token in tokens:
+                    await ws.send_json({"token": token})
+        except ConnectionResetError:
+            break
+        except Exception as e:
+            await ws.send_json({"error": str(e)})
+            continue
+        session = await manager.get_session(user_id, chat_id)
+        await ws.send_json({**_answer_payload(session.pipeline.last_message, session), "done": True})
+
+    return ws
+
+
+async def handle_health(request: web.Request) -> web.Response:
+    manager = request.app[MANAGER_KEY]
+    return web.json_response({
+        "status": "ok",
+        "sessions": len(manager.sessions),
+        "embedding": manager.query_understanding.embedding_service.stats(),
+        "embedding_cache": manager.query_understanding.embedding_cache.stats(),
+        "llm_cache": manager.allm.cache.stats(),
+        "tokens": manager.allm.token_counter.stats(),
+        "speculation": manager.speculation_stats.stats(),
+    })
+
+
+async def handle_ready(request: web.Request) -> web.Response:
+    """
+        GET /ready  200 once the startup warmup (embedding model, memory store) has finished, else 503
+    """
+    manager = request.app[MANAGER_KEY]
+    report = manager.warmup.report() if manager.warmup else {"ready": True}
+    return web.json_response(report, status=200 if manager.ready else 503)
+
+
+async def handle_metrics(request: web.Request) -> web.Response:
+    """
+        Prometheus text exposition of per-stage latency histograms and token / cache counters
+    """
+    return web.Response(text=tracer.render_prometheus(), content_type="text/plain")
+
+
+def create_app(config: dict) -> web.Application:
+    app = web.Application()
+
+    async def session_manager_ctx(app):
+        # model loading / Milvus checks run in the background warmup (see /ready); the rest is cheap
+        # but still does some file I/O -> keep it off the loop
+        manager = await asyncio.to_thread(SessionManager, config)
+        await manager.start()
+        app[MANAGER_KEY] = manager
+        yield
+        await manager.close()
+
+    app.cleanup_ctx.append(session_manager_ctx)
+
+    app.router.add_post("/chat", handle_chat)
+    app.router.add_post("/chat/stream", handle_chat_stream)
+    app.router.add_get("/ws", handle_ws)
+    app.router.add_get("/healthz", handle_health)
+    app.router.add_get("/ready", handle_ready)
+    app.router.add_get("/metrics", handle_metrics)
+    return app
+
+
+def serve(config: dict, host: str = "0.0.0.0", port: int = 8000):
+    web.run_app(create_app(config), host=host, port=port)
@@ -0,0 +1,63 @@
+# src/startup.py
+import threading
+import time
+
+from src.tracing import tracer
+
+
+class Warmup:
+    """
+        Runs independent startup steps (embedding model load, memory-store checks, ...) concurrently
+        on background threads. `ready` is set once every step has finished; report() gives the
+        per-step timing breakdown. Steps are idempotent, so code that needs a resource before
+        warmup is done simply loads it itself (and waits on the same lock).
+    """
+    def __init__(self, steps: dict):
+        self.steps = steps
+        self.timings_ms: dict[str, float] = {}
+        self.errors: dict[str, str] = {}
+        self.ready = threading.Event()
+        self.total_ms = None
+        self._t0 = None
+
+    def start(self) -> "Warmup":
+        self._t0 = time.perf_counter()
+        threads = [
+            threading.Thread(target=self._run_step, args=(name, fn), name=f"warmup-{name}", daemon=True)
+            for name, fn in self.steps.items()
+        ]
+        for t in threads:
+            t.start()
+        threading.Thread(target=self._finish, args=(threads,), name="warmup", daemon=True).start()
+        return self
+
+    def _run_step(self, name: str, fn):
+        t0 = time.perf_counter()
+        try:
+            fn()
+        except Exception as e:
+            # not fatal: the first request retries the same (lazy) initialization
+            self.errors[name] = f"{type(e).__name__}: {e}"
+            print(f"[WARN] warmup step '{name}' failed: {e}", flush=True)
+        finally:
+            self.timings_ms[name] = round((time.perf_counter() - t0) * 1000, 1)
+            tracer.observe(f"startup.{name}", self.timings_ms[name], {})
+
+    def _finish(self, threads: list):
+        for t in threads:
+            t.join()
+        self.total_ms = round((time.perf_counter() - self._t0) * 1000, 1)
+        self.ready.set()
+        steps = ", ".join(f"{name}={ms} ms" for name, ms in self.timings_ms.items())
+        print(f"Warmup done in {self.total_ms} ms ({steps}).", flush=True)
+
+    def wait(self, timeout: float | None = None) -> bool:
+        return self.ready.wait(timeout)
+
+    def report(self) -> dict:
+        return {
+            "ready": self.ready.is_set(),
+            "total_ms": self.total_ms,
+            "steps_ms": dict(self.timings_ms),
+            "errors": dict(self.errors),
+        }
@@ -0,0 +1,192 @@
+# src/tracing.py
+import contextvars
+import json
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+# latency buckets in milliseconds (Prometheus style, cumulative)
+LATENCY_BUCKETS_MS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000)
+
+_current_trace: contextvars.ContextVar["Trace | None"] = contextvars.ContextVar("current_trace", default=None)
+
+
+class Trace:
+    """
+        All spans recorded for one unit of work (a chat turn or a background memory job)
+    """
+    def __init__(self, kind: str, **attrs):
+        self.trace_id = uuid.uuid4().hex
+        self.kind = kind
+        self.attrs = attrs
+        self.started_at = time.time()
+        self._t0 = time.perf_counter()
+        self.wall_ms = None
+        self.spans: list[dict] = []
+
+    def add_span(self, stage: str, start: float, wall_ms: float, attrs: dict):
+        # list.append is atomic -> safe from to_thread workers sharing this trace
+        self.spans.append({
+            "stage": stage,
+            "start_ms": round((start - self._t0) * 1000, 3),
+            "wall_ms": round(wall_ms, 3),
+            **attrs,
+        })
+
+    def to_dict(self) -> dict:
+        return {
+            "trace_id": self.trace_id,
+            "kind": self.kind,
+            "started_at": self.started_at,
+            "wall_ms": self.wall_ms,
+            **self.attrs,
+            "spans": self.spans,
+        }
+
+
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS_MS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.count += 1
+        self.sum += value
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+
+
+class Tracer:
+    """
+        Process-wide sink: per-stage latency histograms + token/cache counters, and an optional
+        JSON-lines export of every finished trace (`trace_path`).
+    """
+    def __init__(self):
+        self.trace_path = None
+        self.histograms: dict[str, Histogram] = {}
+        self.counters: dict[tuple[str, str], float] = {}
+        self._lock = threading.Lock()
+
+    def configure(self, config: dict | None):
+        self.trace_path = (config or {}).get("trace_path")
+        if self.trace_path:
+            os.makedirs(os.path.dirname(self.trace_path) or ".", exist_ok=True)
+
+    def observe(self, stage: str, wall_ms: float, attrs: dict):
+        with self._lock:
+            self.histograms.setdefault(stage, Histogram()).observe(wall_ms)
+            for name in ("prompt_tokens", "completion_tokens", "retries"):
+                if attrs.get(name):
+                    key = (name, stage)
+                    self.counters[key] = self.counters.get(key, 0) + attrs[name]
+            for name in ("cache", "speculation"):
+                if name in attrs:
+                    key = (f"{name}_{attrs[name]}", stage)
+                    self.counters[key] = self.counters.get(key, 0) + 1
+
+    def export(self, trace: Trace):
+        self.observe(trace.kind, trace.wall_ms, {})
+        if not self.trace_path:
+            return
+        line = json.dumps(trace.to_dict(), ensure_ascii=False, default=str)
+        with self._lock:
+            with open(self.trace_path, "a") as f:
+                f.write(line + "\n")
+
+    def render_prometheus(self) -> str:
+        lines = ["# TYPE chatbot_stage_latency_ms histogram"]
+        with self._lock:
+            for stage, h in sorted(self.histograms.items()):
+                for bound, n in zip(h.buckets, h.counts):
+                    lines.append(f'chatbot_stage_latency_ms_bucket{{stage="{stage}",le="{bound}"}} {n}')
+                lines.append(f'chatbot_stage_latency_ms_bucket{{stage="{stage}",le="+Inf"}} {h.count}')
+                lines.append(f'chatbot_stage_latency_ms_sum{{stage="{stage}"}} {round(h.sum, 3)}')
+                lines.append(f'chatbot_stage_latency_ms_count{{stage="{stage}"}} {h.count}')
+            names = sorted({name for name, _ in self.counters})
+            for name in names:
+                lines.append(f"# TYPE chatbot_{name}_total counter")
+                for (n, stage), value in sorted(self.counters.items()):
+                    if n == name:
+                        lines.append(f'chatbot_{name}_total{{stage="{stage}"}} {value}')
+        return "\n".join(lines) + "\n"
+
+    def percentiles(self, stage: str) -> dict:
+        """
+            Approximate p50/p95/p99 (bucket upper bounds) for one stage
+        """
+        with self._lock:
+            h = self.histograms.get(stage)
+            if h is None or h.count == 0:
+                return {}
+            out = {}
+            for q in (0.5, 0.95, 0.99):
+                target = q * h.count
+                value = float("inf")
+                for bound, n in zip(h.buckets, h.counts):
+                    if n >= target:
+                        value = bound
+                        break
+                out[f"p{int(q * 100)}"] = value
+            return out
+
+
+tracer = Tracer()
+
+
+def start_trace(kind: str, **attrs) -> Trace:
+    trace = Trace(kind, **attrs)
+    _current_trace.set(trace)
+    return trace
+
+
+def end_trace(trace: Trace):
+    trace.wall_ms = round((time.perf_counter() - trace._t0) * 1000, 3)
+    if _current_trace.get() is trace:
+        _current_trace.set(None)
+    tracer.export(trace)
+
+
+def current_trace() -> Trace | None:
+    return _current_trace.get()
+
+
+@contextmanager
+def span(stage: str, **attrs):
+    """
+        Time a block. The yielded dict can be filled with extra attributes
+        (prompt_tokens, completion_tokens, retries, cache, ...) before the block ends.
+    """
+    start = time.perf_counter()
+    try:
+        yield attrs
+    except BaseException as e:
+        attrs.setdefault("error", type(e).__name__)
+        raise
+    finally:
+        wall_ms = (time.perf_counter() - start) * 1000
+        tracer.observe(stage, wall_ms, attrs)
+        trace = _current_trace.get()
+        if trace is not None:
+            trace.add_span(stage, start, wall_ms, attrs)
+
+
+def usage_attrs(usage) -> dict:
+    if usage is None:
+        return {}
+    return {
+        "prompt_tokens": getattr(usage, "prompt_tokens", None),
+        "completion_tokens": getattr(usage, "completion_tokens", None),
+    }
+
+
+def detached(fn, *args, **kwargs):
+    """
+        Call fn (typically asyncio.create_task) in an empty context, so long-lived background
+        tasks don't inherit - and keep recording into - the trace of whichever turn started them.
+    """
+    return contextvars.Context().run(fn, *args, **kwargs)